@@ -0,0 +1,6 @@
+"""
+Benchmarks for the hot paths in :mod:`mortar_rdb`.
+
+These are run with ``python -m benchmarks`` from a checkout, see
+``docs/development.txt`` for details.
+"""
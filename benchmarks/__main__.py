@@ -0,0 +1,73 @@
+"""
+Run the benchmarks, compare them with previous runs and record the
+results.
+"""
+
+import os
+import sys
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+from . import cases  # registers the benchmarks
+from .runner import Database, History, benchmarks, report, run
+
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument(
+        'names', nargs='*', metavar='NAME',
+        help='Only run the named benchmarks: ' +
+             ', '.join(bench.name for bench in benchmarks)
+    )
+    parser.add_argument(
+        '--history', default=os.path.join('.benchmarks', 'history.json'),
+        help='The JSON file in which results are recorded.'
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.25,
+        help='The fractional slowdown, compared with the median of recent '
+             'runs, that is treated as a regression.'
+    )
+    parser.add_argument(
+        '--window', type=int, default=5,
+        help='The number of recent runs to compare against.'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='The number of times to repeat each benchmark, '
+             'the fastest is recorded.'
+    )
+    parser.add_argument(
+        '--no-save', action='store_true',
+        help='Do not record the results of this run.'
+    )
+    options = parser.parse_args(argv)
+    unknown = set(options.names) - {bench.name for bench in benchmarks}
+    if unknown:
+        parser.error('unknown benchmarks: ' + ', '.join(sorted(unknown)))
+
+    history = History(options.history)
+    with TemporaryDirectory() as path:
+        databases = [
+            Database('memory', 'sqlite://'),
+            Database('file', 'sqlite:///' + os.path.join(path, 'bench.db')),
+        ]
+        results = run(databases, options.repeat, options.names)
+
+    regressions = report(results, history.baseline(options.window),
+                         options.threshold)
+
+    if not options.no_save:
+        history.add(results)
+        history.save()
+
+    if regressions:
+        print('%i benchmarks regressed by more than %.0f%%: %s' % (
+            len(regressions), options.threshold * 100, ', '.join(regressions)
+        ))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
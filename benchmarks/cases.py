@@ -0,0 +1,117 @@
+"""
+The benchmarks themselves.
+"""
+
+import os
+import sys
+from tempfile import TemporaryDirectory
+
+from sqlalchemy import (
+    Column, ForeignKey, Integer, MetaData, String, Table, create_engine
+)
+from testfixtures.components import TestComponents
+
+from mortar_rdb import (
+    declarative_base, drop_tables, get_session, register_session
+)
+from mortar_rdb.controlled import Config, Source, scan
+from mortar_rdb.testing import TestingBase, register_session as \
+    testing_register_session
+
+from .runner import benchmark
+
+MODULES = 500
+WIDE = 200
+
+
+def wide_metadata(tables=WIDE):
+    # a chain of tables, each with a foreign key to the previous one
+    metadata = MetaData()
+    for i in range(tables):
+        columns = [Column('id', Integer, primary_key=True),
+                   Column('name', String(50))]
+        if i:
+            columns.append(Column('parent_id', Integer,
+                                  ForeignKey('table%i.id' % (i-1))))
+        Table('table%i' % i, metadata, *columns)
+    return metadata
+
+
+@benchmark('get_session', number=10000)
+def get_session_lookup(db):
+    components = TestComponents()
+    register_session(db.url)
+    get_session()
+    yield get_session
+    components.uninstall()
+
+
+@benchmark('register_session', number=200)
+def register_session_call(db):
+    components = TestComponents()
+    yield lambda: register_session(db.url, transactional=False)
+    components.uninstall()
+
+
+@benchmark('declarative_base', number=10000, uses_db=False)
+def declarative_base_repeated(db):
+    tb = TestingBase()
+    declarative_base()
+    yield declarative_base
+    tb.restore()
+
+
+@benchmark('scan', number=5, uses_db=False)
+def scan_package(db):
+    tb = TestingBase()
+    modules = set(sys.modules)
+    with TemporaryDirectory() as path:
+        package = os.path.join(path, 'bench_scan_package')
+        os.mkdir(package)
+        with open(os.path.join(package, '__init__.py'), 'w'):
+            pass
+        for i in range(MODULES):
+            with open(os.path.join(package, 'm%i.py' % i), 'w') as module:
+                module.write(
+                    'from mortar_rdb import declarative_base\n'
+                    'from sqlalchemy import Column, Integer\n'
+                    'class Model%i(declarative_base()):\n'
+                    '    __tablename__ = "table%i"\n'
+                    '    id = Column(Integer, primary_key=True)\n' % (i, i)
+                )
+        sys.path.append(path)
+        # the first scan imports all the modules:
+        scan('bench_scan_package')
+        yield lambda: scan('bench_scan_package')
+        sys.path.remove(path)
+        for name in set(sys.modules) - modules:
+            del sys.modules[name]
+    tb.restore()
+
+
+@benchmark('source_and_config', number=20, uses_db=False)
+def source_and_config(db):
+    tables = list(wide_metadata().tables.values())
+    yield lambda: Config(Source(*tables))
+
+
+@benchmark('drop_tables', number=5)
+def drop_tables_wide(db):
+    metadata = wide_metadata()
+    engine = create_engine(db.url)
+    drop_tables(engine)
+    yield (lambda: metadata.create_all(engine)), (lambda: drop_tables(engine))
+    engine.dispose()
+
+
+@benchmark('testing.register_session', number=50)
+def testing_register_session_cycle(db):
+    metadata = wide_metadata(20)
+
+    def cycle():
+        components = TestComponents()
+        session = testing_register_session(db.url, metadata=metadata)
+        session.rollback()
+        components.uninstall()
+
+    yield cycle
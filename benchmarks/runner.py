@@ -0,0 +1,157 @@
+"""
+The machinery for defining, running and recording benchmarks.
+"""
+
+import json
+import os
+import platform
+import sys
+from datetime import datetime
+from statistics import median
+from time import perf_counter
+
+benchmarks = []
+
+
+class Database:
+    """
+    A database that benchmarks may be run against.
+    """
+
+    def __init__(self, name, url):
+        self.name = name
+        self.url = url
+
+    def __repr__(self):
+        return '<Database %s: %s>' % (self.name, self.url)
+
+
+class Benchmark:
+
+    def __init__(self, name, func, number, uses_db):
+        self.name = name
+        self.func = func
+        self.number = number
+        self.uses_db = uses_db
+
+    def run(self, db, repeat):
+        """
+        Return the fastest time, in seconds, for a single call of the
+        benchmarked code over `repeat` runs of :attr:`number` calls.
+        """
+        fixture = self.func(db)
+        prepared = next(fixture)
+        if isinstance(prepared, tuple):
+            setup, target = prepared
+        else:
+            setup, target = None, prepared
+        try:
+            best = None
+            for r in range(repeat):
+                elapsed = 0
+                for n in range(self.number):
+                    if setup is not None:
+                        setup()
+                    start = perf_counter()
+                    target()
+                    elapsed += perf_counter() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            return best / self.number
+        finally:
+            # run any teardown:
+            next(fixture, None)
+
+
+def benchmark(name, number=1000, uses_db=True):
+    """
+    Register a benchmark. The decorated function is passed a
+    :class:`Database`, or `None` if `uses_db` is `False`, and should be
+    a generator that performs any setup, yields the callable to be timed
+    and then performs any teardown.
+
+    If setup is required before every call, a tuple of the setup callable
+    and the callable to be timed may be yielded instead.
+    """
+    def register(func):
+        benchmarks.append(Benchmark(name, func, number, uses_db))
+        return func
+    return register
+
+
+def run(databases, repeat, selected=()):
+    """
+    Run the registered benchmarks, returning a dictionary mapping the
+    name of each benchmark to the time taken for one call.
+    """
+    results = {}
+    for bench in benchmarks:
+        if selected and bench.name not in selected:
+            continue
+        for db in databases if bench.uses_db else [None]:
+            name = bench.name if db is None else '%s[%s]' % (bench.name,
+                                                             db.name)
+            results[name] = bench.run(db, repeat)
+    return results
+
+
+class History:
+    """
+    A JSON file containing the results of previous benchmark runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            with open(path) as source:
+                self.runs = json.load(source)
+        else:
+            self.runs = []
+
+    def baseline(self, window):
+        """
+        Return a dictionary mapping benchmark name to the median of the
+        times for that benchmark in the last `window` runs.
+        """
+        times = {}
+        for previous in self.runs[-window:]:
+            for name, elapsed in previous['results'].items():
+                times.setdefault(name, []).append(elapsed)
+        return {name: median(values) for name, values in times.items()}
+
+    def add(self, results):
+        from sqlalchemy import __version__ as sqlalchemy_version
+        self.runs.append(dict(
+            timestamp=datetime.now().isoformat(timespec='seconds'),
+            python=platform.python_version(),
+            sqlalchemy=sqlalchemy_version,
+            results=results,
+        ))
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as target:
+            json.dump(self.runs, target, indent=2, sort_keys=True)
+
+
+def report(results, baseline, threshold, stream=sys.stdout):
+    """
+    Write a table of results compared to the baseline and return a list
+    of the names of the benchmarks that are slower than the baseline by
+    more than the threshold.
+    """
+    regressions = []
+    width = max((len(name) for name in results), default=0)
+    for name, elapsed in sorted(results.items()):
+        line = '%-*s %12.3fus' % (width, name, elapsed * 1e6)
+        previous = baseline.get(name)
+        if previous:
+            change = elapsed / previous - 1
+            line += ' %+8.1f%%' % (change * 100)
+            if change > threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        stream.write(line + '\n')
+    return regressions
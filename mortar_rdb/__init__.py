@@ -1,22 +1,36 @@
+from contextvars import ContextVar
+from importlib import import_module
 from logging import getLogger
-from sqlalchemy import create_engine
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.ext.declarative import declarative_base as sa_declarative_base
-from sqlalchemy.orm import scoped_session
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.schema import (
-    MetaData,
-    Table,
-    DropTable,
-    ForeignKeyConstraint,
-    DropConstraint,
-    )
-from zope.component import getSiteManager
-from zope.sqlalchemy import register
-from zope.sqlalchemy.datamanager import STATUS_CHANGED
+import sys
 
 from .interfaces import ISession
 
+def _lazy(module, name, alias=None):
+    # Return a placeholder for a callable that is only imported when it
+    # is first called, at which point the placeholder replaces itself in
+    # this module. This keeps "import mortar_rdb" cheap for short-lived
+    # processes.
+    alias = alias or name
+    def placeholder(*args, **kw):
+        obj = getattr(import_module(module), name)
+        globals()[alias] = obj
+        return obj(*args, **kw)
+    placeholder.__name__ = alias
+    return placeholder
+
+create_engine = _lazy('sqlalchemy', 'create_engine')
+sessionmaker = _lazy('sqlalchemy.orm', 'sessionmaker')
+scoped_session = _lazy('sqlalchemy.orm', 'scoped_session')
+getSiteManager = _lazy('zope.component', 'getSiteManager')
+register = _lazy('zope.sqlalchemy', 'register')
+shared_engine = _lazy('mortar_rdb.engines', 'shared_engine')
+prewarm_engine = _lazy('mortar_rdb.engines', 'prewarm', 'prewarm_engine')
+track_engine = _lazy('mortar_rdb.engines', 'track', 'track_engine')
+warm_queries = _lazy('mortar_rdb.queries', 'warm', 'warm_queries')
+
+# see mortar_rdb.scoping.request_scope
+_current_request = ContextVar('mortar_rdb_request', default=None)
+
 logger = getLogger('mortar_rdb')
 
 def register_session(url=None,
@@ -25,7 +39,16 @@ def register_session(url=None,
                     echo=None,
                     transactional=True,
                     scoped=True,
-                    twophase=True):
+                    twophase=True,
+                    scopefunc=None,
+                    shards=None,
+                    shard_chooser=None,
+                    identity_chooser=None,
+                    execute_chooser=None,
+                    engine_options=None,
+                    share_engine=False,
+                    prewarm=0,
+                    prewarm_query=None):
     """
     Create a :class:`~sqlalchemy.orm.session.Session` class and
     register it for later use.
@@ -45,6 +68,12 @@ def register_session(url=None,
       session for each thread that it is called from but, within that thread,
       it will always return the same session. If it is `False`, every call
       to :func:`get_session` will return a new session.
+
+    :param scopefunc: If supplied, this callable will be used in place of
+      the current thread to determine the scope of the sessions returned
+      by :func:`get_session`. A :class:`~mortar_rdb.scoping.ContextScope`
+      can be used here to scope sessions to a request rather than a
+      thread. This can only be specified when scoped sessions are used.
     
     :param transactional:
 
@@ -63,47 +92,186 @@ def register_session(url=None,
       single-phase transactions can be used for all engines by passing this
       parameter as `False`.
 
+    :param shards: If supplied, this should be a mapping of shard id to
+      either a :mod:`SQLAlchemy` url or an
+      :class:`~sqlalchemy.engine.base.Engine` and neither `url` nor
+      `engine` should be passed. Sessions will then be instances of
+      :class:`~mortar_rdb.sharding.ShardedSession`, with two-phase
+      transactions used only if supported by all shards.
+
+    :param shard_chooser: Required when `shards` are supplied, this is
+      passed a mapper, a mapped instance and, optionally, a SQL clause,
+      and must return the id of the shard to use.
+
+    :param identity_chooser: When `shards` are supplied, this may be passed
+      a mapper and a primary key identity, along with keyword parameters,
+      and should return a list of the shard ids where that identity may
+      reside. Defaults to all shards.
+
+    :param execute_chooser: When `shards` are supplied, this may be passed
+      an :class:`~sqlalchemy.orm.ORMExecuteState` and should return a list
+      of shard ids against which the statement should be executed.
+      Defaults to all shards. Where more than one shard is returned, the
+      statement will be executed against those shards concurrently and the
+      results combined.
+
+    :param engine_options: A dictionary of additional keyword parameters to
+      pass to :func:`~sqlalchemy.create_engine` when a `url` is passed, such
+      as `pool_size` or `max_overflow`. This cannot be specified if you
+      pass in an engine.
+
+    :param share_engine: If `True`, the engine for the `url` will be obtained
+      from :func:`~mortar_rdb.engines.shared_engine` so that all sessions
+      registered for the same url with the same `echo` and `engine_options`
+      will share one engine and so one connection pool.
+
+    :param prewarm: The number of connections to open, in parallel, to each
+      database when the session is registered, so that they are waiting in
+      the connection pool before the first requests arrive.
+      See :func:`~mortar_rdb.engines.prewarm`.
+
+    :param prewarm_query: If supplied, this SQL, such as ``SELECT 1``, will
+      be executed on each connection opened when pre-warming to make
+      sure it is usable.
+
+    Any statements declared with :func:`~mortar_rdb.queries.hot_query` will
+    be compiled into the statement cache of each engine used by the session.
+
     """
-    if (engine and url) or not (engine or url):
+    if shards is not None:
+        if engine or url:
+            raise TypeError('Cannot specify engine or url when using shards')
+        if shard_chooser is None:
+            raise TypeError('Must specify shard_chooser when using shards')
+    elif (engine and url) or not (engine or url):
         raise TypeError('Must specify engine or url, but not both')
 
-    if transactional and not scoped:
-        raise TypeError(
-            'Transactions can only be managed when using scoped sessions'
-            )
-        
+    _check_scoping(transactional, scoped, scopefunc)
+
+    if shards is not None:
+        Session, engines = _sharded_session_factory(
+            name, shards, echo, transactional, scoped, twophase, scopefunc,
+            shard_chooser, identity_chooser, execute_chooser,
+            engine_options, share_engine
+        )
+    else:
+        Session, engines = _engine_session_factory(
+            name, url, engine, echo, transactional, scoped, twophase,
+            scopefunc, engine_options, share_engine
+        )
+
+    for engine in engines:
+        track_engine(engine)
+        if prewarm:
+            prewarm_engine(engine, prewarm, prewarm_query)
+    warm_queries(engines)
+
+    getSiteManager().registerUtility(
+        Session,
+        provided=ISession,
+        name=name,
+        ) 
+
+def _engine_session_factory(name, url, engine, echo,
+                            transactional, scoped, twophase, scopefunc,
+                            engine_options, share_engine):
+    engine_options = engine_options or {}
     if engine:
         if echo:
             raise TypeError('Cannot specify echo if an engine is passed')
+        if engine_options or share_engine:
+            raise TypeError(
+                'Cannot specify engine_options or share_engine '
+                'if an engine is passed'
+                )
+    elif share_engine:
+        engine = shared_engine(url, echo=echo, **engine_options)
     else:
-        engine = create_engine(url, echo=echo)
+        engine = create_engine(url, echo=echo, **engine_options)
 
     logger.info('Registering session for %r with name %r',
                 engine.url, name)
 
-    params = dict(
-            bind = engine,
-            autoflush=True,
-            autocommit=False,
+    return _session_factory(
+        transactional, scoped, scopefunc,
+        bind=engine,
+        twophase=_twophase(transactional, twophase, engine),
+    ), [engine]
+
+def _sharded_session_factory(name, shards, echo,
+                             transactional, scoped, twophase, scopefunc,
+                             shard_chooser, identity_chooser, execute_chooser,
+                             engine_options, share_engine):
+    from sqlalchemy.engine.url import make_url
+    from .sharding import ShardedSession, all_shards
+
+    engines = {}
+    for shard_id, bind in shards.items():
+        if isinstance(bind, str):
+            url = make_url(bind)
+            kw = dict(engine_options or {})
+            if url.get_backend_name() == 'sqlite':
+                # connections are used from the fan-out threads:
+                kw['connect_args'] = dict(kw.get('connect_args', {}),
+                                          check_same_thread=False)
+            if share_engine:
+                bind = shared_engine(url, echo=echo, **kw)
+            else:
+                bind = create_engine(url, echo=echo, **kw)
+        elif echo:
+            raise TypeError('Cannot specify echo if an engine is passed')
+        logger.info('Registering session for %r with name %r and shard %r',
+                    bind.url, name, shard_id)
+        engines[shard_id] = bind
+
+    default_identity_chooser, default_execute_chooser = all_shards(engines)
+
+    return _session_factory(
+        transactional, scoped, scopefunc,
+        class_=ShardedSession,
+        shards=engines,
+        shard_chooser=shard_chooser,
+        identity_chooser=identity_chooser or default_identity_chooser,
+        execute_chooser=execute_chooser or default_execute_chooser,
+        twophase=_twophase(transactional, twophase, *engines.values()),
+    ), list(engines.values())
+
+def _check_scoping(transactional, scoped, scopefunc):
+    if transactional and not scoped:
+        raise TypeError(
+            'Transactions can only be managed when using scoped sessions'
             )
 
-    if transactional:
-        if twophase and engine.dialect.name in ('postgresql', 'mysql'):
-            params['twophase']=True
+    if scopefunc is not None and not scoped:
+        raise TypeError(
+            'A scopefunc can only be specified when using scoped sessions'
+            )
+
+def _twophase(transactional, twophase, *engines):
+    # two-phase transactions are only used where all engines support them
+    return bool(transactional and twophase and all(
+        engine.dialect.name in ('postgresql', 'mysql') for engine in engines
+    ))
+
+def _session_factory(transactional, scoped, scopefunc, twophase, **params):
+    params['autoflush'] = True
+
+    if twophase:
+        params['twophase'] = True
 
     Session = sessionmaker(**params)
     
     if scoped:
-        Session = scoped_session(Session)
+        if scopefunc is None:
+            Session = scoped_session(Session)
+        else:
+            Session = scoped_session(Session, scopefunc=scopefunc)
 
     if transactional:
+        from zope.sqlalchemy.datamanager import STATUS_CHANGED
         register(Session, initial_state=STATUS_CHANGED)
-    
-    getSiteManager().registerUtility(
-        Session,
-        provided=ISession,
-        name=name,
-        ) 
+
+    return Session
 
 def drop_tables(engine):
     """
@@ -114,59 +282,146 @@ def drop_tables(engine):
     first making this quite brutal!
     """
     # from http://www.sqlalchemy.org/trac/wiki/UsageRecipes/DropEverything
-    conn = engine.connect()
-
-    inspector = Inspector.from_engine(engine)
-
-    # gather all data first before dropping anything.
-    # some DBs lock after things have been dropped in 
-    # a transaction.
-    metadata = MetaData()
-
-    tbs = []
-    for table_name in inspector.get_table_names():
-        fks = []
-        for fk in inspector.get_foreign_keys(table_name):
-            if not fk['name']:
-                continue
-            fks.append(
-                ForeignKeyConstraint((),(),name=fk['name'])
-                )
-        t = Table(table_name, metadata,*fks)
-        tbs.append(t)
-        for fkc in fks:
-            conn.execute(DropConstraint(fkc, cascade=True))
+    from sqlalchemy import inspect
+    from sqlalchemy.schema import (
+        MetaData,
+        Table,
+        DropTable,
+        ForeignKeyConstraint,
+        DropConstraint,
+        )
+
+    with engine.begin() as conn:
+
+        inspector = inspect(conn)
+
+        # gather all data first before dropping anything.
+        # some DBs lock after things have been dropped in 
+        # a transaction.
+        metadata = MetaData()
 
-    for table in tbs:
-        conn.execute(DropTable(table))
+        tbs = []
+        for table_name in inspector.get_table_names():
+            fks = []
+            for fk in inspector.get_foreign_keys(table_name):
+                if not fk['name']:
+                    continue
+                fks.append(
+                    ForeignKeyConstraint((),(),name=fk['name'])
+                    )
+            t = Table(table_name, metadata,*fks)
+            tbs.append(t)
+            for fkc in fks:
+                conn.execute(DropConstraint(fkc, cascade=True))
 
-def get_session(name=u''):
+        for table in tbs:
+            # partitions are dropped along with their partitioned table
+            conn.execute(DropTable(table, if_exists=True))
+
+def get_session(name=u'', tenant=None):
     """
     Return a :class:`~sqlalchemy.orm.session.Session` instance from
     the current registry as registered with the supplied `name`.
+
+    If the session was registered using
+    :func:`~mortar_rdb.tenants.register_tenant_session`, then the
+    `tenant` for which a session is required must also be supplied.
     """
-    return getSiteManager().getUtility(ISession,name)()
+    Session = getSiteManager().getUtility(ISession,name)
+    if tenant is not None:
+        factory = getattr(Session, 'factory', None)
+        if factory is None:
+            raise TypeError(
+                'Session registered with name %r does not support tenants' % (
+                    name
+                ))
+        Session = factory(tenant)
+    session = Session()
+    request = _current_request.get()
+    if request is not None:
+        request.add(Session, session)
+    return session
 
 _bases = {}
+# table name -> the classes mapped to a table of that name by any Base
+# returned by declarative_base, see mapped_classes
+_tables = {}
+# module name -> (module, the classes defined in that module and mapped by
+# any Base returned by declarative_base), see controlled.scan
+_modules = {}
+
+class _Identity:
+    # Wraps a parameter value that cannot be hashed so that it can form
+    # part of a key in _bases, compared by identity. Holding the value
+    # here also ensures that its id is never re-used.
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __hash__(self):
+        return id(self.value)
+
+    def __eq__(self, other):
+        return isinstance(other, _Identity) and other.value is self.value
+
+def _base_key(kw):
+    key = []
+    for name, value in sorted(kw.items()):
+        try:
+            hash(value)
+        except TypeError:
+            value = _Identity(value)
+        key.append((name, value))
+    return tuple(key)
+
+def _index(mapper, cls):
+    module = sys.modules.get(cls.__module__)
+    indexed = _modules.get(cls.__module__)
+    if indexed is None or indexed[0] is not module:
+        if indexed is not None:
+            # the module has been imported again, so forget the classes
+            # from the previous import:
+            for classes in _tables.values():
+                classes[:] = [c for c in classes if c not in indexed[1]]
+        indexed = _modules[cls.__module__] = (module, [])
+    indexed[1].append(cls)
+    name = getattr(mapper.local_table, 'name', None)
+    if name is not None:
+        _tables.setdefault(name, []).append(cls)
 
 def declarative_base(**kw):
     """
     Return a :obj:`Base` as would be returned by
-    :func:`~sqlalchemy.ext.declarative.declarative_base`.
+    :func:`~sqlalchemy.orm.declarative_base`.
 
     Only one :obj:`Base` will exist for each combination of parameters
     that this function is called with. If it is called with the same
-    combination of parameters more than once, subsequent calls will
-    return the existing :obj:`Base`.
+    combination of parameters more than once, in any order, subsequent
+    calls will return the existing :obj:`Base`. Parameter values that
+    cannot be hashed, such as a :class:`dict`, are compared by identity.
 
     This method should be used so that even if more than one package
     used by a project defines models, they will all end up in the
     same :class:`~sqlalchemy.schema.MetaData` instance and all have the
     same declarative registry.
     """
-    key = tuple(kw.items())
+    key = _base_key(kw)
     if key in _bases:
         return _bases[key]
+    from sqlalchemy import event
+    from sqlalchemy.orm import declarative_base as sa_declarative_base
     base = sa_declarative_base(**kw)
+    event.listen(base, 'instrument_class', _index, propagate=True)
     _bases[key] = base
     return base
+
+def mapped_classes(table_name):
+    """
+    Return a list of the model classes mapped to a table with the
+    supplied name using any :obj:`Base` returned by
+    :func:`declarative_base`. Where single table inheritance is used, the
+    base class will be first in the list.
+    """
+    return list(_tables.get(table_name, ()))
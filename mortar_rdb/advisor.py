@@ -0,0 +1,171 @@
+"""
+Suggest indexes for the tables in a :class:`~mortar_rdb.controlled.Config`
+based on a workload of the statements an application executes.
+
+A workload is a text file containing one statement per line, with its
+whitespace normalized, and a statement appearing once for each time it is
+executed. Each column compared in a ``WHERE`` or ``JOIN ... ON`` clause
+that is not the leading column of an index, primary key or unique
+constraint is reported, ranked by how often it is used multiplied by the
+estimated number of rows in its table.
+
+A workload can be recorded while running a test suite, or any other code
+that uses a registered session, with
+:func:`~mortar_rdb.testing.record_workload`:
+
+.. code-block:: python
+
+  from mortar_rdb.testing import record_workload
+
+  with record_workload('workload.sql'):
+      ...
+
+Statements from other sources, such as a database's statement log, can
+be added using :func:`write_workload`.
+"""
+
+import re
+from collections import Counter
+
+_whitespace = re.compile(r'\s+')
+_quotes = re.compile(r'["`\[\]]')
+_keywords = (
+    'AS|ON|WHERE|INNER|LEFT|RIGHT|FULL|OUTER|CROSS|JOIN|SET|GROUP|ORDER|'
+    'LIMIT|NATURAL|USING|HAVING|UNION'
+)
+_from = re.compile(
+    r'\b(?:FROM|JOIN|UPDATE)\s+([\w.]+)'
+    r'(?:\s+(?:AS\s+)?(?!(?:%s)\b)(\w+))?' % _keywords,
+    re.IGNORECASE
+)
+_clauses = re.compile(
+    r'\b(WHERE|ON|GROUP\s+BY|ORDER\s+BY|HAVING|LIMIT|OFFSET|JOIN|SET|'
+    r'VALUES|RETURNING|UNION|FROM)\b',
+    re.IGNORECASE
+)
+_comparison = re.compile(
+    r'((?:\w+\.)?\w+)\s*'
+    r'(?:=|<>|!=|<=|>=|<|>|\bNOT\s+IN\b|\bIN\b|\bNOT\s+LIKE\b|\bLIKE\b|'
+    r'\bBETWEEN\b|\bIS\b)'
+    r'\s*((?:\w+\.)?\w+)?',
+    re.IGNORECASE
+)
+
+
+def _aliases(statement, tables):
+    # map each name a table is referred to by in the statement to the table
+    aliases = {}
+    for name, alias in _from.findall(statement):
+        table = tables.get(name)
+        if table is None:
+            continue
+        aliases[name] = table
+        if alias:
+            aliases[alias] = table
+    return aliases
+
+
+def _resolve(reference, aliases):
+    # the (table, column) a reference in a predicate is to, if any
+    if '.' in reference:
+        qualifier, name = reference.rsplit('.', 1)
+        table = aliases.get(qualifier)
+        if table is not None and name in table.c:
+            return table, table.c[name]
+        return None
+    candidates = {table for table in aliases.values()
+                  if reference in table.c}
+    if len(candidates) == 1:
+        table, = candidates
+        return table, table.c[reference]
+    return None
+
+
+def predicate_columns(statement, tables):
+    """
+    Return the set of columns compared in the ``WHERE`` and ``ON`` clauses
+    of the supplied statement. `tables` should be a mapping of table name
+    to :class:`~sqlalchemy.schema.Table` containing the tables that may be
+    referred to.
+    """
+    statement = _quotes.sub('', statement)
+    aliases = _aliases(statement, tables)
+    columns = set()
+    parts = _clauses.split(statement)
+    # parts alternates between text and the keyword that ends it
+    for keyword, text in zip(parts[1::2], parts[2::2]):
+        if keyword.upper() not in ('WHERE', 'ON'):
+            continue
+        for left, right in _comparison.findall(text):
+            for reference in left, right:
+                if not reference:
+                    continue
+                resolved = _resolve(reference, aliases)
+                if resolved is not None:
+                    columns.add(resolved[1])
+    return columns
+
+
+def indexed(column):
+    """
+    Return `True` if the supplied column is the leading column of an
+    index, primary key or unique constraint on its table.
+    """
+    from sqlalchemy import PrimaryKeyConstraint, UniqueConstraint
+    table = column.table
+    for index in table.indexes:
+        if index.expressions and index.expressions[0] is column:
+            return True
+    for constraint in table.constraints:
+        if isinstance(constraint, (PrimaryKeyConstraint, UniqueConstraint)):
+            columns = list(constraint.columns)
+            if columns and columns[0] is column:
+                return True
+    return False
+
+
+def advise(statements, tables, row_estimates):
+    """
+    Return a list of ``(score, column, executions)`` tuples, highest score
+    first, for columns used in predicates by the supplied statements that
+    are not indexed.
+
+    :param statements: An iterable of statements, with each statement
+      appearing once for each time it was executed.
+
+    :param tables: A mapping of table name to
+      :class:`~sqlalchemy.schema.Table`.
+
+    :param row_estimates: A mapping of table name to the estimated number
+      of rows in that table.
+    """
+    executions = Counter()
+    for statement, count in Counter(
+        statement.strip() for statement in statements if statement.strip()
+    ).items():
+        for column in predicate_columns(statement, tables):
+            if not indexed(column):
+                executions[column] += count
+    advice = [
+        (count * max(row_estimates.get(column.table.key, 0), 1),
+         column, count)
+        for column, count in executions.items()
+    ]
+    advice.sort(key=lambda item: (-item[0], str(item[1])))
+    return advice
+
+
+def write_workload(path, statements):
+    """
+    Append the supplied statements to the workload file at `path`, one
+    per line with their whitespace normalized. `statements` may contain
+    strings or the ``(sql, seconds)`` tuples returned by
+    :func:`~mortar_rdb.testing.assert_max_queries`.
+    """
+    with open(path, 'a') as target:
+        for statement in statements:
+            if not isinstance(statement, str):
+                statement = statement[0]
+            statement = _whitespace.sub(' ', statement).strip()
+            if statement:
+                target.write(statement + '\n')
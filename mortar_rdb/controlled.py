@@ -41,19 +41,45 @@ the database structure matches that expected by the code it is
 currently using.
 """
 
-from argparse import ArgumentParser, RawDescriptionHelpFormatter
-from inspect import getmembers
-from pkgutil import walk_packages
-from sqlalchemy import MetaData, Table, create_engine
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.engine.url import make_url
-from zope.dottedname.resolve import resolve
-
 import logging
 import sys
+from functools import cached_property
+
+# Other imports are done where needed so that importing this module,
+# usually to define a Config, is cheap.
 
 logger = logging.getLogger(__name__)
 
+def _ddl(metadata, dialect, drop=False, schema_translate_map=None,
+         tables=None):
+    # Return the statements, as strings, that create_all or drop_all
+    # would execute on a database that contains none or all of the
+    # supplied tables, or all the tables in the metadata, compiled for the
+    # supplied dialect.
+    from sqlalchemy.engine.mock import MockConnection
+
+    statements = []
+    kw = {}
+    if schema_translate_map:
+        kw = dict(schema_translate_map=schema_translate_map,
+                  render_schema_translate=True)
+
+    def executor(sql, *multiparams, **params):
+        statements.append(str(sql.compile(dialect=dialect, **kw)).strip())
+
+    engine = MockConnection(dialect, executor)
+    if drop:
+        metadata.drop_all(engine, tables=tables, checkfirst=False)
+    else:
+        metadata.create_all(engine, tables=tables, checkfirst=False)
+    return statements
+
+def _dialect_key(dialect):
+    # the attributes of a dialect that can change how a statement compiles
+    return (type(dialect), dialect.server_version_info, dialect.paramstyle,
+            dialect.positional, dialect.max_identifier_length,
+            dialect.label_length)
+
 class Source:
     """
     A collection of tables that should have their versioning managed together.
@@ -63,10 +89,16 @@ class Source:
           A sequence of :class:`~sqlalchemy.schema.Table` objects that
           contain all the tables that will be managed by the
           repository in this Source. 
+
+    :param partitioning:
+          An optional mapping of table name to a
+          :class:`~mortar_rdb.partitions.Partitioning` describing how
+          that table is partitioned.
     """
 
-    def __init__(self, *tables):
-        
+    def __init__(self, *tables, partitioning=None):
+        from sqlalchemy import Index, MetaData, Table, UniqueConstraint
+
         self.metadata = MetaData()
         
         for table in tables:
@@ -76,7 +108,40 @@ class Source:
                     'mapped model class.' % (
                         table
                         ))
-            table.tometadata(self.metadata)
+            table.to_metadata(self.metadata)
+
+        self.partitioning = dict(partitioning or {})
+        for name, spec in self.partitioning.items():
+            table = self.metadata.tables.get(name)
+            if table is None:
+                raise ValueError('%r is not a table in this Source' % name)
+            column = table.c.get(spec.column)
+            if column is None:
+                raise ValueError('%r has no column %r' % (name, spec.column))
+            if table.primary_key and not column.primary_key:
+                raise ValueError(
+                    'Partition column %r must be part of the primary key '
+                    'of %r' % (spec.column, name)
+                )
+            # PostgreSQL requires this of every unique constraint and
+            # index, not just the primary key:
+            unique = [c for c in table.constraints
+                      if isinstance(c, UniqueConstraint)]
+            unique.extend(i for i in table.indexes if i.unique)
+            for item in sorted(unique, key=lambda item: str(item.name)):
+                if column not in list(item.columns):
+                    raise ValueError(
+                        'Partition column %r must be part of the unique '
+                        '%s on (%s) of %r' % (
+                            spec.column,
+                            'index' if isinstance(item, Index)
+                            else 'constraint',
+                            ', '.join(c.name for c in item.columns),
+                            name,
+                        ))
+            table.dialect_kwargs['postgresql_partition_by'] = (
+                spec.partition_by
+            )
 
 def scan(package, tables=()):
     """Scan a package or module and return a
@@ -86,6 +151,13 @@ def scan(package, tables=()):
     the :mod:`sqlalchemy-migrate` repository contained within the
     package.
 
+    Models are found among the members of each module, so models mapped
+    using any :obj:`Base` are included. Models mapped in a module using a
+    :obj:`Base` returned by :func:`~mortar_rdb.declarative_base` are also
+    included even if they are not members of it. If a module has been
+    imported more than once, only models from the latest import are
+    included.
+
     .. note::
       While the `package` parameter is passed as a string, this will
       be resolved into a module or package object. It is not a
@@ -103,6 +175,10 @@ def scan(package, tables=()):
           :func:`~mortar_rdb.controlled.scan` cannot sensibly scan for
           these objects.
     """
+    from pkgutil import walk_packages
+    from zope.dottedname.resolve import resolve
+    from . import _modules
+
     package_ob = resolve(package)
     to_search = [package_ob]
     if hasattr(package_ob, '__path__'):
@@ -115,15 +191,18 @@ def scan(package, tables=()):
                 pass
             else:
                 to_search.append(sys.modules[modname])
-    
+
     tables_for_source = set()
     for searchable in to_search:
-        for name,ob in getmembers(searchable):
-            table = getattr(ob, '__table__', None)
-            if table is None:
-                continue
-            if ob.__module__.startswith(package):
-                tables_for_source.add(table)
+        classes = [ob for ob in vars(searchable).values()
+                   if getattr(ob, '__table__', None) is not None]
+        # classes mapped in the module that aren't attributes of it:
+        indexed = _modules.get(searchable.__name__)
+        if indexed is not None and indexed[0] is searchable:
+            classes.extend(indexed[1])
+        for cls in classes:
+            if cls.__module__.startswith(package):
+                tables_for_source.add(cls.__table__)
 
     for table in tables:
         tables_for_source.add(table)
@@ -141,24 +220,142 @@ class Config:
 
     def __init__(self, *sources):
         self.tables = set()
+        #: A dictionary mapping the name of each table in this
+        #: configuration to the :class:`Source` it comes from.
+        self.source_for = {}
         problem_tables = set()
         for source in sources:
             for table in source.metadata.tables.keys():
-                if table in self.tables:
+                if table in self.source_for:
                     problem_tables.add(table)
                 else:
-                    self.tables.add(table)
+                    self.source_for[table] = source
         if problem_tables:
             raise ValueError('Tables present in more than one Source: %s' % (
                 ', '.join(problem_tables)
                 ))
+        self.tables.update(self.source_for)
+        #: A dictionary mapping the name of each partitioned table in this
+        #: configuration to its :class:`~mortar_rdb.partitions.Partitioning`.
+        self.partitioning = {}
+        for source in sources:
+            self.partitioning.update(source.partitioning)
         self.sources = sources
         # keep track of which tables *aren't managed by a particular source
         self.excludes = {}
         for source in sources:
             excludes = self.tables - set(source.metadata.tables.keys())
             self.excludes[source] = excludes
-    
+        # the plan below is only built when first needed:
+        self._metadata = None
+        self._ddl = {}
+
+    @property
+    def metadata(self):
+        """
+        A :class:`~sqlalchemy.schema.MetaData` containing copies of the
+        tables from all sources in this configuration, such that foreign
+        keys between tables in different sources are resolved.
+        """
+        if self._metadata is None:
+            from sqlalchemy import MetaData
+            metadata = MetaData()
+            for source in self.sources:
+                for table in source.metadata.tables.values():
+                    table.to_metadata(metadata)
+            self._metadata = metadata
+        return self._metadata
+
+    @cached_property
+    def dependencies(self):
+        """
+        A dictionary mapping the name of each table in this configuration
+        to the set of names of the tables it has foreign keys to.
+        """
+        dependencies = {}
+        for name, table in self.metadata.tables.items():
+            referenced = dependencies[name] = set()
+            for fk in table.foreign_keys:
+                # "[schema.]table.column", which may not be in this config
+                target = fk.target_fullname.rsplit('.', 1)[0]
+                if target != name:
+                    referenced.add(target)
+        return dependencies
+
+    @cached_property
+    def create_order(self):
+        """
+        A list of the tables in this configuration in the order in which
+        they should be created, such that tables are created after those
+        they depend on.
+        """
+        return self.metadata.sorted_tables
+
+    @cached_property
+    def drop_order(self):
+        """
+        A list of the tables in this configuration in the order in which
+        they should be dropped.
+        """
+        return list(reversed(self.metadata.sorted_tables))
+
+    def create_ddl(self, dialect, schema_translate_map=None):
+        """
+        Return a list of the statements needed to create all the tables in
+        this configuration in an empty database using the supplied
+        :class:`~sqlalchemy.engine.interfaces.Dialect`, with schemas
+        translated using the supplied `schema_translate_map`. The
+        statements are only compiled once for each dialect and map.
+        """
+        return self._compiled(dialect, False, schema_translate_map)
+
+    def drop_ddl(self, dialect, schema_translate_map=None):
+        """
+        Return a list of the statements needed to drop all the tables in
+        this configuration from a database using the supplied
+        :class:`~sqlalchemy.engine.interfaces.Dialect`, with schemas
+        translated using the supplied `schema_translate_map`. The
+        statements are only compiled once for each dialect and map.
+        """
+        return self._compiled(dialect, True, schema_translate_map)
+
+    def _compiled(self, dialect, drop, schema_translate_map):
+        # dialects of the same type, configured in the same way and
+        # connected to the same version of a database will compile
+        # identical statements
+        key = (_dialect_key(dialect), drop,
+               tuple(sorted((schema_translate_map or {}).items(), key=str)))
+        statements = self._ddl.get(key)
+        if statements is None:
+            statements = self._ddl[key] = _ddl(
+                self.metadata, dialect, drop, schema_translate_map
+            )
+        return statements
+
+def argument(*args, **kw):
+    """
+    A decorator for methods of :class:`Scripts` subclasses that adds a
+    command line argument to the method's command. The parameters are
+    those of :meth:`~argparse.ArgumentParser.add_argument` and the parsed
+    value is passed to the method as a keyword parameter.
+    """
+    def add(method):
+        method.__dict__.setdefault('arguments', []).insert(0, (args, kw))
+        return method
+    return add
+
+def _maintenance(method):
+    # the arguments shared by the table maintenance commands
+    method = argument(
+        '--timeout', type=float, default=None,
+        help='Abandon the work on a table after this many seconds.'
+    )(method)
+    method = argument(
+        '--jobs', type=int, default=1,
+        help='The number of tables to process at once.'
+    )(method)
+    return method
+
 class Scripts:
     """
     A command-line harness for performing schema control functions on
@@ -202,17 +399,32 @@ class Scripts:
         Create all the tables in the configuration
         in the database
         """
-        names = Inspector.from_engine(self.engine).get_table_names()
+        from sqlalchemy import inspect
+        names = inspect(self.engine).get_table_names()
         if names:
             logger.error("Refusing to create as the following tables exist:")
             for name in names:
                 logger.error(name)
             return
         logger.info("Creating the following tables:")
-        for source in self.config.sources:
-            for table in source.metadata.sorted_tables:
-                logger.info(table.name)
-            source.metadata.create_all(self.engine)
+        for table in self.config.create_order:
+            logger.info(table.name)
+        with self.engine.begin() as connection:
+            for statement in self.config.create_ddl(
+                self.engine.dialect,
+                self.engine.get_execution_options().get(
+                    'schema_translate_map'
+                )
+            ):
+                connection.exec_driver_sql(statement)
+            if (self.config.partitioning and
+                    self.engine.dialect.name == 'postgresql'):
+                from .partitions import maintain_partitions
+                for action, table, partition, statement in (
+                    maintain_partitions(connection, self.config, expire=False)
+                ):
+                    logger.info('Created partition %s of %s',
+                                partition, table)
 
     def drop(self):
         "Drop all tables in the database"
@@ -224,14 +436,303 @@ class Scripts:
         else:
             logger.error("Refusing to drop all tables due to failsafe.")
 
+    @argument('workload', help='A file containing one statement per line, '
+                                'such as one written by record_workload.')
+    @argument('--limit', type=int, default=20,
+              help='The maximum number of columns to report.')
+    def advise_indexes(self, workload, limit):
+        """
+        Report columns used in predicates that are not indexed.
+
+        The statements in the workload file are analysed and each column
+        compared in a WHERE or JOIN clause that is not the leading column
+        of an index on its table in the configuration is reported. Columns
+        are ranked by how many times they are used multiplied by the
+        estimated number of rows in their table in the database.
+        """
+        from .advisor import advise
+        from .stats import row_estimates
+        tables = self.config.metadata.tables
+        with open(workload) as source:
+            statements = source.readlines()
+        with self.engine.connect() as connection:
+            estimates = row_estimates(connection, tables)
+        advice = advise(statements, tables, estimates)[:limit]
+        if not advice:
+            logger.info("All columns used in predicates are indexed.")
+            return
+        logger.info("Columns used in predicates without an index:")
+        for score, column, executions in advice:
+            logger.info('%s.%s: used %i times, score %i',
+                        column.table.name, column.name, executions, score)
+
+    def _maintain(self, operation, jobs, timeout):
+        from time import perf_counter
+        from .maintenance import maintain
+        start = perf_counter()
+        names = sorted(self.config.tables)
+        logger.info("Running %s on %i tables using %i jobs.",
+                    operation, len(names), jobs)
+        try:
+            results = maintain(self.engine, operation, names, jobs, timeout)
+        except ValueError as e:
+            logger.error(str(e))
+            return
+        for name, seconds, exception in results:
+            if exception is None:
+                logger.info('%s: %.3fs', name, seconds)
+            else:
+                logger.error('%s: failed after %.3fs: %s',
+                             name, seconds, exception)
+        logger.info('Total: %.3fs', perf_counter()-start)
+
+    @_maintenance
+    def analyze(self, jobs, timeout):
+        """
+        Update the planner statistics for the tables in the configuration.
+        """
+        self._maintain('analyze', jobs, timeout)
+
+    @_maintenance
+    def vacuum(self, jobs, timeout):
+        """
+        Reclaim space in the tables in the configuration.
+        """
+        self._maintain('vacuum', jobs, timeout)
+
+    @_maintenance
+    def reindex(self, jobs, timeout):
+        """
+        Rebuild the indexes of the tables in the configuration.
+        """
+        self._maintain('reindex', jobs, timeout)
+
+    @argument('--dry-run', action='store_true',
+              help='Only show the statements that would be executed.')
+    @argument('--interval', type=float, default=10,
+              help='The number of seconds between progress reports.')
+    def sync_indexes(self, dry_run, interval):
+        """
+        Create indexes in the configuration that are missing from the
+        database.
+
+        Indexes are compared by name alone, so an existing index whose
+        columns or options differ from the configuration is not changed.
+        On PostgreSQL, indexes are built
+        using CREATE INDEX CONCURRENTLY, outside of a transaction, so
+        that writes to their tables are not blocked, and invalid indexes
+        left by an earlier failed build are rebuilt. On MySQL, indexes
+        are built in place without locking their tables.
+        """
+        from .maintenance import build_index, index_statements
+        from .maintenance import missing_indexes
+        with self.engine.connect() as connection:
+            missing = missing_indexes(connection, self.config.metadata)
+        if not missing:
+            logger.info('All indexes exist.')
+            return
+        logger.info('Creating %i indexes.', len(missing))
+
+        def progress(index, row):
+            phase, blocks_done, blocks_total, tuples_done, tuples_total = row
+            if blocks_total:
+                logger.info('%s: %s, %i of %i blocks',
+                            index.name, phase, blocks_done, blocks_total)
+            elif tuples_total:
+                logger.info('%s: %s, %i of %i tuples',
+                            index.name, phase, tuples_done, tuples_total)
+            else:
+                logger.info('%s: %s', index.name, phase)
+
+        for index, invalid in missing:
+            if dry_run:
+                for statement in index_statements(self.engine.dialect,
+                                                  index, invalid):
+                    logger.info(statement)
+                continue
+            logger.info('%s %s on %s',
+                        'Rebuilding invalid index' if invalid
+                        else 'Creating index',
+                        index.name, index.table.fullname)
+            try:
+                seconds = build_index(self.engine, index, invalid,
+                                      progress, interval)
+            except Exception as e:
+                logger.error('%s: failed: %s', index.name, e)
+            else:
+                logger.info('%s: %.3fs', index.name, seconds)
+
+    @argument('table', help='The name of the table to purge.')
+    @argument('where', help='The SQL condition rows to purge must match.')
+    @argument('--batch-size', type=int, default=1000,
+              help='The maximum number of rows deleted in each transaction.')
+    @argument('--pause', type=float, default=0,
+              help='The number of seconds to sleep between batches.')
+    @argument('--max-lag', type=float, default=None,
+              help='Wait before each batch until replicas are no more '
+                   'than this many seconds behind. PostgreSQL only.')
+    @argument('--archive', metavar='TABLE', default=None,
+              help='Copy rows to this table before deleting them.')
+    @argument('--state', metavar='PATH', default=None,
+              help='Record progress in this file so that an interrupted '
+                   'purge can be resumed.')
+    def purge(self, table, where, batch_size, pause, max_lag, archive,
+              state):
+        """
+        Delete rows matching a condition from a table in batches.
+
+        Rows are deleted, and optionally archived, in batches ordered by
+        primary key with each batch in its own transaction, so that locks
+        are only held briefly and replicas can keep up. If a state file
+        is used, a purge that is interrupted will continue from the last
+        batch completed when run again with the same table and
+        condition. The state file is removed when the purge completes.
+        """
+        import json
+        import os
+        from time import perf_counter
+        from .purge import dump_key, load_key, purge, replica_lag
+        if table not in self.config.tables:
+            logger.error('%s is not in the configuration.', table)
+            return
+        table_ob = self.config.metadata.tables[table]
+
+        after = None
+        if state is not None and os.path.exists(state):
+            with open(state) as source:
+                saved = json.load(source)
+            if (saved['table'], saved['where']) != (table, where):
+                logger.error('%s is the state of a different purge.', state)
+                return
+            after = load_key(saved['after'])
+            logger.info('Resuming after %r.', after)
+
+        if archive is not None:
+            from sqlalchemy import MetaData, Table
+            schema = None
+            if '.' in archive:
+                schema, archive = archive.rsplit('.', 1)
+            archive = Table(archive, MetaData(), schema=schema,
+                            autoload_with=self.engine)
+
+        def lag(connection):
+            seconds = replica_lag(connection)
+            if seconds > max_lag:
+                logger.info('Replica lag is %.1fs, waiting.', seconds)
+            return seconds
+
+        totals = [0]
+
+        def batch(count, last, seconds):
+            totals[0] += count
+            logger.info('Purged %i rows in %.3fs, %i in total.',
+                        count, seconds, totals[0])
+            if state is not None:
+                # serialize before touching the file so a key that can't
+                # be stored doesn't destroy the previous state:
+                content = json.dumps(dict(table=table, where=where,
+                                          after=dump_key(last)))
+                temp = '%s.%i' % (state, os.getpid())
+                with open(temp, 'w') as target:
+                    target.write(content)
+                os.replace(temp, state)
+
+        logger.info('Purging rows from %s where %s.', table, where)
+        start = perf_counter()
+        try:
+            purge(self.engine, table_ob, where, batch_size, pause, archive,
+                  max_lag, lag, after, batch)
+        except ValueError as e:
+            logger.error(str(e))
+            return
+        if state is not None and os.path.exists(state):
+            os.remove(state)
+        logger.info('Purged %i rows in total in %.3fs.',
+                    totals[0], perf_counter()-start)
+
+    @argument('--json', dest='output', metavar='PATH', default=None,
+              help='Also write the statistics to this file as JSON.')
+    def stats(self, output):
+        """
+        Report the size of the tables in the configuration.
+
+        For each table, the estimated number of rows, the space used by
+        the table and its indexes and, where the database reports them,
+        the number of dead rows and the free space are shown, largest
+        table first.
+        """
+        from .stats import human_size, table_stats
+        with self.engine.connect() as connection:
+            stats = table_stats(connection, sorted(self.config.tables))
+        if output is not None:
+            import json
+            with open(output, 'w') as target:
+                json.dump(stats, target, indent=2, sort_keys=True)
+        rows = [('Table', 'Rows', 'Table size', 'Index size',
+                 'Dead rows', 'Free')]
+        for name, values in sorted(
+            stats.items(),
+            key=lambda item: (-((item[1]['table_bytes'] or 0) +
+                                (item[1]['index_bytes'] or 0)),
+                              -item[1]['rows'], item[0])
+        ):
+            rows.append((
+                name,
+                str(values['rows']),
+                human_size(values['table_bytes']),
+                human_size(values['index_bytes']),
+                '-' if values['dead_rows'] is None
+                else str(values['dead_rows']),
+                human_size(values['free_bytes']),
+            ))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(rows[0]))]
+        for row in rows:
+            logger.info('  '.join(
+                [row[0].ljust(widths[0])] +
+                [value.rjust(width) for value, width in zip(row[1:],
+                                                            widths[1:])]
+            ).rstrip())
+
+    @argument('--date', default=None,
+              help='Maintain partitions as if today were this date, '
+                   'in YYYY-MM-DD form.')
+    def maintain_partitions(self, date):
+        """
+        Create upcoming partitions and remove expired ones.
+
+        For each partitioned table in the configuration, any missing
+        partitions are created, including range partitions for the periods
+        to be created in advance. Range partitions older than the
+        table's retention policy are dropped or detached.
+        """
+        from datetime import date as date_type
+        from .partitions import maintain_partitions
+        if date is not None:
+            date = date_type.fromisoformat(date)
+        try:
+            with self.engine.begin() as connection:
+                executed = maintain_partitions(connection, self.config, date)
+        except ValueError as e:
+            logger.error(str(e))
+            return
+        if not executed:
+            logger.info('All partitions are up to date.')
+        done = dict(create='Created', detach='Detached', drop='Dropped')
+        for action, table, partition, statement in executed:
+            logger.info('%s partition %s of %s',
+                        done[action], partition, table)
+
     def setup_parser(self, parser):
+        from argparse import RawDescriptionHelpFormatter
+        from sqlalchemy.engine.url import make_url
         parser.formatter_class = RawDescriptionHelpFormatter
         if parser.description is None:
             parser.description = ''
         if self.default_url:
             parser.description += (
                 '\nThe database to be acted on is at:\n%r' % (
-                make_url(self.default_url)
+                make_url(self.default_url),
             ))
         parser.description += (
             '\n\nThe following tables are in the current configuration:\n' +
@@ -253,10 +754,15 @@ class Scripts:
                 continue
             doc = doc.strip()
             command = commands.add_parser(
-                name,
-                help=doc
+                name.replace('_', '-'),
+                help=doc.split('\n\n')[0],
+                description=doc,
                 )
-            command.set_defaults(method=getattr(self,name))
+            method = getattr(self, name)
+            dests = []
+            for args, kw in getattr(method, 'arguments', ()):
+                dests.append(command.add_argument(*args, **kw).dest)
+            command.set_defaults(method=method, method_arguments=dests)
 
     def setup_logging(self):
         handler = logging.StreamHandler()
@@ -265,12 +771,15 @@ class Scripts:
         logger.setLevel(logging.INFO)
 
     def run(self, db_url, options):
+        from sqlalchemy import create_engine
         db_url = options.url or db_url
         self.engine = create_engine(db_url)
         logger.info("For database at %r:", self.engine.url)
-        options.method()
+        names = getattr(options, 'method_arguments', ())
+        options.method(**{name: getattr(options, name) for name in names})
 
     def __call__(self, argv=None):
+        from argparse import ArgumentParser
         parser = ArgumentParser()
         self.setup_parser(parser)
         options = parser.parse_args(argv)
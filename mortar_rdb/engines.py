@@ -0,0 +1,206 @@
+"""
+Helpers for managing the engines used by sessions registered with
+:func:`~mortar_rdb.register_session`.
+
+This includes a process-wide registry of engines so that sessions
+registered with the same url and engine options can share one engine
+and so one connection pool.
+
+It also includes protection for engines that are created before a
+process forks, such as when an application is preloaded by a pre-forking
+server like gunicorn or uWSGI. All engines used by sessions registered
+with :func:`~mortar_rdb.register_session` are tracked and, in a child
+process, each is given a new, empty connection pool so that the child
+never uses a connection, and so a socket, that it shares with its parent.
+"""
+
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+from weakref import WeakSet
+
+from sqlalchemy import create_engine, event, exc, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import SingletonThreadPool
+
+logger = getLogger('mortar_rdb')
+
+_engines = {}
+_lock = Lock()
+
+_tracked = WeakSet()
+# Pools inherited from a parent process are kept here so that they are
+# never garbage collected, as that would close connections that the
+# parent process is still using.
+_inherited = []
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def engine_key(url, **options):
+    """
+    Return the key used to look up the engine for the supplied url and
+    engine options. Urls that differ only in the order of their query
+    parameters, and options that differ only in their order, will have
+    the same key.
+    """
+    url = make_url(url)
+    return url.render_as_string(hide_password=False), _freeze(options)
+
+
+def shared_engine(url, **options):
+    """
+    Return the engine for the supplied url and options, creating it with
+    :func:`~sqlalchemy.create_engine` if no such engine has been created
+    before.
+    """
+    key = engine_key(url, **options)
+    with _lock:
+        engine = _engines.get(key)
+        if engine is None:
+            engine = _engines[key] = create_engine(url, **options)
+        return engine
+
+
+def dispose_shared_engines():
+    """
+    Dispose of all the engines returned by :func:`shared_engine` and
+    empty the registry.
+    """
+    with _lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def prewarm(engine, connections, query=None):
+    """
+    Open the specified number of connections to the database for the
+    supplied engine, in parallel, and then return them all to the
+    engine's pool so that they are ready for use.
+
+    :param query: If supplied, this SQL will be executed on each
+      connection to check it is usable. Any failure will be raised once
+      all connections that were successfully opened have been returned to
+      the pool.
+
+    .. note::
+
+      Where the pool has a limited size, such as a
+      :class:`~sqlalchemy.pool.QueuePool` with a `pool_size` greater than
+      zero, no more connections than that size are opened, as any more
+      could not be kept in the pool and could have to wait for the pool's
+      timeout. A :class:`~sqlalchemy.pool.SingletonThreadPool`, the
+      default for in-memory SQLite databases, keeps one connection for
+      each thread, so only the calling thread's connection is opened.
+      Pools such as :class:`~sqlalchemy.pool.NullPool` do not keep
+      connections at all, so pre-warming them is not useful.
+    """
+    def connect():
+        connection = engine.connect()
+        if query is not None:
+            try:
+                connection.execute(text(query)).close()
+            except:
+                connection.close()
+                raise
+        return connection
+
+    # QueuePool.size() is the number of connections it keeps, where 0
+    # means no limit. SingletonThreadPool.size is an int that limits
+    # threads rather than connections, so is ignored.
+    size = getattr(engine.pool, 'size', None)
+    if callable(size) and size() > 0:
+        connections = min(connections, size())
+
+    start = perf_counter()
+    if isinstance(engine.pool, SingletonThreadPool):
+        # This pool keeps one connection for each thread, so only the
+        # connection for the calling thread can be of any use and it must
+        # be opened in that thread.
+        connections = min(connections, 1)
+        futures = []
+        for i in range(connections):
+            future = Future()
+            try:
+                future.set_result(connect())
+            except Exception as e:
+                future.set_exception(e)
+            futures.append(future)
+    else:
+        with ThreadPoolExecutor(
+            max_workers=max(connections, 1),
+            thread_name_prefix='mortar_rdb_prewarm'
+        ) as pool:
+            futures = [pool.submit(connect) for i in range(connections)]
+
+    error = None
+    for future in futures:
+        if future.exception() is None:
+            future.result().close()
+        elif error is None:
+            error = future.exception()
+    if error is not None:
+        raise error
+
+    logger.info('Opened %i connections for %r in %.3fs',
+                connections, engine.url, perf_counter()-start)
+
+
+def reset_pool(engine):
+    """
+    Give the supplied engine a new, empty connection pool without closing
+    any of the connections in its current pool. This is what happens to
+    all tracked engines in a child process after a fork.
+    """
+    _inherited.append(engine.pool)
+    engine.pool = engine.pool.recreate()
+
+
+def _after_fork_in_child():
+    for engine in list(_tracked):
+        reset_pool(engine)
+
+
+def _check_pid(engine):
+    # for platforms without os.register_at_fork, invalidate any
+    # connection that was opened by another process when checked out
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        connection_record.info['mortar_rdb_pid'] = os.getpid()
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        pid = os.getpid()
+        if connection_record.info.get('mortar_rdb_pid', pid) != pid:
+            connection_record.dbapi_connection = None
+            connection_proxy.dbapi_connection = None
+            raise exc.DisconnectionError(
+                'Connection record belongs to pid %s, '
+                'attempting to check out in pid %s' % (
+                    connection_record.info['mortar_rdb_pid'], pid
+                ))
+
+
+def track(engine):
+    """
+    Track the supplied engine so that, should this process fork, the
+    engine will have a new, empty connection pool in the child process.
+    """
+    if engine in _tracked:
+        return
+    _tracked.add(engine)
+    if not hasattr(os, 'register_at_fork'):
+        _check_pid(engine)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,220 @@
+"""
+Helpers for maintaining the tables in a database, used by the commands
+provided by :class:`~mortar_rdb.controlled.Scripts`.
+"""
+
+import re
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from time import perf_counter
+
+# CREATE INDEX without CONCURRENTLY, which postgresql_concurrently=True
+# adds itself:
+_create_index = re.compile(r'^(CREATE (?:UNIQUE )?INDEX) (?!CONCURRENTLY )')
+
+# operation -> dialect name -> statement
+_statements = {
+    'analyze': dict(
+        postgresql='ANALYZE {}',
+        mysql='ANALYZE TABLE {}',
+        sqlite='ANALYZE {}',
+    ),
+    'vacuum': dict(
+        postgresql='VACUUM {}',
+        mysql='OPTIMIZE TABLE {}',
+        # SQLite can only vacuum a whole database
+    ),
+    'reindex': dict(
+        postgresql='REINDEX TABLE {}',
+        sqlite='REINDEX {}',
+    ),
+}
+
+
+def quote_table(dialect, name):
+    """
+    Return the supplied table name, which may include a schema, quoted
+    as required by the supplied dialect.
+    """
+    preparer = dialect.identifier_preparer
+    return '.'.join(preparer.quote(part) for part in name.split('.'))
+
+
+@contextmanager
+def time_limit(connection, seconds):
+    """
+    A context manager that, where the database supports it, causes
+    statements executed on the supplied connection within it to be
+    abandoned once they have run for the supplied number of `seconds`.
+    PostgreSQL and SQLite are supported.
+    """
+    dialect = connection.dialect.name
+    if seconds is None or dialect not in ('postgresql', 'sqlite'):
+        yield
+    elif dialect == 'postgresql':
+        connection.exec_driver_sql(
+            'SET statement_timeout = %i' % (seconds * 1000)
+        )
+        try:
+            yield
+        finally:
+            connection.exec_driver_sql('RESET statement_timeout')
+    else:
+        deadline = perf_counter() + seconds
+        driver_connection = connection.connection.driver_connection
+        # a non-zero return value interrupts the current statement:
+        driver_connection.set_progress_handler(
+            lambda: perf_counter() > deadline, 1000
+        )
+        try:
+            yield
+        finally:
+            driver_connection.set_progress_handler(None, 1000)
+
+
+def maintain(engine, operation, names, jobs=1, timeout=None):
+    """
+    Perform a maintenance `operation`, one of ``'analyze'``, ``'vacuum'``
+    or ``'reindex'``, on each of the named tables, using up to `jobs`
+    connections at once.
+
+    :param timeout: If supplied, the number of seconds after which the
+      operation on a single table will be abandoned, where the database
+      supports it. See :func:`time_limit`.
+
+    A list of ``(name, seconds, exception)`` tuples is returned in the
+    order the names were supplied, where `exception` is `None` unless the
+    operation on that table failed.
+    """
+    template = _statements[operation].get(engine.dialect.name)
+    if template is None:
+        raise ValueError('%s is not supported for %s databases' % (
+            operation, engine.dialect.name
+        ))
+
+    def process(name):
+        start = perf_counter()
+        try:
+            with engine.connect() as connection:
+                # maintenance statements can't be run in a transaction
+                connection.execution_options(isolation_level='AUTOCOMMIT')
+                with time_limit(connection, timeout):
+                    connection.exec_driver_sql(template.format(
+                        quote_table(engine.dialect, name)
+                    ))
+        except Exception as exception:
+            return name, perf_counter()-start, exception
+        return name, perf_counter()-start, None
+
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='mortar_rdb_maintain') as pool:
+        return list(pool.map(process, names))
+
+
+def missing_indexes(connection, metadata):
+    """
+    Return a list of ``(index, invalid)`` tuples for the indexes on the
+    tables in the supplied :class:`~sqlalchemy.schema.MetaData` that are
+    not usable in the database, in the order of the tables they are on.
+    `invalid` is `True` where a PostgreSQL index exists but is invalid,
+    usually as the result of an earlier concurrent build failing.
+
+    Indexes are compared by name alone, so an index in the database with
+    the same name as one in the metadata is treated as present even if
+    its columns or options differ. Only indexes on tables that exist in
+    the database are considered.
+    """
+    from sqlalchemy import inspect, text
+    inspector = inspect(connection)
+    missing = []
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name, table.schema):
+            continue
+        existing = {index['name'] for index in
+                    inspector.get_indexes(table.name, table.schema)}
+        existing.update(constraint['name'] for constraint in
+                        inspector.get_unique_constraints(table.name,
+                                                         table.schema))
+        invalid = set()
+        if connection.dialect.name == 'postgresql':
+            invalid.update(connection.execute(text(
+                "select c.relname from pg_index i "
+                "join pg_class c on c.oid = i.indexrelid "
+                "where not i.indisvalid "
+                "and i.indrelid = cast(:name as regclass)"
+            ), dict(name=table.fullname)).scalars())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name in invalid:
+                missing.append((index, True))
+            elif index.name not in existing:
+                missing.append((index, False))
+    return missing
+
+
+def index_statements(dialect, index, invalid=False):
+    """
+    Return a list of the statements needed to build the supplied index
+    without blocking writes to its table where the database allows it.
+
+    On PostgreSQL, ``CREATE INDEX CONCURRENTLY`` is used, after dropping
+    the index concurrently if it is `invalid`. On MySQL, the index is
+    built in place without locking the table.
+    """
+    from sqlalchemy.schema import CreateIndex
+    statement = str(CreateIndex(index).compile(dialect=dialect)).strip()
+    statements = []
+    if dialect.name == 'postgresql':
+        if invalid:
+            name = index.name
+            if index.table.schema:
+                name = index.table.schema + '.' + name
+            statements.append('DROP INDEX CONCURRENTLY IF EXISTS ' +
+                              quote_table(dialect, name))
+        statement = _create_index.sub(r'\1 CONCURRENTLY ', statement)
+    elif dialect.name == 'mysql':
+        statement += ' ALGORITHM=INPLACE LOCK=NONE'
+    statements.append(statement)
+    return statements
+
+
+def build_index(engine, index, invalid=False, progress=None, interval=10):
+    """
+    Build the supplied index using the statements returned by
+    :func:`index_statements`, outside of a transaction.
+
+    :param progress: If supplied, on PostgreSQL this callable is called
+      every `interval` seconds while the index is being built with the
+      index and a row from ``pg_stat_progress_create_index`` containing
+      ``phase``, ``blocks_done``, ``blocks_total``, ``tuples_done`` and
+      ``tuples_total``.
+
+    The number of seconds taken is returned.
+    """
+    from sqlalchemy import text
+    start = perf_counter()
+    monitor = progress is not None and engine.dialect.name == 'postgresql'
+    with engine.connect() as connection:
+        # concurrent index builds can't be run in a transaction
+        connection.execution_options(isolation_level='AUTOCOMMIT')
+        for statement in index_statements(engine.dialect, index, invalid):
+            if not monitor:
+                connection.exec_driver_sql(statement)
+                continue
+            pid = connection.exec_driver_sql(
+                'select pg_backend_pid()'
+            ).scalar()
+            with ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='mortar_rdb_index'
+            ) as pool, engine.connect() as watcher:
+                future = pool.submit(connection.exec_driver_sql, statement)
+                while not wait([future], timeout=interval).done:
+                    row = watcher.execute(text(
+                        "select phase, blocks_done, blocks_total, "
+                        "tuples_done, tuples_total "
+                        "from pg_stat_progress_create_index where pid = :pid"
+                    ), dict(pid=pid)).first()
+                    watcher.rollback()
+                    if row is not None:
+                        progress(index, row)
+                future.result()
+    return perf_counter()-start
@@ -0,0 +1,322 @@
+"""
+Declarative partitioning of the tables in a
+:class:`~mortar_rdb.controlled.Config`.
+
+A table is marked as partitioned when it is added to a
+:class:`~mortar_rdb.controlled.Source`:
+
+.. code-block:: python
+
+  from mortar_rdb.controlled import Config, Source
+  from mortar_rdb.partitions import RangePartitioning
+
+  config = Config(Source(
+      Event.__table__,
+      partitioning={'event': RangePartitioning('at', retain=12)},
+  ))
+
+On PostgreSQL, :meth:`~mortar_rdb.controlled.Scripts.create` will then
+create the table using native partitioning along with its initial
+partitions, and the ``maintain-partitions`` command will create upcoming
+range partitions and remove those that have passed their retention
+period. Other databases create the table without partitions.
+
+The partition column must be part of the table's primary key and of
+each of its unique constraints and unique indexes, as PostgreSQL requires
+this of a partitioned table. :class:`~mortar_rdb.controlled.Source`
+raises a :class:`ValueError` if it is not.
+
+Other ways of partitioning can be added by subclassing
+:class:`Partitioning`.
+"""
+
+import re
+from datetime import date, datetime, timedelta
+
+_formats = dict(day='%Y_%m_%d', month='%Y_%m', year='%Y')
+
+
+def _start(day, interval):
+    # the first day of the period containing the supplied day
+    if interval == 'year':
+        return day.replace(month=1, day=1)
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def _step(start, interval, count=1):
+    # the start of the period `count` periods after the supplied start
+    if interval == 'day':
+        return start + timedelta(days=count)
+    months = start.year*12 + start.month - 1
+    months += count * (12 if interval == 'year' else 1)
+    return start.replace(year=months // 12, month=months % 12 + 1)
+
+
+def _literal(dialect, value):
+    from sqlalchemy import literal
+    return str(literal(value).compile(
+        dialect=dialect, compile_kwargs=dict(literal_binds=True)
+    ))
+
+
+def _unqualified(name):
+    return name.rsplit('.', 1)[-1]
+
+
+def _qualified(table_name, name):
+    # put a partition in the same schema as its table
+    if '.' in table_name:
+        return table_name.rsplit('.', 1)[0] + '.' + name
+    return name
+
+
+class Partitioning(object):
+    """
+    The base class for the ways in which a table can be partitioned.
+    Subclasses set :attr:`method` and return the partitions a table should
+    have from :meth:`partitions`. Used directly, no partitions are
+    created or removed, so they must be managed by other means.
+
+    :param column: The name of the column the table is partitioned by.
+    """
+
+    #: The partitioning method used in the ``PARTITION BY`` clause.
+    method = None
+
+    def __init__(self, column):
+        if self.method is None:
+            raise TypeError('%s does not set a partitioning method' % (
+                type(self).__name__
+            ))
+        self.column = column
+
+    @property
+    def partition_by(self):
+        """
+        The text that follows ``PARTITION BY`` when the table is created.
+        """
+        return '%s (%s)' % (self.method, self.column)
+
+    def partitions(self, dialect, table_name, today):
+        """
+        Return a list of ``(name, bound)`` tuples for the partitions the
+        named table should have on the supplied date, where `bound` is
+        the partition bound clause used when creating the partition.
+        """
+        return []
+
+    def expired(self, table_name, existing, today):
+        """
+        Return a sorted list of the names of the `existing` partitions of
+        the named table that should be removed on the supplied date.
+        """
+        return []
+
+    def __repr__(self):
+        return '<%s on %s>' % (type(self).__name__, self.column)
+
+
+class RangePartitioning(Partitioning):
+    """
+    Partition a table by ranges of a date or timestamp column, with one
+    partition per day, month or year.
+
+    :param interval: ``'day'``, ``'month'`` or ``'year'``.
+
+    :param premake: The number of partitions to create in advance of the
+      one containing the current date.
+
+    :param retain: If supplied, the number of partitions before the one
+      containing the current date to keep. Older partitions are removed.
+
+    :param detach: If `True`, old partitions are detached from the table,
+      leaving them to be archived, rather than dropped.
+
+    :param default: If `True`, a default partition is created to contain
+      rows that fall outside all other partitions.
+    """
+
+    method = 'RANGE'
+
+    def __init__(self, column, interval='month', premake=3, retain=None,
+                 detach=False, default=False):
+        if interval not in _formats:
+            raise ValueError('interval must be one of: %s' % (
+                ', '.join(sorted(_formats))
+            ))
+        super(RangePartitioning, self).__init__(column)
+        self.interval = interval
+        self.premake = premake
+        self.retain = retain
+        self.detach = detach
+        self.default = default
+
+    def _name(self, table_name, start):
+        return '%s_p%s' % (table_name, start.strftime(_formats[self.interval]))
+
+    def partitions(self, dialect, table_name, today):
+        partitions = []
+        start = _start(today, self.interval)
+        for i in range(self.premake + 1):
+            end = _step(start, self.interval)
+            partitions.append((
+                self._name(table_name, start),
+                'FOR VALUES FROM (%s) TO (%s)' % (
+                    _literal(dialect, start.isoformat()),
+                    _literal(dialect, end.isoformat()),
+                )
+            ))
+            start = end
+        if self.default:
+            partitions.append((table_name + '_default', 'DEFAULT'))
+        return partitions
+
+    def expired(self, table_name, existing, today):
+        if self.retain is None:
+            return []
+        pattern = re.compile(
+            re.escape(_unqualified(table_name)) + r'_p([\d_]+)$'
+        )
+        oldest = _step(_start(today, self.interval), self.interval,
+                       -self.retain)
+        expired = []
+        for name in existing:
+            match = pattern.match(name)
+            if match is None:
+                continue
+            try:
+                start = datetime.strptime(
+                    match.group(1), _formats[self.interval]
+                ).date()
+            except ValueError:
+                continue
+            if start < oldest:
+                expired.append(name)
+        return sorted(expired)
+
+
+class ListPartitioning(Partitioning):
+    """
+    Partition a table by the value of a column.
+
+    :param values: A mapping of the suffix of each partition's name to the
+      sequence of values that partition contains.
+
+    :param default: If `True`, a default partition is created to contain
+      rows with any other value.
+    """
+
+    method = 'LIST'
+
+    def __init__(self, column, values, default=False):
+        super(ListPartitioning, self).__init__(column)
+        self.values = values
+        self.default = default
+
+    def partitions(self, dialect, table_name, today):
+        partitions = [
+            ('%s_%s' % (table_name, suffix),
+             'FOR VALUES IN (%s)' % ', '.join(
+                 _literal(dialect, value) for value in values
+             ))
+            for suffix, values in sorted(self.values.items())
+        ]
+        if self.default:
+            partitions.append((table_name + '_default', 'DEFAULT'))
+        return partitions
+
+
+class HashPartitioning(Partitioning):
+    """
+    Partition a table into `modulus` partitions by the hash of a column.
+    """
+
+    method = 'HASH'
+
+    def __init__(self, column, modulus):
+        super(HashPartitioning, self).__init__(column)
+        self.modulus = modulus
+
+    def partitions(self, dialect, table_name, today):
+        return [
+            ('%s_p%i' % (table_name, remainder),
+             'FOR VALUES WITH (MODULUS %i, REMAINDER %i)' % (
+                 self.modulus, remainder
+             ))
+            for remainder in range(self.modulus)
+        ]
+
+
+def existing_partitions(connection, table_name):
+    """
+    Return the set of names, without any schema, of the partitions the
+    named table currently has in the database.
+    """
+    from sqlalchemy import text
+    return set(connection.execute(text(
+        "select c.relname from pg_inherits i "
+        "join pg_class c on c.oid = i.inhrelid "
+        "where i.inhparent = cast(:name as regclass)"
+    ), dict(name=table_name)).scalars())
+
+
+def plan_partitions(dialect, table_name, partitioning, existing, today,
+                    expire=True):
+    """
+    Return a list of ``(action, table_name, partition_name, statement)``
+    tuples describing the statements needed to bring the partitions of
+    the named table up to date, given the names of its `existing`
+    partitions. `action` is one of ``'create'``, ``'detach'`` or
+    ``'drop'``.
+    """
+    from .maintenance import quote_table
+    table = quote_table(dialect, table_name)
+    plan = []
+    for name, bound in partitioning.partitions(dialect, table_name, today):
+        if _unqualified(name) not in existing:
+            plan.append(('create', table_name, name,
+                         'CREATE TABLE %s PARTITION OF %s %s' % (
+                             quote_table(dialect, name), table, bound
+                         )))
+    if expire:
+        for name in partitioning.expired(table_name, existing, today):
+            name = _qualified(table_name, name)
+            if partitioning.detach:
+                plan.append(('detach', table_name, name,
+                             'ALTER TABLE %s DETACH PARTITION %s' % (
+                                 table, quote_table(dialect, name)
+                             )))
+            else:
+                plan.append(('drop', table_name, name,
+                             'DROP TABLE %s' % quote_table(dialect, name)))
+    return plan
+
+
+def maintain_partitions(connection, config, today=None, expire=True):
+    """
+    Create any missing partitions of the partitioned tables in the
+    supplied :class:`~mortar_rdb.controlled.Config` and, if `expire` is
+    `True`, remove those that have passed their retention period, using
+    the supplied connection.
+
+    The list of ``(action, table_name, partition_name, statement)``
+    tuples executed is returned, as described in :func:`plan_partitions`.
+    Only PostgreSQL is supported.
+    """
+    dialect = connection.dialect
+    if dialect.name != 'postgresql':
+        raise ValueError('Partitioning is not supported for %s databases' % (
+            dialect.name
+        ))
+    if today is None:
+        today = date.today()
+    executed = []
+    for table_name, partitioning in sorted(config.partitioning.items()):
+        existing = existing_partitions(connection, table_name)
+        for step in plan_partitions(dialect, table_name, partitioning,
+                                    existing, today, expire):
+            connection.exec_driver_sql(step[-1])
+            executed.append(step)
+    return executed
@@ -0,0 +1,237 @@
+"""
+Tools for recording the query plans of the statements executed by
+sessions registered with :func:`~mortar_rdb.register_session` and for
+checking them against a baseline stored from a previous run.
+
+This is intended to be used by a test suite so that a change to the
+models, indexes or queries that stops a statement using an index is
+noticed before the code reaches a production database:
+
+.. code-block:: python
+
+  from mortar_rdb.plans import PlanRecorder
+  from sample.model import config
+
+  recorder = PlanRecorder('plans.json', config)
+
+  # after a session is registered in each test:
+  recorder.watch()
+
+  # once the test run is complete:
+  recorder.check()
+  recorder.save()
+
+Plans are captured using ``EXPLAIN QUERY PLAN`` on SQLite and ``EXPLAIN``
+on other databases, using the connection that executed the statement so
+that tables and rows not yet committed are visible. These statements are
+executed with the ``mortar_rdb_explain`` execution option, so they are
+not recorded themselves and are not counted by
+:func:`~mortar_rdb.testing.assert_max_queries` or
+:func:`~mortar_rdb.testing.assert_max_time`. Sequential scans and index use are detected for
+SQLite and PostgreSQL; for other databases the plans are recorded but
+not checked.
+"""
+
+import json
+import os
+import re
+from weakref import WeakSet
+
+_cost = re.compile(r'\s+\((?:cost|actual)=[^)]*\)')
+_whitespace = re.compile(r'\s+')
+
+_sqlite_scan = re.compile(r'^SCAN (?:TABLE )?(\S+)(?: AS \S+)?$')
+_sqlite_index = re.compile(
+    r'^(?:SCAN|SEARCH) (?:TABLE )?(\S+)(?: AS \S+)? '
+    r'USING (?:COVERING )?(INDEX \S+|INTEGER PRIMARY KEY|PRIMARY KEY)'
+)
+_postgres_scan = re.compile(r'Seq Scan on (\S+)')
+_postgres_index = re.compile(r'Index (?:Only )?Scan using (\S+) on (\S+)')
+# the table for a bitmap index scan is on the Bitmap Heap Scan line:
+_postgres_bitmap = re.compile(r'Bitmap Index Scan on (\S+)')
+
+
+def _normalize(statement):
+    return _whitespace.sub(' ', statement).strip()
+
+
+def _explain_prefix(dialect):
+    if dialect.name == 'sqlite':
+        return 'EXPLAIN QUERY PLAN '
+    return 'EXPLAIN '
+
+
+def _explaining(context):
+    # True if the statement is one executed by PlanRecorder to capture a
+    # plan.
+    return context is not None and context.execution_options.get(
+        'mortar_rdb_explain', False
+    )
+
+
+def _plan_lines(dialect, rows):
+    # Turn the rows returned by EXPLAIN into a list of strings that don't
+    # change from one run to the next.
+    if dialect.name == 'sqlite':
+        # (id, parent, notused, detail), where the ids vary
+        return [row[-1] for row in rows]
+    lines = []
+    for row in rows:
+        line = ' '.join(str(value) for value in row)
+        lines.append(_cost.sub('', line.replace('->', '')).strip())
+    return lines
+
+
+def scans(dialect_name, plan):
+    """
+    Return the set of names of the tables, or their aliases, that are
+    scanned sequentially according to the supplied plan.
+    """
+    found = set()
+    for line in plan:
+        if dialect_name == 'sqlite':
+            match = _sqlite_scan.match(line)
+            if match:
+                found.add(match.group(1))
+        elif dialect_name == 'postgresql':
+            found.update(_postgres_scan.findall(line))
+    return found
+
+
+def indexes(dialect_name, plan):
+    """
+    Return the set of ``(table, index)`` tuples for the indexes used
+    according to the supplied plan. The table will be `None` where the
+    plan does not say which table the index is on.
+    """
+    found = set()
+    for line in plan:
+        if dialect_name == 'sqlite':
+            match = _sqlite_index.match(line)
+            if match:
+                found.add(match.groups())
+        elif dialect_name == 'postgresql':
+            for index, table in _postgres_index.findall(line):
+                found.add((table, index))
+            for index in _postgres_bitmap.findall(line):
+                found.add((None, index))
+    return found
+
+
+class PlanRecorder(object):
+    """
+    Records the plan of each distinct statement executed using the
+    sessions it is asked to :meth:`watch` and compares them with those
+    stored in a baseline file.
+
+    :param path:
+      The path of the JSON file in which the baseline is stored.
+
+    :param config:
+      An optional :class:`~mortar_rdb.controlled.Config`. If supplied,
+      only statements that refer to at least one of its tables will be
+      recorded.
+    """
+
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = config
+        if os.path.exists(path):
+            with open(path) as source:
+                self.baseline = json.load(source)
+        else:
+            self.baseline = {}
+        #: A dictionary mapping each statement recorded to a dictionary
+        #: containing the name of the dialect and the plan.
+        self.plans = {}
+        self._watched = WeakSet()
+        self._tables = None
+        if config is not None and not config.tables:
+            # a pattern that never matches, so nothing is recorded
+            self._tables = re.compile(r'(?!)')
+        elif config is not None:
+            self._tables = re.compile(r'\b(%s)\b' % '|'.join(
+                re.escape(name) for name in sorted(config.tables)
+            ), re.IGNORECASE)
+
+    def watch(self, name=u''):
+        """
+        Start recording the plans of statements executed by the engines
+        of the session registered with the supplied `name`.
+        """
+        from sqlalchemy import event
+        from .testing import _session_engines
+        for engine in _session_engines(name):
+            if engine not in self._watched:
+                self._watched.add(engine)
+                event.listen(engine, 'after_cursor_execute', self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if _explaining(context):
+            return
+        key = _normalize(statement)
+        if key in self.plans or not key.upper().startswith((
+            'SELECT', 'UPDATE', 'DELETE', 'WITH'
+        )):
+            return
+        if self._tables is not None and not self._tables.search(key):
+            return
+        dialect = conn.dialect
+        if executemany:
+            parameters = parameters[0]
+        rows = conn.exec_driver_sql(
+            _explain_prefix(dialect) + statement, parameters,
+            execution_options=dict(mortar_rdb_explain=True)
+        ).fetchall()
+        self.plans[key] = dict(dialect=dialect.name,
+                               plan=_plan_lines(dialect, rows))
+
+    def problems(self):
+        """
+        Return a list of descriptions of statements recorded that now
+        scan tables sequentially, or no longer use indexes, when compared
+        with the baseline. Statements not in the baseline are ignored.
+        """
+        problems = []
+        for statement, current in sorted(self.plans.items()):
+            previous = self.baseline.get(statement)
+            if previous is None or previous['dialect'] != current['dialect']:
+                continue
+            dialect_name = current['dialect']
+            new_scans = (scans(dialect_name, current['plan']) -
+                         scans(dialect_name, previous['plan']))
+            for table in sorted(new_scans):
+                problems.append('New sequential scan of %s:\n%s' % (
+                    table, statement
+                ))
+            lost = (indexes(dialect_name, previous['plan']) -
+                    indexes(dialect_name, current['plan']))
+            for table, index in sorted(lost, key=str):
+                if table is not None:
+                    index = '%s on %s' % (index, table)
+                problems.append('%s no longer used:\n%s' % (
+                    index, statement
+                ))
+        return problems
+
+    def check(self):
+        """
+        Raise an :class:`AssertionError` describing any
+        :meth:`problems`.
+        """
+        problems = self.problems()
+        if problems:
+            raise AssertionError('\n\n'.join(problems))
+
+    def save(self):
+        """
+        Update the baseline with the plans recorded and write it to the
+        baseline file.
+        """
+        self.baseline.update(self.plans)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, 'w') as target:
+            json.dump(self.baseline, target, indent=2, sort_keys=True)
@@ -0,0 +1,173 @@
+"""
+Delete, and optionally archive, the rows of a large table that match a
+condition without holding locks on the table for long or flooding
+replicas with changes.
+
+Rows are processed in batches ordered by primary key, with each batch
+in its own transaction. Only the primary key is used to find where the
+next batch starts, so each batch costs the same no matter how much of
+the table has already been purged. An optional pause between batches
+and a limit on replica lag give other work a chance to keep up:
+
+.. code-block:: python
+
+  from mortar_rdb.purge import purge
+
+  purge(engine, config.metadata.tables['event'],
+        "created < '2020-01-01'", batch_size=500, pause=0.5, max_lag=5)
+
+A purge that is interrupted can be resumed by passing the last key
+reported to the `batch` callable as the `after` parameter. Keys can be
+stored as JSON between runs using :func:`dump_key` and :func:`load_key`.
+"""
+
+from datetime import date, datetime, time
+from decimal import Decimal
+from time import perf_counter, sleep
+from uuid import UUID
+
+# type -> (tag, function to turn a value into a string, function to turn
+# the string back into a value), for key values JSON can't represent
+_key_types = (
+    (datetime, 'datetime', datetime.isoformat, datetime.fromisoformat),
+    (date, 'date', date.isoformat, date.fromisoformat),
+    (time, 'time', time.isoformat, time.fromisoformat),
+    (UUID, 'uuid', str, UUID),
+    (Decimal, 'decimal', str, Decimal),
+    (bytes, 'bytes', bytes.hex, bytes.fromhex),
+)
+
+
+def dump_key(key):
+    """
+    Return a list that can be serialized as JSON for the supplied tuple
+    of primary key values, such as one passed to the `batch` callable of
+    :func:`purge`. Dates, times, UUIDs, decimals and bytes are supported
+    in addition to the types JSON supports.
+    """
+    values = []
+    for value in key:
+        for type_, tag, dump, load in _key_types:
+            if isinstance(value, type_):
+                value = {tag: dump(value)}
+                break
+        else:
+            if not (value is None or
+                    isinstance(value, (str, int, float))):
+                raise TypeError('Cannot store key value %r' % (value,))
+        values.append(value)
+    return values
+
+
+def load_key(values):
+    """
+    Return the tuple of primary key values for a list returned by
+    :func:`dump_key`.
+    """
+    loads = {tag: load for type_, tag, dump, load in _key_types}
+    key = []
+    for value in values:
+        if isinstance(value, dict):
+            (tag, text), = value.items()
+            value = loads[tag](text)
+        key.append(value)
+    return tuple(key)
+
+
+def replica_lag(connection):
+    """
+    Return the number of seconds that the most lagged replica of the
+    database attached to by the supplied connection is behind it. Only
+    PostgreSQL is supported and the connection must be to the primary.
+    """
+    from sqlalchemy import text
+    if connection.dialect.name != 'postgresql':
+        raise ValueError('Replica lag is not supported for %s databases' % (
+            connection.dialect.name
+        ))
+    return float(connection.execute(text(
+        "select coalesce(extract(epoch from max(replay_lag)), 0) "
+        "from pg_stat_replication"
+    )).scalar())
+
+
+def purge(engine, table, where, batch_size=1000, pause=0, archive=None,
+          max_lag=None, lag=replica_lag, after=None, batch=None):
+    """
+    Delete the rows of the supplied :class:`~sqlalchemy.schema.Table`
+    that match `where` in batches, returning the number of rows deleted.
+
+    :param where: The condition rows must match, either as SQL text or
+      as an SQLAlchemy expression.
+
+    :param batch_size: The maximum number of rows in each batch.
+
+    :param pause: The number of seconds to sleep between batches.
+
+    :param archive: An optional :class:`~sqlalchemy.schema.Table`, with
+      columns of the same names as `table`, to which rows are copied in
+      the same transaction that deletes them.
+
+    :param max_lag: If supplied, before each batch, wait until `lag`
+      returns no more than this number of seconds.
+
+    :param lag: A callable that takes a connection and returns the lag
+      of the database's replicas in seconds.
+
+    :param after: A tuple of primary key values. Only rows with a
+      primary key greater than this are purged.
+
+    :param batch: An optional callable that is called after each batch
+      with the number of rows deleted, the primary key of the last row
+      in the batch, as a tuple, and the number of seconds the batch took.
+    """
+    from sqlalchemy import and_, select, text, tuple_
+    if isinstance(where, str):
+        where = text(where)
+    key = list(table.primary_key.columns)
+    if not key:
+        raise ValueError('%s has no primary key' % table.name)
+    if len(key) == 1:
+        key_expression = key[0]
+        values = lambda rows: [row[0] for row in rows]
+        bound = lambda row: row[0]
+    else:
+        key_expression = tuple_(*key)
+        values = lambda rows: [tuple(row) for row in rows]
+        bound = lambda row: tuple_(*row)
+    total = 0
+    while True:
+        if max_lag is not None:
+            while True:
+                with engine.connect() as connection:
+                    if lag(connection) <= max_lag:
+                        break
+                sleep(max(pause, 1))
+        start = perf_counter()
+        with engine.begin() as connection:
+            query = select(*key).where(where).order_by(*key).limit(batch_size)
+            if after is not None:
+                query = query.where(key_expression > bound(after))
+            rows = connection.execute(query).all()
+            if not rows:
+                break
+            # check the condition again in case a row changed since the
+            # keys were selected:
+            condition = and_(where, key_expression.in_(values(rows)))
+            if archive is not None:
+                connection.execute(archive.insert().from_select(
+                    [archive.c[column.name] for column in table.c],
+                    select(*table.c).where(condition)
+                ))
+            count = connection.execute(
+                table.delete().where(condition)
+            ).rowcount
+        total += count
+        after = tuple(rows[-1])
+        if batch is not None:
+            batch(count, after, perf_counter()-start)
+        if len(rows) < batch_size:
+            break
+        if pause:
+            sleep(pause)
+    return total
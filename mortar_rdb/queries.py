@@ -0,0 +1,73 @@
+"""
+A registry of frequently executed statements that are compiled into
+each engine's statement cache when a session is registered.
+
+:mod:`SQLAlchemy` caches the compiled form of each statement it
+executes, but the first execution of each statement on each engine
+still pays for compiling it. Statements are declared at module level,
+alongside the models built with :func:`~mortar_rdb.declarative_base`
+that they use, and all declared statements are compiled for each
+engine used by a session when that session is registered with
+:func:`~mortar_rdb.register_session`. This means the first request to
+use a statement does not pay for compiling it.
+"""
+
+from sqlalchemy.sql import compiler, visitors
+
+_queries = []
+
+
+def hot_query(statement):
+    """
+    Declare a statement that will be compiled up front whenever a session
+    is registered. The statement is returned unchanged and should be
+    executed as normal, for example with
+    :meth:`~sqlalchemy.orm.Session.execute`.
+
+    Values that vary between executions must be supplied using
+    :func:`~sqlalchemy.sql.expression.bindparam` and passed as parameters
+    when the statement is executed. Literal values can also be used as
+    they do not affect the caching of the compiled statement.
+    """
+    _queries.append(statement)
+    return statement
+
+
+def _parameter_names(statement):
+    # The names of the parameters that must be supplied when executing
+    # the statement, these form part of the compiled cache key.
+    names = set()
+
+    def visit_bindparam(bindparam):
+        if bindparam.required:
+            names.add(bindparam.key)
+
+    visitors.traverse(statement, {}, {'bindparam': visit_bindparam})
+    return sorted(names)
+
+
+def warm(engines):
+    """
+    Compile each statement declared with :func:`hot_query` into the
+    statement cache of each of the supplied engines. This is done by
+    :func:`~mortar_rdb.register_session` and so rarely needs to be
+    called directly.
+    """
+    for statement in list(_queries):
+        keys = _parameter_names(statement)
+        for engine in engines:
+            if engine._compiled_cache is None:
+                # caching has been disabled for this engine
+                continue
+            # This mirrors what Connection does when executing a statement.
+            statement._compile_w_cache(
+                dialect=engine.dialect,
+                compiled_cache=engine._compiled_cache,
+                column_keys=keys,
+                for_executemany=False,
+                schema_translate_map=engine._execution_options.get(
+                    'schema_translate_map'
+                ),
+                linting=engine.dialect.compiler_linting |
+                        compiler.WARN_LINTING,
+            )
@@ -0,0 +1,278 @@
+"""
+Helpers for controlling the scope of sessions registered with
+:func:`~mortar_rdb.register_session`.
+
+By default, scoped sessions are thread-local. Where a thread may serve
+more than one logical request, such as under :mod:`asyncio`,
+:mod:`gevent` or a thread pool that re-uses its threads, a
+:class:`ContextScope` can be passed as the `scopefunc` to
+:func:`~mortar_rdb.register_session` so that a new session is used for
+each request and that session is disposed of when the request ends.
+
+Regardless of how sessions are scoped, :func:`request_scope` and
+:class:`SessionMiddleware` can be used to make sure that all sessions
+obtained with :func:`~mortar_rdb.get_session` during a request are
+closed, and their connections returned to the pool, when that request
+ends.
+"""
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+
+from zope.component import getSiteManager
+
+from . import _current_request
+from .interfaces import ISession
+
+logger = getLogger('mortar_rdb')
+
+
+class ContextScope:
+    """
+    A scope function for use with :func:`~mortar_rdb.register_session`
+    that is based on a :class:`~contextvars.ContextVar` rather than the
+    current thread.
+
+    A scope must be explicitly begun before a session can be obtained
+    with :func:`~mortar_rdb.get_session` and must be ended once the
+    request is complete, at which point all sessions obtained within
+    that scope will be removed.
+
+    :param name: The name used for the underlying
+      :class:`~contextvars.ContextVar`.
+    """
+
+    def __init__(self, name='mortar_rdb_scope'):
+        self._current = ContextVar(name)
+        #: A list of callables that will be called, with no parameters,
+        #: whenever a scope ends. These are called after the sessions
+        #: for the scope have been removed.
+        self.on_end = []
+
+    def __call__(self):
+        try:
+            return self._current.get()
+        except LookupError:
+            raise RuntimeError('No session scope is active')
+
+    def begin(self):
+        """
+        Begin a new scope in the current context, returning a token
+        that must be passed to :meth:`end`.
+        """
+        return self._current.set(object())
+
+    def _factories(self):
+        for name, Session in getSiteManager().getUtilitiesFor(ISession):
+            factories = getattr(Session, 'factories', None)
+            if factories is None:
+                yield Session
+            else:
+                # one registration may provide many session factories,
+                # see mortar_rdb.tenants.TenantSessions
+                yield from factories()
+
+    def end(self, token):
+        """
+        End the scope represented by the supplied token, as returned by
+        :meth:`begin`. Any sessions obtained within that scope from a
+        session registered with this scope function will be removed
+        and any :attr:`on_end` hooks will be called.
+        """
+        try:
+            for Session in self._factories():
+                registry = getattr(Session, 'registry', None)
+                if getattr(registry, 'scopefunc', None) is not self:
+                    continue
+                if registry.has():
+                    Session.remove()
+            for hook in self.on_end:
+                hook()
+        finally:
+            self._current.reset(token)
+
+    @contextmanager
+    def scope(self):
+        """
+        A context manager that begins a scope on entry and ends it on
+        exit.
+        """
+        token = self.begin()
+        try:
+            yield
+        finally:
+            self.end(token)
+
+
+class RequestSessions:
+    """
+    The sessions obtained and connections used during a request, as
+    yielded by :func:`request_scope`.
+    """
+
+    def __init__(self):
+        #: A list of ``(factory, session)`` tuples for the sessions
+        #: obtained with :func:`~mortar_rdb.get_session`.
+        self.sessions = []
+        #: The number of connections checked out and returned to a pool.
+        self.connections = 0
+        #: The total time, in seconds, for which those connections were
+        #: checked out.
+        self.connection_time = 0.0
+        #: The number of connections currently checked out.
+        self.checked_out = 0
+
+    def add(self, factory, session):
+        for existing_factory, existing in self.sessions:
+            if existing is session:
+                return
+        self.sessions.append((factory, session))
+
+    def close(self):
+        """
+        Close all the sessions obtained during the request. Sessions from
+        a scoped session factory are removed from that factory.
+        """
+        for factory, session in self.sessions:
+            remove = getattr(factory, 'remove', None)
+            if remove is None:
+                session.close()
+            else:
+                remove()
+        self.sessions = []
+
+
+_listening = False
+_listening_lock = Lock()
+
+
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    request = _current_request.get()
+    if request is not None:
+        request.checked_out += 1
+        connection_record.info['mortar_rdb_request'] = (request, perf_counter())
+
+
+def _checkin(dbapi_connection, connection_record):
+    checkout = connection_record.info.pop('mortar_rdb_request', None)
+    if checkout is not None:
+        request, start = checkout
+        request.checked_out -= 1
+        request.connections += 1
+        request.connection_time += perf_counter() - start
+
+
+def _listen():
+    # Listen to all pools, once, for timing connections used during
+    # requests.
+    global _listening
+    with _listening_lock:
+        if not _listening:
+            from sqlalchemy import event
+            from sqlalchemy.pool import Pool
+            event.listen(Pool, 'checkout', _checkout)
+            event.listen(Pool, 'checkin', _checkin)
+            _listening = True
+
+
+@contextmanager
+def request_scope(scope=None):
+    """
+    A context manager, that can also be used as a decorator, within which
+    all sessions obtained with :func:`~mortar_rdb.get_session` will be
+    tracked so that they can be closed when the context manager exits,
+    whether or not a :mod:`transaction` was used.
+
+    A :class:`RequestSessions` is returned that records the time for which
+    database connections were checked out during the request.
+
+    :param scope: If supplied, a :class:`ContextScope` that will have a
+      scope begun and ended along with the request.
+    """
+    _listen()
+    request = RequestSessions()
+    token = _current_request.set(request)
+    scope_token = None if scope is None else scope.begin()
+    try:
+        yield request
+    finally:
+        try:
+            request.close()
+            if scope_token is not None:
+                scope.end(scope_token)
+        finally:
+            _current_request.reset(token)
+        logger.debug('Request used %i connections for %.3fs',
+                     request.connections, request.connection_time)
+        if request.checked_out:
+            logger.warning(
+                '%i connections still checked out at the end of the request',
+                request.checked_out
+            )
+
+
+class SessionMiddleware:
+    """
+    WSGI middleware that wraps each request in a :func:`request_scope`.
+    The scope ends once the response has been completely sent and closed.
+
+    The :class:`RequestSessions` for the current request is available in
+    the WSGI environment as ``mortar_rdb.request``.
+
+    :param scope: Passed to :func:`request_scope`.
+
+    :param warn_after: If supplied, a warning will be logged for any
+      request that holds database connections for longer than this number
+      of seconds.
+    """
+
+    def __init__(self, app, scope=None, warn_after=None):
+        self.app = app
+        self.scope = scope
+        self.warn_after = warn_after
+
+    def __call__(self, environ, start_response):
+        context = request_scope(self.scope)
+        request = environ['mortar_rdb.request'] = context.__enter__()
+        try:
+            response = self.app(environ, start_response)
+        except:
+            self._end(environ, request, context)
+            raise
+        return _ClosingResponse(response, self, environ, request, context)
+
+    def _end(self, environ, request, context):
+        try:
+            context.__exit__(None, None, None)
+        finally:
+            if (self.warn_after is not None and
+                    request.connection_time > self.warn_after):
+                logger.warning(
+                    '%s %s held %i connections for %.3fs',
+                    environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'),
+                    request.connections, request.connection_time
+                )
+
+
+class _ClosingResponse:
+
+    def __init__(self, response, middleware, environ, request, context):
+        self.response = response
+        self.middleware = middleware
+        self.environ = environ
+        self.request = request
+        self.context = context
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def close(self):
+        try:
+            close = getattr(self.response, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.middleware._end(self.environ, self.request, self.context)
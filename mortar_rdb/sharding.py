@@ -0,0 +1,214 @@
+"""
+Support for horizontal sharding of sessions registered with
+:func:`~mortar_rdb.register_session`, built on
+:mod:`sqlalchemy.ext.horizontal_shard`.
+
+Statements that span more than one shard are executed concurrently, one
+thread per shard, with the results merged in the order the shards were
+returned by the `execute_chooser`.
+
+.. note::
+
+  Connections are checked out in the calling thread but used from a
+  worker thread. Where a shard is an SQLite database, the engine must be
+  created with ``connect_args={'check_same_thread': False}``. This is
+  done for you when a url is passed for a shard.
+
+.. note::
+
+  Executing statements concurrently relies on parts of the ORM's
+  execution machinery that are not public. Should those change in a
+  future release of :mod:`SQLAlchemy`, a warning is logged and statements
+  are executed against each shard in turn instead.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.ext.horizontal_shard import (
+    ShardedSession as BaseShardedSession, set_shard_id
+)
+
+
+logger = getLogger('mortar_rdb')
+
+_executor = None
+_executor_workers = 0
+_executor_lock = Lock()
+_warned = []
+
+
+def shard_executor(workers):
+    """
+    Return the :class:`~concurrent.futures.ThreadPoolExecutor` shared by
+    all sharded sessions, ensuring it has at least the supplied number of
+    workers. A larger executor replaces a smaller one, whose threads exit
+    once the sessions using it are finished with it.
+    """
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor_workers < workers:
+            _executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='mortar_rdb_shards'
+            )
+            _executor_workers = workers
+        return _executor
+
+
+def _internals(orm_context):
+    # Look up the private parts of the ORM relied on by _shard_id and
+    # _plan, so that an AttributeError here, and only here, means they
+    # have changed.
+    compile_state_cls = orm_context._compile_state_cls
+    if compile_state_cls is not None:
+        for name in 'orm_pre_session_exec', 'orm_setup_cursor_result':
+            getattr(compile_state_cls, name)
+    if orm_context.is_select:
+        options = orm_context.load_options
+    elif orm_context.is_update or orm_context.is_delete:
+        options = orm_context.update_delete_options
+    else:
+        options = None
+    identity_token = None if options is None else options._identity_token
+    return (compile_state_cls, orm_context._non_compile_orm_options,
+            identity_token)
+
+
+def _shard_id(orm_context, non_compile_options, identity_token):
+    # The single shard an execution has been limited to, if any, as
+    # determined by sqlalchemy.ext.horizontal_shard.
+    for option in non_compile_options:
+        if isinstance(option, set_shard_id):
+            return option.shard_id
+    if identity_token is not None:
+        return identity_token
+    if '_sa_shard_id' in orm_context.execution_options:
+        return orm_context.execution_options['_sa_shard_id']
+    return orm_context.bind_arguments.get('shard_id')
+
+
+def _plan(orm_context, compile_state_cls, shard_ids):
+    # The session is not thread safe, so everything other than executing
+    # the statement on each shard's connection is done in this thread,
+    # mirroring what Session.execute does for a single shard.
+    session = orm_context.session
+    params = orm_context.parameters or {}
+    executions = []
+    for shard_id in shard_ids:
+        bind_arguments = dict(orm_context.bind_arguments, shard_id=shard_id)
+        statement, execution_options = compile_state_cls.orm_pre_session_exec(
+            session,
+            orm_context.statement,
+            params,
+            orm_context.local_execution_options.union(
+                dict(identity_token=shard_id)
+            ),
+            bind_arguments,
+            False,
+        )
+        connection = session.connection(bind_arguments=bind_arguments)
+        executions.append(
+            (connection, statement, execution_options, bind_arguments)
+        )
+    return params, executions
+
+
+def _fall_back(error):
+    # the private parts of the ORM found by _internals have changed
+    if not _warned:
+        _warned.append(True)
+        logger.warning(
+            'Executing statements on shards in turn as concurrent '
+            'execution is not supported by this version of SQLAlchemy: %s',
+            error
+        )
+
+
+def _execute_concurrently(orm_context):
+    session = orm_context.session
+    try:
+        compile_state_cls, non_compile_options, identity_token = (
+            _internals(orm_context)
+        )
+    except AttributeError as e:
+        return _fall_back(e)
+    if compile_state_cls is None:
+        # not an ORM statement, such as text(), so leave it to the
+        # base class
+        return
+    if _shard_id(orm_context, non_compile_options,
+                 identity_token) is not None:
+        return
+    shard_ids = list(session.execute_chooser(orm_context))
+    if len(shard_ids) < 2:
+        return
+    params, executions = _plan(orm_context, compile_state_cls, shard_ids)
+
+    def execute(execution):
+        connection, statement, execution_options, bind_arguments = execution
+        return connection.execute(statement, params,
+                                  execution_options=execution_options)
+
+    results = [
+        compile_state_cls.orm_setup_cursor_result(
+            session, statement, params, execution_options, bind_arguments,
+            result
+        )
+        for (connection, statement, execution_options, bind_arguments), result
+        in zip(executions, session.executor(len(executions)).map(
+            execute, executions
+        ))
+    ]
+    if orm_context.is_select:
+        # Buffer the rows from each shard, much as a single query does,
+        # so that objects from one shard cannot be garbage collected
+        # and confuse the uniquing of objects from later shards.
+        results = [result.freeze()() for result in results]
+    return results[0].merge(*results[1:])
+
+
+class ShardedSession(BaseShardedSession):
+    """
+    The :class:`~sqlalchemy.orm.session.Session` class used when
+    :func:`~mortar_rdb.register_session` is passed `shards`.
+
+    :param executor: The :class:`~concurrent.futures.Executor` used to
+      execute statements that span more than one shard. Defaults to the
+      one returned by :func:`shard_executor`.
+    """
+
+    def __init__(self, executor=None, **kw):
+        super().__init__(**kw)
+        self._executor = executor
+
+    def executor(self, workers):
+        """
+        Return the executor to use for a statement spanning the supplied
+        number of shards.
+        """
+        if self._executor is not None:
+            return self._executor
+        return shard_executor(workers)
+
+
+# this must run before the handler each instance gets from the base class:
+event.listen(ShardedSession, 'do_orm_execute', _execute_concurrently,
+             retval=True, insert=True)
+
+
+def all_shards(shards):
+    """
+    Return an `identity_chooser` and an `execute_chooser` that both return
+    all of the supplied shard ids.
+    """
+    shard_ids = list(shards)
+
+    def identity_chooser(mapper, primary_key, **kw):
+        return shard_ids
+
+    def execute_chooser(orm_context):
+        return shard_ids
+
+    return identity_chooser, execute_chooser
@@ -0,0 +1,155 @@
+"""
+Helpers for gathering statistics about the tables in a database, using
+the database's own catalog where it keeps estimates so that large tables
+do not need to be scanned.
+"""
+
+
+def row_estimates(connection, names):
+    """
+    Return a dictionary mapping each of the supplied table names to an
+    estimate of the number of rows in that table.
+
+    PostgreSQL and MySQL estimates come from their catalogs. For other
+    databases, the rows are counted.
+    """
+    from sqlalchemy import bindparam, text
+    names = list(names)
+    if not names:
+        return {}
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        rows = connection.execute(text(
+            "select c.relname, c.reltuples from pg_class c "
+            "join pg_namespace n on n.oid = c.relnamespace "
+            "where n.nspname = any(current_schemas(false)) "
+            "and c.relkind in ('r', 'p') and c.relname = any(:names)"
+        ), dict(names=names))
+    elif dialect == 'mysql':
+        rows = connection.execute(text(
+            "select table_name, table_rows from information_schema.tables "
+            "where table_schema = database() and table_name in :names"
+        ).bindparams(
+            bindparam('names', expanding=True)
+        ), dict(names=names))
+    else:
+        preparer = connection.dialect.identifier_preparer
+        rows = [
+            (name, connection.execute(text(
+                'select count(*) from ' + '.'.join(
+                    preparer.quote(part) for part in name.split('.')
+                )
+            )).scalar())
+            for name in names
+        ]
+    estimates = dict.fromkeys(names, 0)
+    for name, count in rows:
+        # PostgreSQL uses -1 for tables that have never been analyzed
+        estimates[name] = max(int(count or 0), 0)
+    return estimates
+
+
+def human_size(size):
+    """
+    Return the supplied number of bytes in a form suitable for people to
+    read, or ``-`` if it is `None`.
+    """
+    if size is None:
+        return '-'
+    for unit in 'B', 'kB', 'MB', 'GB':
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    if unit == 'B':
+        return '%i B' % size
+    return '%.1f %s' % (size, unit)
+
+
+def table_stats(connection, names):
+    """
+    Return a dictionary mapping each of the supplied table names to a
+    dictionary of statistics for that table, gathered with as few queries
+    as the database allows:
+
+    ``rows``
+      The estimated number of rows, as returned by :func:`row_estimates`.
+
+    ``table_bytes``
+      The space used by the table's rows.
+
+    ``index_bytes``
+      The space used by the table's indexes.
+
+    ``dead_rows``
+      On PostgreSQL, the number of dead rows not yet vacuumed.
+
+    ``free_bytes``
+      On MySQL, the space allocated to the table but not used.
+
+    Statistics that are not available for a database are `None`.
+    """
+    from sqlalchemy import bindparam, text
+    names = list(names)
+    stats = {name: dict(rows=0, table_bytes=None, index_bytes=None,
+                        dead_rows=None, free_bytes=None)
+             for name in names}
+    if not names:
+        return stats
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        rows = connection.execute(text(
+            "select c.relname, c.reltuples, pg_table_size(c.oid), "
+            "pg_indexes_size(c.oid), s.n_dead_tup "
+            "from pg_class c "
+            "join pg_namespace n on n.oid = c.relnamespace "
+            "left join pg_stat_user_tables s on s.relid = c.oid "
+            "where n.nspname = any(current_schemas(false)) "
+            "and c.relkind in ('r', 'p') and c.relname = any(:names)"
+        ), dict(names=names))
+        for name, count, table_bytes, index_bytes, dead_rows in rows:
+            stats[name].update(rows=max(int(count), 0),
+                               table_bytes=table_bytes,
+                               index_bytes=index_bytes,
+                               dead_rows=dead_rows)
+    elif dialect == 'mysql':
+        rows = connection.execute(text(
+            "select table_name, table_rows, data_length, index_length, "
+            "data_free from information_schema.tables "
+            "where table_schema = database() and table_name in :names"
+        ).bindparams(
+            bindparam('names', expanding=True)
+        ), dict(names=names))
+        for name, count, table_bytes, index_bytes, free_bytes in rows:
+            stats[name].update(rows=count or 0,
+                               table_bytes=table_bytes,
+                               index_bytes=index_bytes,
+                               free_bytes=free_bytes)
+    else:
+        for name, count in row_estimates(connection, names).items():
+            stats[name]['rows'] = count
+        if dialect == 'sqlite':
+            _sqlite_sizes(connection, stats)
+    return stats
+
+
+def _sqlite_sizes(connection, stats):
+    # Sizes come from the dbstat virtual table, which is not available in
+    # all builds of SQLite.
+    from sqlalchemy import exc, text
+    try:
+        rows = connection.execute(text(
+            "select m.tbl_name, m.type, sum(d.pgsize) from dbstat d "
+            "join sqlite_master m on m.name = d.name "
+            "group by m.tbl_name, m.type"
+        )).fetchall()
+    except exc.OperationalError:
+        return
+    for name, type, size in rows:
+        if name in stats:
+            stats[name]['index_bytes' if type == 'index'
+                        else 'table_bytes'] = size
+    for values in stats.values():
+        if values['table_bytes'] is not None and values['index_bytes'] is None:
+            values['index_bytes'] = 0
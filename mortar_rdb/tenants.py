@@ -0,0 +1,262 @@
+"""
+Support for applications where each tenant's data is held in its own
+database or its own schema within a database.
+
+Rather than registering a session for every tenant, a single
+registration can be made with :func:`register_tenant_session` and the
+session for a particular tenant obtained with
+:func:`~mortar_rdb.get_session`::
+
+  register_tenant_session('postgresql://localhost/app',
+                          schema='tenant_{tenant}')
+  session = get_session(tenant='acme')
+
+An engine, and so a connection pool, is only created for a tenant when
+a session for that tenant is first requested. Where tenants have their
+own schemas in the same database, they share one engine and the schema
+is selected at the start of each transaction. The number of tenants
+kept open is bounded, with the least recently used idle tenants being
+closed when that bound is exceeded.
+"""
+
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from weakref import WeakSet
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
+from zope.component import getSiteManager
+
+from . import _check_scoping, _session_factory, _twophase
+from .engines import track
+from .interfaces import ISession
+
+logger = getLogger('mortar_rdb')
+
+
+def _idle(engine):
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout is None or not checkedout()
+
+
+def _schema_per_transaction(engine):
+    # Set the search_path at the start of each transaction to the schema
+    # of the tenant the connection is being used for. SET LOCAL means the
+    # setting ends with the transaction, so the pool can be shared.
+    # Two-phase transactions, which are used by default on PostgreSQL,
+    # have their own event.
+    preparer = engine.dialect.identifier_preparer
+
+    @event.listens_for(engine, 'begin_twophase')
+    def begin_twophase(connection, xid):
+        begin(connection)
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        schema = connection.get_execution_options().get('mortar_rdb_schema')
+        if schema is None:
+            return
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute('SET LOCAL search_path TO ' +
+                           preparer.quote_schema(schema))
+        finally:
+            cursor.close()
+
+
+def _live(sessions):
+    # a session is live while it has a transaction or objects loaded
+    for session in list(sessions):
+        if session.in_transaction() or len(session.identity_map):
+            return True
+    return False
+
+
+class TenantSessions:
+    """
+    The component registered by :func:`register_tenant_session`.
+    This maintains a bounded, least-recently-used collection of engines
+    and session factories keyed by tenant.
+    """
+
+    def __init__(self, url, schema, max_engines, engine_options,
+                 session_factory):
+        self.url = url
+        self.schema = schema
+        self.max_engines = max_engines
+        self.engine_options = engine_options
+        self.session_factory = session_factory
+        # tenant -> (url, engine, bind, Session, sessions)
+        self._tenants = OrderedDict()
+        # url -> engine, shared by tenants with schemas in one database
+        self._engines = {}
+        self._lock = Lock()
+
+    def __call__(self):
+        raise TypeError('A tenant must be specified for this session')
+
+    def _create(self, tenant):
+        url = self.url.format(tenant=tenant)
+        engine = self._engines.get(url)
+        if engine is None:
+            engine = self._engines[url] = create_engine(
+                url, **self.engine_options
+            )
+            if self.schema is not None:
+                _schema_per_transaction(engine)
+            track(engine)
+        bind = engine
+        if self.schema is not None:
+            bind = engine.execution_options(
+                mortar_rdb_schema=self.schema.format(tenant=tenant)
+            )
+        Session = self.session_factory(bind)
+        sessions = WeakSet()
+        event.listen(getattr(Session, 'session_factory', Session),
+                     'after_transaction_create',
+                     lambda session, transaction: sessions.add(session))
+        return url, engine, bind, Session, sessions
+
+    def _shared(self, tenant, url):
+        return any(other != tenant and entry[0] == url
+                   for other, entry in self._tenants.items())
+
+    def _evict(self):
+        # the most recently used tenant is never evicted:
+        for tenant, entry in list(self._tenants.items())[:-1]:
+            if len(self._tenants) <= self.max_engines:
+                return
+            url, engine, bind, Session, sessions = entry
+            if _live(sessions):
+                continue
+            shared = self._shared(tenant, url)
+            if not shared and not _idle(engine):
+                continue
+            logger.debug('Closing tenant %r', tenant)
+            del self._tenants[tenant]
+            if not shared:
+                del self._engines[url]
+                engine.dispose()
+        if len(self._tenants) > self.max_engines:
+            logger.warning(
+                '%i tenant engines are in use, more than the maximum of %i',
+                len(self._tenants), self.max_engines
+            )
+
+    def factory(self, tenant):
+        """
+        Return the session factory for the supplied tenant, creating it
+        if necessary.
+        """
+        with self._lock:
+            entry = self._tenants.get(tenant)
+            if entry is None:
+                entry = self._tenants[tenant] = self._create(tenant)
+                self._evict()
+            else:
+                self._tenants.move_to_end(tenant)
+            return entry[3]
+
+    def for_tenant(self, tenant):
+        """
+        Return a :class:`~sqlalchemy.orm.session.Session` for the
+        supplied tenant.
+        """
+        return self.factory(tenant)()
+
+    def factories(self):
+        """
+        Return a list of the session factories for the tenants that
+        currently have open engines.
+        """
+        with self._lock:
+            return [entry[3] for entry in self._tenants.values()]
+
+    def engines(self):
+        """
+        Return a mapping of tenant to the engine its sessions are bound to
+        for the tenants currently open, ordered from least to most
+        recently used.
+        """
+        with self._lock:
+            return OrderedDict(
+                (tenant, entry[2]) for tenant, entry in self._tenants.items()
+            )
+
+    def dispose(self):
+        """
+        Dispose of all the engines currently open.
+        """
+        with self._lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+            self._tenants.clear()
+
+
+def register_tenant_session(url,
+                            name=u'',
+                            echo=None,
+                            transactional=True,
+                            scoped=True,
+                            twophase=True,
+                            scopefunc=None,
+                            schema=None,
+                            max_engines=100,
+                            engine_options=None):
+    """
+    Register a session for use by many tenants, each of which has its own
+    database or schema. Sessions for a particular tenant can then be
+    obtained by passing the `tenant` parameter to
+    :func:`~mortar_rdb.get_session`.
+
+    The `name`, `echo`, `transactional`, `scoped`, `twophase` and
+    `scopefunc` parameters have the same meaning as for
+    :func:`~mortar_rdb.register_session`.
+
+    :param url: The :mod:`SQLAlchemy` url for the database. This may contain
+      a ``{tenant}`` placeholder which will be replaced with the tenant
+      when that tenant's engine is created.
+
+    :param schema: If specified, the PostgreSQL ``search_path`` will be set
+      to this schema at the start of each transaction. This may also
+      contain a ``{tenant}`` placeholder. Tenants whose urls are the same
+      share one engine and its connection pool.
+
+    :param max_engines: The maximum number of tenants to keep open. When
+      this is exceeded, the least recently used tenants that have no
+      sessions with a transaction or loaded objects will be closed, and
+      their engines disposed of when no other tenant uses them.
+
+    :param engine_options: A dictionary of additional keyword parameters to
+      pass to :func:`~sqlalchemy.create_engine` for each tenant's engine,
+      such as `pool_size`.
+    """
+    if '{tenant}' not in url and '{tenant}' not in (schema or ''):
+        raise ValueError(
+            'Either url or schema must contain a {tenant} placeholder'
+            )
+
+    _check_scoping(transactional, scoped, scopefunc)
+
+    engine_options = dict(engine_options or {})
+    if echo is not None:
+        engine_options['echo'] = echo
+
+    def session_factory(engine):
+        return _session_factory(
+            transactional, scoped, scopefunc,
+            bind=engine,
+            twophase=_twophase(transactional, twophase, engine),
+        )
+
+    logger.info('Registering tenant session for %r with name %r',
+                make_url(url), name)
+
+    getSiteManager().registerUtility(
+        TenantSessions(url, schema, max_engines, engine_options,
+                       session_factory),
+        provided=ISession,
+        name=name,
+        )
@@ -2,7 +2,14 @@
 Helpers for unit testing when using :mod:`mortar_rdb`
 """
 
+import json
 import os
+from contextlib import contextmanager
+from hashlib import sha1
+from itertools import groupby
+from time import perf_counter
+from traceback import extract_stack, format_list
+from weakref import WeakSet
 
 from . import (
     get_session, drop_tables,
@@ -13,6 +20,201 @@ from sqlalchemy.pool import StaticPool
 
 import mortar_rdb
 
+# schema fingerprint -> the statements to create that schema
+_ddl_cache = {}
+
+def _default(default):
+    # A stable description of a server default, computed column or
+    # identity, which may contain SQL text.
+    if default is None:
+        return None
+    parts = [type(default).__name__]
+    for name in ('arg', 'sqltext', 'persisted', 'for_update', 'always',
+                 'on_null', 'start', 'increment', 'minvalue', 'maxvalue',
+                 'cycle', 'cache', 'order'):
+        value = getattr(default, name, None)
+        if value is not None:
+            parts.append('%s=%s' % (name, _text(value)))
+    return parts
+
+def _text(value):
+    # SQL expressions are rendered with their bound values.
+    from sqlalchemy.sql import ClauseElement
+    if isinstance(value, ClauseElement):
+        try:
+            return str(value.compile(compile_kwargs=dict(literal_binds=True)))
+        except Exception:
+            pass
+    return str(value)
+
+def _options(item):
+    # Dialect specific options such as postgresql_partition_by or
+    # sqlite_where, whose values may be SQL expressions.
+    return sorted((key, _text(value))
+                  for key, value in item.dialect_kwargs.items())
+
+def _describe(item):
+    # A stable description of a constraint or index for _fingerprint.
+    parts = [type(item).__name__, str(item.name)]
+    parts.extend(str(expression) for expression in getattr(
+        item, 'expressions', item.columns
+    ))
+    for element in getattr(item, 'elements', ()):
+        parts.append(element.target_fullname)
+    for name in ('ondelete', 'onupdate', 'unique', 'sqltext', 'deferrable',
+                 'initially', 'match', 'use_alter'):
+        parts.append(_text(getattr(item, name, None)))
+    parts.append(_options(item))
+    return repr(parts)
+
+def _describe_column(column):
+    # A stable description of a column for _fingerprint. The repr of a
+    # column includes the address of any SQL text in its defaults.
+    return repr([
+        column.key, column.name, repr(column.type), column.nullable,
+        column.primary_key, str(column.autoincrement), column.comment,
+        _default(column.server_default), _default(column.server_onupdate),
+        _options(column),
+    ])
+
+def _fingerprint(metadata, dialect, tables=None):
+    # A hash of everything that affects the DDL to create the supplied
+    # tables, or all the tables in the metadata, using the dialect.
+    from sqlalchemy import __version__
+    from .controlled import _dialect_key
+    parts = [__version__, type(dialect).__module__, type(dialect).__name__,
+             repr(_dialect_key(dialect)[1:])]
+    if tables is None:
+        tables = metadata.tables.values()
+    for table in sorted(tables, key=lambda table: table.key):
+        parts.append(repr([table.name, table.schema, table.comment,
+                           _options(table)]))
+        parts.extend(_describe_column(column) for column in table.columns)
+        parts.extend(sorted(_describe(c) for c in table.constraints))
+        parts.extend(sorted(_describe(i) for i in table.indexes))
+    return sha1('\n'.join(parts).encode('utf-8')).hexdigest()
+
+def _create_statements(metadata, dialect, compile, tables=None):
+    # Return the statements to create the supplied tables, or all the
+    # tables in the metadata, only calling compile if they are not in the
+    # in-memory cache or in the directory named by DDL_CACHE.
+    key = _fingerprint(metadata, dialect, tables)
+    statements = _ddl_cache.get(key)
+    if statements is not None:
+        return statements
+    directory = os.environ.get('DDL_CACHE')
+    path = directory and os.path.join(directory, key+'.json')
+    if path and os.path.exists(path):
+        with open(path) as source:
+            statements = json.load(source)
+    else:
+        statements = compile()
+        if path:
+            os.makedirs(directory, exist_ok=True)
+            # write then rename so other processes never see part of a file
+            temp = '%s.%i' % (path, os.getpid())
+            with open(temp, 'w') as target:
+                json.dump(statements, target)
+            os.replace(temp, path)
+    _ddl_cache[key] = statements
+    return statements
+
+# (schema fingerprints, fixtures key) -> in-memory SQLite snapshot, with
+# the most recently used last
+_snapshots = {}
+# the maximum number of snapshots kept in _snapshots
+_snapshot_limit = 20
+
+def _snapshot_key(engine, config, metadata, fixtures):
+    dialect = engine.dialect
+    return (
+        None if config is None else _fingerprint(config.metadata, dialect),
+        None if metadata is None else _fingerprint(metadata, dialect),
+        getattr(fixtures, 'key', fixtures),
+    )
+
+def _cached_snapshot(key):
+    # Return the snapshot for the key, marking it as most recently used.
+    snapshot = _snapshots.pop(key, None)
+    if snapshot is not None:
+        _snapshots[key] = snapshot
+    return snapshot
+
+def _cache_snapshot(key, snapshot):
+    # Store a snapshot, closing the least recently used ones if there
+    # are too many.
+    _snapshots[key] = snapshot
+    while len(_snapshots) > _snapshot_limit:
+        _snapshots.pop(next(iter(_snapshots))).close()
+
+def _snapshot(engine):
+    # Copy the database into a new in-memory database.
+    import sqlite3
+    snapshot = sqlite3.connect(':memory:', check_same_thread=False)
+    connection = engine.raw_connection()
+    try:
+        connection.driver_connection.backup(snapshot)
+    finally:
+        connection.close()
+    return snapshot
+
+def _restore(snapshot, engine):
+    # Replace the contents of the database with those of a snapshot.
+    connection = engine.raw_connection()
+    try:
+        snapshot.backup(connection.driver_connection)
+    finally:
+        connection.close()
+
+def _execute_script(engine, statements):
+    # Send all the statements to the database in as few round trips as
+    # the driver allows.
+    if not statements:
+        return
+    if engine.dialect.name == 'sqlite':
+        connection = engine.raw_connection()
+        try:
+            connection.driver_connection.executescript(
+                ';\n'.join(statements)+';'
+            )
+        finally:
+            connection.close()
+    else:
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.exec_driver_sql(statement)
+
+# the LeakCheck instances currently active
+_leak_checks = []
+# engines that have had the listeners below added
+_watched = WeakSet()
+# connection record -> (engine, stack) for connections checked out while
+# a LeakCheck is active
+_checkouts = {}
+
+def _checkout(engine):
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        if _leak_checks:
+            _checkouts[connection_record] = engine, extract_stack()[:-2]
+    return checkout
+
+def _checkin(dbapi_connection, connection_record):
+    _checkouts.pop(connection_record, None)
+
+def _watch(name, engine):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    if not isinstance(engine, Engine):
+        # nothing to watch, such as when the session is bound to a
+        # connection
+        return
+    if engine not in _watched:
+        _watched.add(engine)
+        event.listen(engine, 'checkout', _checkout(engine))
+        event.listen(engine, 'checkin', _checkin)
+    for check in _leak_checks:
+        check.sessions.append((name, engine))
+
 def register_session(url=None,
                      name=u'',
                      engine=None,
@@ -20,7 +222,8 @@ def register_session(url=None,
                      transactional=True,
                      scoped=True,
                      config=None,
-                     metadata=None):
+                     metadata=None,
+                     fixtures=None):
     """
     This will create a :class:`~sqlalchemy.orm.session.Session` class for
     testing purposes and register it for later use.
@@ -41,6 +244,29 @@ def register_session(url=None,
     If a :class:`~sqlalchemy.schema.MetaData` instance is passed in,
     then all tables within it will be created.
 
+    If a `fixtures` callable is passed in, it will be called with a
+    :class:`~sqlalchemy.engine.Connection` once the tables have been
+    created so that it can insert any data needed by the tests. The
+    connection's transaction will be committed once the callable returns.
+
+    When the implicit ``sqlite://`` url is used, the database is only
+    built once for each combination of the schemas of `config` and
+    `metadata` and the `fixtures`. A snapshot is then taken using SQLite's
+    backup API and restored into the new database on later calls, which
+    is much quicker than creating the tables and inserting the data
+    again. :class:`Fixtures` are matched by the rows they contain. Other
+    callables are matched using their `key` attribute, if they have one,
+    or otherwise by identity, so a callable created anew in each test
+    should have a `key` that changes only when the data it inserts does.
+    Only the most recently used snapshots are kept.
+
+    The statements used to create tables are compiled once for each
+    schema and database type and then re-used by later calls. If the
+    ``DDL_CACHE`` environment variable is set to a directory, they will
+    also be stored there so that later test runs need not compile them.
+    With SQLite, all the statements are sent to the database in one
+    script.
+
     Unlike the non-testing :class:`~mortar_rdb.register_session`, this will
     also return an instance of the registered session.
     
@@ -51,6 +277,7 @@ def register_session(url=None,
 
     """
 
+    snapshot_key = None
     if not (url or engine):
         url = os.environ.get('DB_URL')
         if not url:
@@ -61,6 +288,9 @@ def register_session(url=None,
                                    echo=echo)
             # don't confuse the real register_session
             echo = False
+            if config is not None or metadata is not None or fixtures:
+                snapshot_key = _snapshot_key(engine, config, metadata,
+                                             fixtures)
         
     real_register_session(
         url,
@@ -73,18 +303,168 @@ def register_session(url=None,
         )
     session = get_session(name)
     engine = session.bind
+    _watch(name, engine)
+
+    if snapshot_key is not None:
+        snapshot = _cached_snapshot(snapshot_key)
+        if snapshot is not None:
+            _restore(snapshot, engine)
+            return session
+    else:
+        drop_tables(engine)
     
-    drop_tables(engine)
-    
+    dialect = engine.dialect
+
     if config is not None:
-        for source in config.sources:
-            source.metadata.create_all(engine)
+        _execute_script(engine, _create_statements(
+            config.metadata, dialect, lambda: config.create_ddl(dialect)
+        ))
 
     if metadata is not None:
-        metadata.create_all(engine)
+        from .controlled import _ddl
+        tables = None
+        if config is not None:
+            # tables in both have already been created from the config
+            tables = [table for key, table in metadata.tables.items()
+                      if key not in config.metadata.tables]
+        _execute_script(engine, _create_statements(
+            metadata, dialect,
+            lambda: _ddl(metadata, dialect, tables=tables),
+            tables
+        ))
+
+    if fixtures is not None:
+        with engine.begin() as connection:
+            fixtures(connection)
+
+    if snapshot_key is not None:
+        _cache_snapshot(snapshot_key, _snapshot(engine))
 
     return session
 
+def _table_rows(source, rows):
+    # Turn rows for a mapped class, or a table, into a list of
+    # (table, {column key: value}) tuples.
+    from sqlalchemy import Table, inspect
+    if isinstance(source, Table):
+        return [(source, dict(row)) for row in rows]
+    mapper = inspect(source)
+    table_rows = []
+    for row in rows:
+        values = {table: {} for table in mapper.tables}
+        for key, value in row.items():
+            # a property may be mapped to a column in more than one table,
+            # such as the primary key when joined inheritance is used
+            for column in mapper.get_property(key).columns:
+                values[column.table][column.key] = value
+        discriminator = mapper.polymorphic_on
+        if discriminator is not None and discriminator.key not in values[
+            discriminator.table
+        ]:
+            values[discriminator.table][discriminator.key] = (
+                mapper.polymorphic_identity
+            )
+        table_rows.extend(values.items())
+    return table_rows
+
+class Fixtures(object):
+    """
+    A set of rows to be inserted into a database for testing purposes.
+
+    :param rows:
+      A dictionary mapping either declaratively mapped model classes or
+      :class:`~sqlalchemy.schema.Table` objects to a sequence of
+      dictionaries, one for each row to be inserted. For model classes,
+      the keys are attribute names, for tables they are column keys.
+
+    :param config:
+      An optional :class:`~mortar_rdb.controlled.Config`. If supplied,
+      tables will be populated in the order in which the configuration
+      creates them. Otherwise, the order is worked out from the foreign
+      keys between the tables containing rows.
+
+    Rows are inserted using one :meth:`executemany
+    <sqlalchemy.engine.Connection.execute>` for each table rather than
+    by flushing a :class:`~sqlalchemy.orm.session.Session`. The work of
+    ordering and grouping the rows is only done once, so the same
+    :class:`Fixtures` can be cheaply loaded in many tests, either by
+    passing it as the `fixtures` parameter to :func:`register_session` or
+    by calling :meth:`load`.
+    """
+
+    def __init__(self, rows, config=None):
+        self.rows = rows
+        self.config = config
+        self._plan = None
+        self._key = None
+
+    @property
+    def key(self):
+        """
+        A hash of the rows, used by :func:`register_session` to re-use
+        snapshots of databases into which the same rows have been
+        inserted.
+        """
+        if self._key is None:
+            from sqlalchemy import Table
+            parts = []
+            for source, rows in self.rows.items():
+                if isinstance(source, Table):
+                    name = source.fullname
+                else:
+                    name = '%s.%s' % (source.__module__, source.__qualname__)
+                parts.append(repr([name, [sorted(row.items())
+                                          for row in rows]]))
+            self._key = sha1(
+                '\n'.join(sorted(parts)).encode('utf-8')
+            ).hexdigest()
+        return self._key
+
+    def _compile(self):
+        from sqlalchemy.schema import sort_tables
+        by_table = {}
+        for source, rows in self.rows.items():
+            for table, values in _table_rows(source, rows):
+                by_table.setdefault(table, []).append(values)
+        if self.config is None:
+            tables = sort_tables(by_table)
+        else:
+            order = {table.key: i
+                     for i, table in enumerate(self.config.create_order)}
+            missing = sorted(t.key for t in by_table if t.key not in order)
+            if missing:
+                raise ValueError('Tables not in configuration: %s' % (
+                    ', '.join(missing)
+                    ))
+            tables = sorted(by_table, key=lambda t: order[t.key])
+        plan = []
+        for table in tables:
+            statement = table.insert()
+            # executemany needs every row to have the same keys, so split
+            # the rows where that changes while keeping them in order:
+            for keys, group in groupby(by_table[table],
+                                       key=lambda values: sorted(values)):
+                plan.append((statement, list(group)))
+        return plan
+
+    def __call__(self, connection):
+        """
+        Insert the rows using the supplied
+        :class:`~sqlalchemy.engine.Connection`.
+        """
+        if self._plan is None:
+            self._plan = self._compile()
+        for statement, rows in self._plan:
+            connection.execute(statement, rows)
+
+    def load(self, session):
+        """
+        Insert the rows using the connection of the supplied
+        :class:`~sqlalchemy.orm.session.Session`, as part of its current
+        transaction.
+        """
+        self(session.connection())
+
 class TestingBase(object):
     """
     This is a helper class that can either be used to make
@@ -119,14 +499,214 @@ class TestingBase(object):
     __test__ = False
 
     def __init__(self):
-        self.original = mortar_rdb._bases
+        self.original = (
+            mortar_rdb._bases, mortar_rdb._tables, mortar_rdb._modules
+        )
         mortar_rdb._bases = {}
+        mortar_rdb._tables = {}
+        mortar_rdb._modules = {}
 
     def restore(self):
-        mortar_rdb._bases = self.original
+        (mortar_rdb._bases, mortar_rdb._tables,
+         mortar_rdb._modules) = self.original
 
     def __enter__(self):
         return self
     
     def __exit__(self,*args):
         self.restore()
+
+class LeakCheck(object):
+    """
+    A helper that reports anything left behind by a test that used
+    sessions registered with :func:`register_session`:
+
+    - connections that are still checked out of an engine's pool, along
+      with the stack from when each was checked out.
+
+    - scoped sessions that were never removed, including whether they
+      still have a transaction open.
+
+    It should be created before any sessions are registered and checked
+    when the test is torn down:
+
+    .. code-block:: python
+
+      from mortar_rdb.testing import LeakCheck
+      from unittest import TestCase
+
+      class YourTestCase(TestCase):
+
+          def setUp(self):
+              self.leaks = LeakCheck()
+              self.addCleanup(self.leaks.check)
+
+    :class:`LeakCheck` can also be used as a context manager, in which
+    case it is checked on exit unless an exception has been raised.
+    Stacks are only recorded for connections checked out while a
+    :class:`LeakCheck` is active.
+    """
+
+    __test__ = False
+
+    def __init__(self):
+        self.sessions = []
+        _leak_checks.append(self)
+
+    def leaks(self):
+        """
+        Return a list of descriptions of anything left behind.
+        """
+        from . import getSiteManager
+        from .interfaces import ISession
+        leaks = []
+        registry = getSiteManager()
+        for name, engine in self.sessions:
+            Session = registry.queryUtility(ISession, name)
+            scoped = getattr(Session, 'registry', None)
+            if scoped is not None and scoped.has():
+                if scoped().in_transaction():
+                    leaks.append('Session %r has an open transaction '
+                                 'and was never removed' % name)
+                else:
+                    leaks.append('Session %r was never removed' % name)
+        engines = self._engines()
+        for engine, stack in _checkouts.values():
+            if engine in engines:
+                leaks.append('Connection to %r checked out at:\n%s' % (
+                    engine.url, ''.join(format_list(stack)).rstrip()
+                ))
+        return leaks
+
+    def _engines(self):
+        return {engine for name, engine in self.sessions}
+
+    def restore(self):
+        """
+        Stop tracking sessions and connections.
+        """
+        if self in _leak_checks:
+            _leak_checks.remove(self)
+        # forget any leaked connections so they are only reported once
+        engines = self._engines()
+        for record, (engine, stack) in list(_checkouts.items()):
+            if engine in engines:
+                del _checkouts[record]
+
+    def check(self):
+        """
+        Stop tracking and raise an :class:`AssertionError` describing
+        anything left behind.
+        """
+        leaks = self.leaks()
+        self.restore()
+        if leaks:
+            raise AssertionError('\n\n'.join(leaks))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.check()
+        else:
+            self.restore()
+
+def _session_engines(name):
+    # The engines used by the session registered with the supplied name.
+    from . import getSiteManager
+    from .interfaces import ISession
+    Session = getSiteManager().getUtility(ISession, name)
+    factory = getattr(Session, 'session_factory', Session)
+    kw = getattr(factory, 'kw', {})
+    if kw.get('shards'):
+        return list(kw['shards'].values())
+    if kw.get('bind') is not None:
+        return [kw['bind']]
+    raise TypeError(
+        'Session registered with name %r is not bound to an engine' % name
+        )
+
+@contextmanager
+def _recording(name):
+    # Yield a list to which a (sql, seconds) tuple is added for each
+    # statement executed by the engines of the named session, other than
+    # those executed by a PlanRecorder.
+    from sqlalchemy import event
+    from .plans import _explaining
+    statements = []
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        if _explaining(context):
+            return
+        conn.info.setdefault('mortar_rdb_start', []).append(perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        if _explaining(context):
+            return
+        start = conn.info['mortar_rdb_start'].pop()
+        statements.append((statement, perf_counter()-start))
+
+    engines = _session_engines(name)
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', before)
+        event.listen(engine, 'after_cursor_execute', after)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', before)
+            event.remove(engine, 'after_cursor_execute', after)
+
+def _describe_statements(statements):
+    return '\n'.join('%.6fs: %s' % (seconds, sql)
+                     for sql, seconds in statements)
+
+@contextmanager
+def assert_max_queries(count, name=u''):
+    """
+    A context manager that raises an :class:`AssertionError` if more than
+    `count` statements are executed within it using the session registered
+    with the supplied `name`. A list of the ``(sql, seconds)`` tuples for
+    the statements executed is returned by the context manager.
+    """
+    with _recording(name) as statements:
+        yield statements
+    if len(statements) > count:
+        raise AssertionError(
+            '%i statements executed, expected at most %i:\n%s' % (
+                len(statements), count, _describe_statements(statements)
+            ))
+
+@contextmanager
+def record_workload(path, name=u''):
+    """
+    A context manager that appends the statements executed within it
+    using the session registered with the supplied `name` to the
+    workload file at `path`, in the format used by
+    :mod:`mortar_rdb.advisor` and the ``advise-indexes`` command. A list of
+    the ``(sql, seconds)`` tuples for the statements executed is returned
+    by the context manager.
+    """
+    from .advisor import write_workload
+    with _recording(name) as statements:
+        yield statements
+    write_workload(path, statements)
+
+@contextmanager
+def assert_max_time(seconds, name=u''):
+    """
+    A context manager that raises an :class:`AssertionError` if the
+    statements executed within it using the session registered with the
+    supplied `name` take more than the supplied number of `seconds`, in
+    total, to execute. A list of the ``(sql, seconds)`` tuples for the
+    statements executed is returned by the context manager.
+    """
+    with _recording(name) as statements:
+        yield statements
+    total = sum(duration for sql, duration in statements)
+    if total > seconds:
+        raise AssertionError(
+            'Statements took %.6fs, expected at most %.6fs:\n%s' % (
+                total, seconds, _describe_statements(statements)
+            ))
@@ -2,8 +2,10 @@ from mortar_rdb.controlled import Scripts, Config, Source
 from sqlalchemy import (
     Table, Column, Integer, String, Text, MetaData, create_engine
     )
+# make sure the orm is imported before PackageTest snapshots sys.modules:
+import sqlalchemy.orm
 from testfixtures import TempDirectory, Replacer, compare
-from unittest import TestCase
+from unittest import SkipTest, TestCase
 
 import os,sys
 
@@ -42,3 +44,16 @@ class ControlledTest(PackageTest):
         self.engine = create_engine(self.db_url)
         self.metadata.create_all(self.engine)
         self.config = Config(Source(self.table))
+
+def sqlite_page_size(connection):
+    """
+    Return the page size of the SQLite database attached to by the
+    supplied connection, skipping the test if the dbstat virtual table
+    that table sizes come from is not available.
+    """
+    from sqlalchemy.exc import OperationalError
+    try:
+        connection.exec_driver_sql('select 1 from dbstat limit 1')
+    except OperationalError:
+        raise SkipTest('dbstat is not available')
+    return connection.exec_driver_sql('pragma page_size').scalar()
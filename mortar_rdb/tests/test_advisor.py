@@ -0,0 +1,151 @@
+from unittest import TestCase
+
+from sqlalchemy import (
+    Column, ForeignKey, Index, Integer, MetaData, String, Table,
+    UniqueConstraint, create_engine
+)
+from testfixtures import TempDirectory, compare
+
+from mortar_rdb.advisor import (
+    advise, indexed, predicate_columns, write_workload
+)
+from mortar_rdb.stats import row_estimates
+
+
+class AdvisorTest(TestCase):
+
+    def setUp(self):
+        self.metadata = MetaData()
+        self.user = Table('user', self.metadata,
+                          Column('id', Integer, primary_key=True),
+                          Column('name', String(50)),
+                          Column('email', String(50)),
+                          Column('team', Integer),
+                          UniqueConstraint('email'))
+        Index('ix_user_name_team', self.user.c.name, self.user.c.team)
+        self.address = Table('address', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('user_id', ForeignKey('user.id')),
+                             Column('city', String(50)))
+        self.tables = self.metadata.tables
+
+
+class TestPredicateColumns(AdvisorTest):
+
+    def _check(self, statement, *expected):
+        compare(set(expected), predicate_columns(statement, self.tables))
+
+    def test_where(self):
+        self._check('SELECT * FROM user WHERE name = ? AND team > 1',
+                    self.user.c.name, self.user.c.team)
+
+    def test_qualified_and_quoted(self):
+        self._check('SELECT "user".id FROM "user" WHERE "user".email = ?',
+                    self.user.c.email)
+
+    def test_join(self):
+        self._check('SELECT u.name FROM user AS u '
+                    'JOIN address a ON a.user_id = u.id '
+                    'WHERE a.city IN (?, ?) ORDER BY u.name',
+                    self.address.c.user_id, self.user.c.id,
+                    self.address.c.city)
+
+    def test_ambiguous(self):
+        # id is in both tables:
+        self._check('SELECT * FROM user JOIN address '
+                    'ON user_id = user.id WHERE id = 1',
+                    self.address.c.user_id, self.user.c.id)
+
+    def test_update_set_ignored(self):
+        self._check("UPDATE user SET name = 'x' WHERE team = 2",
+                    self.user.c.team)
+
+    def test_unknown_table(self):
+        self._check('SELECT * FROM other WHERE name = ?')
+
+    def test_no_predicates(self):
+        self._check('SELECT name FROM user ORDER BY name')
+
+
+class TestIndexed(AdvisorTest):
+
+    def test_primary_key(self):
+        self.assertTrue(indexed(self.user.c.id))
+
+    def test_unique(self):
+        self.assertTrue(indexed(self.user.c.email))
+
+    def test_leading_column(self):
+        self.assertTrue(indexed(self.user.c.name))
+
+    def test_not_leading_column(self):
+        self.assertFalse(indexed(self.user.c.team))
+
+    def test_foreign_key(self):
+        self.assertFalse(indexed(self.address.c.user_id))
+
+
+class TestAdvise(AdvisorTest):
+
+    def test_ranking(self):
+        statements = [
+            'SELECT * FROM user WHERE team = 1\n',
+            'SELECT * FROM user WHERE team = 1\n',
+            '\n',
+            'SELECT * FROM address WHERE city = ?\n',
+            'SELECT * FROM address WHERE user_id = ? AND city = ?\n',
+            'SELECT * FROM user WHERE id = 1\n',
+        ]
+        compare([
+            (20, self.address.c.city, 2),
+            (10, self.address.c.user_id, 1),
+            (2, self.user.c.team, 2),
+        ], advise(statements, self.tables, dict(address=10)))
+
+    def test_empty_tables_still_ranked(self):
+        compare([(1, self.user.c.team, 1)],
+                advise(['SELECT * FROM user WHERE team = 1'],
+                       self.tables, dict(user=0)))
+
+    def test_nothing(self):
+        compare([], advise([], self.tables, {}))
+
+
+class TestWriteWorkload(AdvisorTest):
+
+    def test_write_and_advise(self):
+        with TempDirectory() as dir:
+            path = dir.getpath('workload.sql')
+            write_workload(path, [
+                ('SELECT *\n  FROM user\n  WHERE team = ?', 0.1),
+                'SELECT * FROM user WHERE team = ?',
+                '  ',
+            ])
+            write_workload(path, ['SELECT * FROM address WHERE city = ?'])
+            compare(b'SELECT * FROM user WHERE team = ?\n'
+                    b'SELECT * FROM user WHERE team = ?\n'
+                    b'SELECT * FROM address WHERE city = ?\n',
+                    dir.read('workload.sql'))
+            with open(path) as source:
+                compare([(2, self.user.c.team, 2),
+                         (1, self.address.c.city, 1)],
+                        advise(source.readlines(), self.tables, {}))
+
+
+class TestRowEstimates(TestCase):
+
+    def test_counted(self):
+        metadata = MetaData()
+        table = Table('order', metadata, Column('id', Integer))
+        Table('empty', metadata, Column('id', Integer))
+        engine = create_engine('sqlite://')
+        metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(table.insert(), [dict(id=1), dict(id=2)])
+            compare({'order': 2, 'empty': 0},
+                    row_estimates(connection, ['order', 'empty']))
+
+    def test_no_tables(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            compare({}, row_estimates(connection, []))
@@ -1,12 +1,22 @@
+import re
+import sys
+from warnings import catch_warnings, simplefilter
 from unittest import TestCase
 
-from sqlalchemy import Table, Column, Integer, String, MetaData
+from mock import Mock
+
+from sqlalchemy import (
+    Table, Column, Integer, String, MetaData, ForeignKey, create_engine,
+    inspect
+)
+from sqlalchemy.exc import SAWarning
 from testfixtures import (
-    compare, TempDirectory, ShouldRaise,
+    compare, TempDirectory, ShouldRaise, Replacer,
     StringComparison as S
     )
 
-from mortar_rdb.controlled import Source, scan, Config
+from mortar_rdb import mapped_classes
+from mortar_rdb.controlled import Source, scan, Config, _ddl
 from mortar_rdb.testing import TestingBase
 from .base import PackageTest
 
@@ -244,6 +254,81 @@ class Model3(declarative_base()):
         compare(['table2','table3'], sorted(s.metadata.tables.keys()))
 
     
+    def test_plain_declarative_base(self):
+        self.dir.write('plain/__init__.py', b"""
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Integer
+class Model(declarative_base()):
+  __tablename__ = 'plain'
+  id = Column('id', Integer, primary_key=True)
+""")
+        s = scan('plain')
+        compare(['plain'], list(s.metadata.tables.keys()))
+
+    def test_already_imported_before_testing_base(self):
+        self.dir.write('imported/__init__.py', b"""
+from mortar_rdb import declarative_base
+from sqlalchemy import Column, Integer
+class Model(declarative_base()):
+  __tablename__ = 'imported'
+  id = Column('id', Integer, primary_key=True)
+""")
+        __import__('imported')
+        tb = TestingBase()
+        try:
+            s = scan('imported')
+        finally:
+            tb.restore()
+        compare(['imported'], list(s.metadata.tables.keys()))
+
+    def test_mixed_bases(self):
+        self.dir.write('mixed/__init__.py', b"""
+from mortar_rdb import declarative_base
+from sqlalchemy import Column, Integer
+from sqlalchemy.orm import declarative_base as sa_declarative_base
+class A(declarative_base()):
+  __tablename__ = 'a'
+  id = Column('id', Integer, primary_key=True)
+class B(sa_declarative_base()):
+  __tablename__ = 'b'
+  id = Column('id', Integer, primary_key=True)
+""")
+        s = scan('mixed')
+        compare(['a', 'b'], sorted(s.metadata.tables.keys()))
+
+    def test_reimported(self):
+        source = b"""
+from mortar_rdb import declarative_base
+from sqlalchemy import Column, Integer
+class Model(declarative_base()):
+  __tablename__ = '%s'
+  id = Column('id', Integer, primary_key=True)
+"""
+        self.dir.write('reimported/__init__.py', source % b'old')
+        __import__('reimported')
+        compare(['old'], list(scan('reimported').metadata.tables.keys()))
+        del sys.modules['reimported']
+        self.dir.write('reimported/__init__.py', source % b'new')
+        with catch_warnings():
+            # SQLAlchemy warns that the old class is being replaced:
+            simplefilter('ignore', SAWarning)
+            __import__('reimported')
+        compare(['new'], list(scan('reimported').metadata.tables.keys()))
+        compare([], mapped_classes('old'))
+
+    def test_not_a_member(self):
+        self.dir.write('hidden/__init__.py', b"""
+from mortar_rdb import declarative_base
+from sqlalchemy import Column, Integer
+class Model(declarative_base()):
+  __tablename__ = 'hidden'
+  id = Column('id', Integer, primary_key=True)
+del Model
+""")
+        s = scan('hidden')
+        compare(['hidden'], list(s.metadata.tables.keys()))
+
+
 class TestConfig(TestCase):
 
     def setUp(self):
@@ -278,3 +363,111 @@ class TestConfig(TestCase):
 
         compare({'t2'}, c.excludes[s1])
         compare({'t1'}, c.excludes[s2])
+
+    def test_source_for(self):
+        s1 = Source(Table('t1', MetaData()), Table('t2', MetaData()))
+        s2 = Source(Table('t3', MetaData()))
+
+        c = Config(s1, s2)
+
+        compare(dict(t1=s1, t2=s1, t3=s2), c.source_for)
+        compare({'t1', 't2', 't3'}, c.tables)
+
+    def _cross_source(self):
+        parent = Table('parent', MetaData(),
+                       Column('id', Integer, primary_key=True))
+        child = Table('child', MetaData(),
+                      Column('id', Integer, primary_key=True),
+                      Column('parent_id', ForeignKey('parent.id')))
+        return Config(Source(child), Source(parent))
+
+    def test_metadata(self):
+        c = self._cross_source()
+        compare({'child', 'parent'}, set(c.metadata.tables))
+        fk, = c.metadata.tables['child'].foreign_keys
+        self.assertTrue(fk.column.table is c.metadata.tables['parent'])
+        # only built once:
+        self.assertTrue(c.metadata is c.metadata)
+
+    def test_dependencies(self):
+        c = self._cross_source()
+        compare(dict(child={'parent'}, parent=set()), c.dependencies)
+
+    def test_dependencies_outside_config(self):
+        c = Config(Source(Table('child', MetaData(),
+                                Column('parent_id',
+                                       ForeignKey('other.parent.id')))))
+        compare(dict(child={'other.parent'}), c.dependencies)
+
+    def test_dependencies_self_referential(self):
+        c = Config(Source(Table('node', MetaData(),
+                                Column('id', Integer, primary_key=True),
+                                Column('parent_id', ForeignKey('node.id')))))
+        compare(dict(node=set()), c.dependencies)
+
+    def test_create_and_drop_order(self):
+        c = self._cross_source()
+        compare(['parent', 'child'], [t.name for t in c.create_order])
+        compare(['child', 'parent'], [t.name for t in c.drop_order])
+
+    def test_create_ddl(self):
+        c = self._cross_source()
+        engine = create_engine('sqlite://')
+        compare([S('CREATE TABLE parent .+', flags=re.DOTALL),
+                 S('CREATE TABLE child .+REFERENCES parent \\(id\\).+',
+                   flags=re.DOTALL)],
+                c.create_ddl(engine.dialect))
+
+        with engine.begin() as connection:
+            for statement in c.create_ddl(engine.dialect):
+                connection.exec_driver_sql(statement)
+        compare(['child', 'parent'], sorted(inspect(engine).get_table_names()))
+
+        with engine.begin() as connection:
+            for statement in c.drop_ddl(engine.dialect):
+                connection.exec_driver_sql(statement)
+        compare([], inspect(engine).get_table_names())
+
+    def test_drop_ddl(self):
+        c = self._cross_source()
+        compare(['\nDROP TABLE child'.strip(), 'DROP TABLE parent'],
+                c.drop_ddl(create_engine('sqlite://').dialect))
+
+    def test_ddl_compiled_once(self):
+        c = self._cross_source()
+        dialect = create_engine('sqlite://').dialect
+        with Replacer() as r:
+            ddl = Mock(wraps=_ddl)
+            r.replace('mortar_rdb.controlled._ddl', ddl)
+            first = c.create_ddl(dialect)
+            # another dialect of the same type:
+            second = c.create_ddl(create_engine('sqlite://').dialect)
+            c.drop_ddl(dialect)
+            c.drop_ddl(dialect)
+        self.assertTrue(first is second)
+        compare(2, ddl.call_count)
+
+    def test_ddl_dialect_options(self):
+        c = self._cross_source()
+        from sqlalchemy.dialects import sqlite
+        with Replacer() as r:
+            ddl = Mock(wraps=_ddl)
+            r.replace('mortar_rdb.controlled._ddl', ddl)
+            c.create_ddl(sqlite.dialect())
+            c.create_ddl(sqlite.dialect(paramstyle='named'))
+            c.create_ddl(sqlite.dialect(), dict(other='x'))
+        compare(3, ddl.call_count)
+
+    def test_schema_translate_map(self):
+        c = self._cross_source()
+        compare([S('CREATE TABLE app.parent .+', flags=re.DOTALL),
+                 S('CREATE TABLE app.child .+REFERENCES parent.+',
+                   flags=re.DOTALL)],
+                c.create_ddl(create_engine('sqlite://').dialect,
+                             {None: 'app'}))
+
+    def test_orders_computed_once(self):
+        c = self._cross_source()
+        self.assertTrue(c.create_order is c.create_order)
+        self.assertTrue(c.drop_order is c.drop_order)
+        self.assertTrue(c.dependencies is c.dependencies)
@@ -2,7 +2,7 @@ from datetime import datetime
 from mortar_rdb import get_session
 from mortar_rdb.testing import register_session
 from testfixtures.components import TestComponents
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.schema import Column
 from sqlalchemy.types import  Integer, DateTime
 from unittest import TestCase
@@ -1,7 +1,8 @@
-from mortar_rdb import declarative_base
-from sqlalchemy import create_engine, MetaData
-from sqlalchemy.ext.declarative import DeclarativeMeta
-from testfixtures import Replacer, ShouldRaise
+from mortar_rdb import declarative_base, mapped_classes
+from mortar_rdb.testing import TestingBase
+from sqlalchemy import Column, Integer, MetaData
+from sqlalchemy.orm import DeclarativeMeta
+from testfixtures import Replacer, ShouldRaise, compare
 from unittest import TestCase
 
 
@@ -33,15 +34,12 @@ class TestGetBase(TestCase):
         with ShouldRaise(TypeError(text)):
             declarative_base(engine)
 
-    def test_parameters_engine(self):
-        engine = create_engine('sqlite://')
-
-        b1 = declarative_base(bind=engine)
-        b2 = declarative_base(bind=engine)
+    def test_parameters_name(self):
+        b1 = declarative_base(name='MyBase')
+        b2 = declarative_base(name='MyBase')
 
         self.assertTrue(b1 is b2)
-        self.assertTrue(b1.metadata.bind is engine)
-        self.assertTrue(b2.metadata.bind is engine)
+        self.assertEqual(b1.__name__, 'MyBase')
     
     def test_parameters_metadata(self):
         metadata = MetaData()
@@ -65,12 +63,11 @@ class TestGetBase(TestCase):
         self.assertTrue(isinstance(b2,MyMeta))
 
     def test_different_bases(self):
-        engine = create_engine('sqlite://')
         metadata = MetaData()
         class MyMeta(DeclarativeMeta):
             pass
 
-        b1 = declarative_base(bind=engine)
+        b1 = declarative_base(name='MyBase')
         b2 = declarative_base(metadata=metadata)
         b3 = declarative_base(metaclass=MyMeta)
 
@@ -78,9 +75,9 @@ class TestGetBase(TestCase):
         self.assertFalse(b1 is b3)
         self.assertFalse(b2 is b3)
 
-        self.assertTrue(b1.metadata.bind is engine)
-        self.assertFalse(b2.metadata.bind is engine)
-        self.assertFalse(b3.metadata.bind is engine)
+        self.assertEqual(b1.__name__, 'MyBase')
+        self.assertEqual(b2.__name__, 'Base')
+        self.assertEqual(b3.__name__, 'Base')
         
         self.assertFalse(b1.metadata is metadata)
         self.assertTrue(b2.metadata is metadata)
@@ -89,3 +86,70 @@ class TestGetBase(TestCase):
         self.assertFalse(isinstance(b1,MyMeta))
         self.assertFalse(isinstance(b2,MyMeta))
         self.assertTrue(isinstance(b3,MyMeta))
+
+    def test_parameters_order(self):
+        metadata = MetaData()
+
+        b1 = declarative_base(name='MyBase', metadata=metadata)
+        b2 = declarative_base(metadata=metadata, name='MyBase')
+
+        self.assertTrue(b1 is b2)
+
+    def test_parameters_unhashable(self):
+        registry = {}
+
+        b1 = declarative_base(class_registry=registry)
+        b2 = declarative_base(class_registry=registry)
+        b3 = declarative_base(class_registry={})
+
+        self.assertTrue(b1 is b2)
+        self.assertFalse(b1 is b3)
+
+
+class TestMappedClasses(TestCase):
+
+    def setUp(self):
+        self.tb = TestingBase()
+
+    def tearDown(self):
+        self.tb.restore()
+
+    def test_mapped(self):
+        class Model(declarative_base()):
+            __tablename__ = 'model'
+            id = Column(Integer, primary_key=True)
+
+        compare([Model], mapped_classes('model'))
+
+    def test_not_mapped(self):
+        compare([], mapped_classes('model'))
+
+    def test_single_table_inheritance(self):
+        class Model(declarative_base()):
+            __tablename__ = 'model'
+            id = Column(Integer, primary_key=True)
+            type = Column(Integer)
+            __mapper_args__ = dict(polymorphic_on=type)
+
+        class SubModel(Model):
+            __mapper_args__ = dict(polymorphic_identity=1)
+
+        compare([Model, SubModel], mapped_classes('model'))
+
+    def test_multiple_bases(self):
+        class Model1(declarative_base()):
+            __tablename__ = 'model'
+            id = Column(Integer, primary_key=True)
+
+        class Model2(declarative_base(name='Other')):
+            __tablename__ = 'model'
+            id = Column(Integer, primary_key=True)
+
+        compare([Model1, Model2], mapped_classes('model'))
+
+    def test_testing_base_restored(self):
+        with TestingBase():
+            class Model(declarative_base()):
+                __tablename__ = 'model'
+                id = Column(Integer, primary_key=True)
+        compare([], mapped_classes('model'))
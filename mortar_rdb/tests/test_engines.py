@@ -0,0 +1,264 @@
+import os
+from unittest import TestCase, skipUnless
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool, NullPool, SingletonThreadPool
+from testfixtures import (
+    Replacer, compare, TempDirectory, LogCapture, ShouldRaise,
+    StringComparison as S
+)
+from testfixtures.components import TestComponents
+
+from mortar_rdb import register_session, get_session
+from mortar_rdb import engines
+from mortar_rdb.engines import (
+    engine_key, shared_engine, dispose_shared_engines, prewarm, reset_pool
+)
+
+
+class TestEngineKey(TestCase):
+
+    def test_query_order(self):
+        compare(engine_key('postgresql://u:p@h/db?b=1&a=2'),
+                expected=engine_key('postgresql://u:p@h/db?a=2&b=1'))
+
+    def test_password_included(self):
+        self.assertNotEqual(engine_key('postgresql://u:p1@h/db'),
+                            engine_key('postgresql://u:p2@h/db'))
+
+    def test_option_order(self):
+        compare(engine_key('sqlite://', pool_size=1, echo=True),
+                expected=engine_key('sqlite://', echo=True, pool_size=1))
+
+    def test_unhashable_options(self):
+        compare(engine_key('sqlite://', connect_args={'a': [1], 'b': 2}),
+                expected=engine_key('sqlite://',
+                                    connect_args={'b': 2, 'a': [1]}))
+
+    def test_different_options(self):
+        self.assertNotEqual(engine_key('sqlite://', echo=True),
+                            engine_key('sqlite://', echo=False))
+
+
+class TestSharedEngine(TestCase):
+
+    def setUp(self):
+        self.r = Replacer()
+        self.r.replace('mortar_rdb.engines._engines', {})
+        self.components = TestComponents()
+
+    def tearDown(self):
+        dispose_shared_engines()
+        self.components.uninstall()
+        self.r.restore()
+
+    def test_same(self):
+        self.assertTrue(shared_engine('sqlite://') is shared_engine('sqlite://'))
+
+    def test_different_url(self):
+        self.assertFalse(shared_engine('sqlite://') is
+                         shared_engine('sqlite:///:memory:'))
+
+    def test_different_options(self):
+        e1 = shared_engine('sqlite://', poolclass=NullPool)
+        e2 = shared_engine('sqlite://', poolclass=QueuePool)
+        self.assertFalse(e1 is e2)
+        self.assertTrue(isinstance(e1.pool, NullPool))
+        self.assertTrue(isinstance(e2.pool, QueuePool))
+
+    def test_dispose(self):
+        e1 = shared_engine('sqlite://')
+        dispose_shared_engines()
+        self.assertFalse(shared_engine('sqlite://') is e1)
+
+    def test_register_session(self):
+        register_session('sqlite://', share_engine=True)
+        register_session('sqlite://', name='other', transactional=False,
+                         share_engine=True)
+        register_session('sqlite://', name='separate')
+        engine = get_session().bind
+        self.assertTrue(get_session('other').bind is engine)
+        self.assertFalse(get_session('separate').bind is engine)
+
+    def test_register_session_engine_options(self):
+        register_session('sqlite://', share_engine=True,
+                         engine_options=dict(poolclass=QueuePool,
+                                             pool_size=3))
+        register_session('sqlite://', name='other', share_engine=True,
+                         engine_options=dict(pool_size=3,
+                                             poolclass=QueuePool))
+        register_session('sqlite://', name='different', share_engine=True)
+        engine = get_session().bind
+        compare(engine.pool.size(), expected=3)
+        self.assertTrue(get_session('other').bind is engine)
+        self.assertFalse(get_session('different').bind is engine)
+
+
+class TestPrewarm(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.components = TestComponents()
+        self.url = 'sqlite:///' + self.dir.getpath('test.db')
+
+    def tearDown(self):
+        self.components.uninstall()
+        self.dir.cleanup()
+
+    def _engine(self):
+        return create_engine(self.url, poolclass=QueuePool, pool_size=3,
+                             connect_args={'check_same_thread': False})
+
+    def test_prewarm(self):
+        engine = self._engine()
+        with LogCapture() as log:
+            prewarm(engine, 3)
+        compare(engine.pool.checkedin(), expected=3)
+        compare(engine.pool.checkedout(), expected=0)
+        log.check(('mortar_rdb', 'INFO',
+                   S(r'Opened 3 connections for sqlite:///.+ in [\d.]+s')))
+
+    def test_prewarm_more_than_pool_size(self):
+        engine = create_engine(self.url, poolclass=QueuePool, pool_size=2,
+                               max_overflow=0, pool_timeout=0.1,
+                               connect_args={'check_same_thread': False})
+        with LogCapture() as log:
+            prewarm(engine, 5)
+        compare(engine.pool.checkedin(), expected=2)
+        log.check(('mortar_rdb', 'INFO',
+                   S(r'Opened 2 connections for sqlite:///.+ in [\d.]+s')))
+
+    def test_prewarm_unlimited_pool_size(self):
+        engine = create_engine(self.url, poolclass=QueuePool, pool_size=0,
+                               connect_args={'check_same_thread': False})
+        prewarm(engine, 3)
+        compare(engine.pool.checkedin(), expected=3)
+
+    def test_prewarm_singleton_thread_pool(self):
+        engine = create_engine('sqlite://')
+        self.assertTrue(isinstance(engine.pool, SingletonThreadPool))
+        connects = []
+        event.listen(engine, 'connect', lambda *args: connects.append(args))
+        with LogCapture() as log:
+            prewarm(engine, 2)
+        log.check(('mortar_rdb', 'INFO',
+                   S(r'Opened 1 connections for sqlite:// in [\d.]+s')))
+        # the connection for this thread was opened and is re-used:
+        compare(len(connects), expected=1)
+        select_one(engine)
+        compare(len(connects), expected=1)
+
+    def test_query(self):
+        engine = self._engine()
+        statements = []
+        @event.listens_for(engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        prewarm(engine, 2, 'select 1')
+        compare(statements, expected=['select 1', 'select 1'])
+        compare(engine.pool.checkedin(), expected=2)
+
+    def test_query_fails(self):
+        engine = self._engine()
+        with ShouldRaise(OperationalError):
+            prewarm(engine, 2, 'select * from missing')
+        compare(engine.pool.checkedout(), expected=0)
+
+    def test_register_session(self):
+        register_session(self.url, prewarm=2, prewarm_query='select 1',
+                         engine_options=dict(
+                             poolclass=QueuePool,
+                             connect_args={'check_same_thread': False},
+                         ))
+        compare(get_session().bind.pool.checkedin(), expected=2)
+
+    def test_register_session_in_memory(self):
+        register_session('sqlite://', prewarm=2)
+        compare(get_session().execute(text('select 1')).scalar(), expected=1)
+
+    def test_register_session_shards(self):
+        url2 = 'sqlite:///' + self.dir.getpath('test2.db')
+        register_session(shards={'a': self.url, 'b': url2},
+                         shard_chooser=lambda mapper, instance, clause=None: 'a',
+                         prewarm=2,
+                         engine_options=dict(poolclass=QueuePool))
+        session = get_session()
+        for shard_id in 'a', 'b':
+            compare(session.get_bind(None, shard_id=shard_id).pool.checkedin(),
+                    expected=2)
+
+
+def select_one(engine):
+    with engine.connect() as conn:
+        return conn.execute(text('select 1')).scalar()
+
+
+class TestForkSafety(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.components = TestComponents()
+        self.url = 'sqlite:///' + self.dir.getpath('test.db')
+
+    def tearDown(self):
+        self.components.uninstall()
+        self.dir.cleanup()
+
+    def test_reset_pool(self):
+        engine = create_engine(self.url, poolclass=QueuePool)
+        select_one(engine)
+        pool = engine.pool
+        compare(pool.checkedin(), expected=1)
+        reset_pool(engine)
+        self.assertFalse(engine.pool is pool)
+        compare(engine.pool.checkedin(), expected=0)
+        # the old pool's connections have not been closed:
+        compare(pool.checkedin(), expected=1)
+        self.assertTrue(pool in engines._inherited)
+        # and the engine still works:
+        compare(select_one(engine), expected=1)
+
+    def test_register_session_tracks(self):
+        register_session(self.url)
+        self.assertTrue(get_session().bind in engines._tracked)
+
+    @skipUnless(hasattr(os, 'register_at_fork'), 'no os.register_at_fork')
+    def test_fork(self):
+        register_session(self.url, transactional=False,
+                         engine_options=dict(poolclass=QueuePool))
+        engine = get_session().bind
+        select_one(engine)
+        pool = engine.pool
+        read, write = os.pipe()
+        pid = os.fork()
+        if not pid:  # pragma: no cover - this is the child
+            try:
+                status = b'new' if engine.pool is not pool else b'same'
+                if engine.pool.checkedin():
+                    status = b'not empty'
+                select_one(engine)
+            except Exception:
+                status = b'error'
+            os.write(write, status)
+            os._exit(0)
+        os.close(write)
+        os.waitpid(pid, 0)
+        compare(os.read(read, 100), expected=b'new')
+        os.close(read)
+        # nothing changes in the parent:
+        self.assertTrue(engine.pool is pool)
+        compare(pool.checkedin(), expected=1)
+
+    def test_pid_check(self):
+        engine = create_engine(self.url, poolclass=QueuePool)
+        engines._check_pid(engine)
+        select_one(engine)
+        dbapi_connection = engine.pool._pool.queue[0].dbapi_connection
+        with Replacer() as r:
+            r.replace('os.getpid', lambda: -1)
+            compare(select_one(engine), expected=1)
+        # the inherited connection has been replaced:
+        self.assertFalse(
+            engine.pool._pool.queue[0].dbapi_connection is dbapi_connection
+        )
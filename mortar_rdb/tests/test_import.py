@@ -0,0 +1,59 @@
+import subprocess
+import sys
+from unittest import TestCase
+
+from testfixtures import compare
+
+
+def imported_by(statement):
+    # return the set of modules imported by the supplied statement,
+    # as reported by -X importtime, excluding those imported by an
+    # interpreter that does nothing.
+    def modules(code):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            stderr=subprocess.PIPE, check=True, universal_newlines=True
+        ).stderr
+        names = set()
+        for line in output.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                name = line.rsplit('|', 1)[1].strip()
+                if name != 'package':  # the header line
+                    names.add(name)
+        return names
+    return modules(statement) - modules('pass')
+
+
+def heavy(modules, *prefixes):
+    return sorted(
+        name for name in modules
+        if any(name == prefix or name.startswith(prefix+'.')
+               for prefix in prefixes)
+    )
+
+
+class TestImportTime(TestCase):
+
+    def test_mortar_rdb(self):
+        modules = imported_by('import mortar_rdb')
+        self.assertTrue('mortar_rdb' in modules, modules)
+        compare(heavy(modules,
+                      'sqlalchemy', 'zope.component', 'zope.sqlalchemy',
+                      'transaction', 'concurrent'),
+                expected=[])
+
+    def test_controlled(self):
+        modules = imported_by('import mortar_rdb.controlled')
+        self.assertTrue('mortar_rdb.controlled' in modules, modules)
+        compare(heavy(modules,
+                      'sqlalchemy', 'zope.component', 'zope.sqlalchemy',
+                      'argparse', 'pkgutil', 'inspect'),
+                expected=[])
+
+    def test_loaded_when_needed(self):
+        modules = imported_by(
+            'from mortar_rdb import register_session\n'
+            'register_session("sqlite://")'
+        )
+        self.assertTrue('sqlalchemy.orm.session' in modules, modules)
+        self.assertTrue('zope.sqlalchemy' in modules, modules)
@@ -0,0 +1,190 @@
+from time import sleep
+from unittest import TestCase
+
+from mock import Mock
+from sqlalchemy import (
+    Column, Index, Integer, MetaData, String, Table, create_engine, event,
+    exc
+)
+from sqlalchemy.dialects import mysql, postgresql
+from testfixtures import ShouldRaise, TempDirectory, compare
+
+from mortar_rdb.maintenance import (
+    build_index, index_statements, maintain, missing_indexes, quote_table,
+    time_limit
+)
+
+
+class TestMaintain(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.engine = create_engine(
+            'sqlite:///'+self.dir.getpath('test.db')
+        )
+        metadata = MetaData()
+        for name in 't1', 't2', 'order':
+            Table(name, metadata, Column('id', Integer, primary_key=True))
+        metadata.create_all(self.engine)
+        self.statements = []
+
+        @event.listens_for(self.engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, *args):
+            self.statements.append(statement)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def _check(self, results, *names):
+        compare(list(names), [name for name, seconds, e in results])
+        for name, seconds, exception in results:
+            self.assertTrue(seconds >= 0)
+            compare(None, exception)
+
+    def test_analyze(self):
+        results = maintain(self.engine, 'analyze', ['t1', 't2', 'order'])
+        self._check(results, 't1', 't2', 'order')
+        compare(['ANALYZE t1', 'ANALYZE t2', 'ANALYZE "order"'],
+                self.statements)
+
+    def test_reindex_concurrently(self):
+        results = maintain(self.engine, 'reindex', ['t1', 't2', 'order'],
+                           jobs=3)
+        self._check(results, 't1', 't2', 'order')
+        compare({'REINDEX t1', 'REINDEX t2', 'REINDEX "order"'},
+                set(self.statements))
+
+    def test_not_supported(self):
+        with ShouldRaise(ValueError(
+            'vacuum is not supported for sqlite databases'
+        )):
+            maintain(self.engine, 'vacuum', ['t1'])
+
+    def test_failure(self):
+        (name, seconds, exception), = maintain(self.engine, 'analyze',
+                                               ['missing'])
+        compare('missing', name)
+        self.assertTrue(isinstance(exception, exc.OperationalError))
+
+    def test_quote_table(self):
+        dialect = self.engine.dialect
+        compare('"order"', quote_table(dialect, 'order'))
+        compare('myschema."order"', quote_table(dialect, 'myschema.order'))
+
+
+class TestTimeLimit(TestCase):
+
+    slow = ('with recursive n(i) as (select 1 union all '
+            'select i+1 from n where i < 100000000) select count(*) from n')
+
+    def test_sqlite(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            with ShouldRaise(exc.OperationalError):
+                with time_limit(connection, 0.01):
+                    connection.exec_driver_sql(self.slow)
+            # the limit no longer applies:
+            compare(1, connection.exec_driver_sql('select 1').scalar())
+
+    def test_none(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            with time_limit(connection, None):
+                compare(1, connection.exec_driver_sql('select 1').scalar())
+
+
+class TestIndexes(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.engine = create_engine(
+            'sqlite:///'+self.dir.getpath('test.db')
+        )
+        self.metadata = MetaData()
+        self.table = Table('model', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(50)),
+                           Column('value', Integer))
+        self.existing = Index('ix_value', self.table.c.value)
+        self.metadata.create_all(self.engine)
+        self.new = Index('ix_name', self.table.c.name, unique=True)
+        Table('not_created', self.metadata,
+              Column('id', Integer), Index('ix_id', 'id'))
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def test_missing(self):
+        with self.engine.connect() as connection:
+            compare([(self.new, False)],
+                    missing_indexes(connection, self.metadata))
+
+    def test_build(self):
+        seconds = build_index(self.engine, self.new)
+        self.assertTrue(seconds >= 0)
+        with self.engine.connect() as connection:
+            compare([], missing_indexes(connection, self.metadata))
+
+    def test_statements(self):
+        compare(['CREATE UNIQUE INDEX ix_name ON model (name)'],
+                index_statements(self.engine.dialect, self.new))
+
+    def test_statements_postgresql(self):
+        compare(['CREATE INDEX CONCURRENTLY ix_value ON model (value)'],
+                index_statements(postgresql.dialect(), self.existing))
+
+    def test_statements_postgresql_already_concurrent(self):
+        index = Index('ix_name', self.table.c.name, unique=True,
+                      postgresql_concurrently=True)
+        compare(['CREATE UNIQUE INDEX CONCURRENTLY ix_name ON model (name)'],
+                index_statements(postgresql.dialect(), index))
+
+    def test_missing_by_name_only(self):
+        # an index with the right name but the wrong columns is not missing:
+        metadata = MetaData()
+        table = Table('model', metadata, Column('name', String(50)))
+        Index('ix_value', table.c.name)
+        with self.engine.connect() as connection:
+            compare([], missing_indexes(connection, metadata))
+
+    def test_statements_postgresql_invalid(self):
+        table = Table('model', MetaData(), Column('name', String(50)),
+                      schema='app')
+        index = Index('ix_name', table.c.name, unique=True)
+        compare(['DROP INDEX CONCURRENTLY IF EXISTS app.ix_name',
+                 'CREATE UNIQUE INDEX CONCURRENTLY ix_name '
+                 'ON app.model (name)'],
+                index_statements(postgresql.dialect(), index, invalid=True))
+
+    def test_statements_mysql(self):
+        compare(['CREATE INDEX ix_value ON model (value) '
+                 'ALGORITHM=INPLACE LOCK=NONE'],
+                index_statements(mysql.dialect(), self.existing))
+
+    def test_build_progress(self):
+        builder = Mock()
+        builder.exec_driver_sql.side_effect = lambda sql: (
+            Mock(**{'scalar.return_value': 42}) if 'pid' in sql
+            else sleep(0.1)
+        )
+        watcher = Mock()
+        watcher.execute.return_value.first.return_value = (
+            'building index', 1, 2, 0, 0
+        )
+        engine = Mock(dialect=postgresql.dialect())
+        engine.connect.return_value.__enter__ = Mock(
+            side_effect=[builder, watcher]
+        )
+        engine.connect.return_value.__exit__ = Mock(return_value=False)
+        progress = Mock()
+        build_index(engine, self.existing, progress=progress,
+                    interval=0.01)
+        builder.exec_driver_sql.assert_called_with(
+            'CREATE INDEX CONCURRENTLY ix_value ON model (value)'
+        )
+        self.assertTrue(progress.call_count > 0)
+        progress.assert_called_with(self.existing,
+                                    ('building index', 1, 2, 0, 0))
+        compare(dict(pid=42), watcher.execute.call_args.args[1])
@@ -0,0 +1,271 @@
+from datetime import date
+from unittest import TestCase
+
+from mock import Mock
+from sqlalchemy import (
+    Column, Date, Index, Integer, MetaData, String, Table, UniqueConstraint
+)
+from sqlalchemy.dialects import postgresql
+from testfixtures import Replacer, ShouldRaise, compare
+
+from mortar_rdb.controlled import Config, Source
+from mortar_rdb.partitions import (
+    HashPartitioning, ListPartitioning, Partitioning, RangePartitioning,
+    maintain_partitions, plan_partitions
+)
+
+
+def event_table(metadata=None, name='event'):
+    return Table(name, metadata or MetaData(),
+                 Column('id', Integer, primary_key=True),
+                 Column('at', Date, primary_key=True),
+                 Column('region', String(10)))
+
+
+class TestSource(TestCase):
+
+    def test_create_ddl(self):
+        config = Config(Source(event_table(), partitioning=dict(
+            event=RangePartitioning('at')
+        )))
+        statements = config.create_ddl(postgresql.dialect())
+        compare(1, len(statements))
+        self.assertTrue(statements[0].endswith('PARTITION BY RANGE (at)'),
+                        statements[0])
+        compare(['event'], list(config.partitioning))
+
+    def test_fingerprint(self):
+        from mortar_rdb.testing import _fingerprint
+        dialect = postgresql.dialect()
+        fingerprints = {
+            _fingerprint(Source(event_table()).metadata, dialect),
+            _fingerprint(Source(event_table(), partitioning=dict(
+                event=RangePartitioning('at')
+            )).metadata, dialect),
+            _fingerprint(Source(event_table(), partitioning=dict(
+                event=HashPartitioning('id', 4)
+            )).metadata, dialect),
+        }
+        compare(3, len(fingerprints))
+
+    def test_other_databases(self):
+        from sqlalchemy.dialects import sqlite
+        config = Config(Source(event_table(), partitioning=dict(
+            event=HashPartitioning('id', 4)
+        )))
+        self.assertFalse('PARTITION' in config.create_ddl(sqlite.dialect())[0])
+
+    def test_original_table_unchanged(self):
+        table = event_table()
+        Source(table, partitioning=dict(event=HashPartitioning('id', 4)))
+        compare({}, dict(table.dialect_kwargs))
+
+    def test_unknown_table(self):
+        with ShouldRaise(ValueError("'other' is not a table in this Source")):
+            Source(event_table(), partitioning=dict(
+                other=HashPartitioning('id', 4)
+            ))
+
+    def test_unknown_column(self):
+        with ShouldRaise(ValueError("'event' has no column 'foo'")):
+            Source(event_table(), partitioning=dict(
+                event=HashPartitioning('foo', 4)
+            ))
+
+    def test_column_not_in_primary_key(self):
+        with ShouldRaise(ValueError(
+            "Partition column 'region' must be part of the primary key "
+            "of 'event'"
+        )):
+            Source(event_table(), partitioning=dict(
+                event=ListPartitioning('region', dict(eu=['eu']))
+            ))
+
+    def test_column_not_in_unique_constraint(self):
+        table = event_table()
+        UniqueConstraint(table.c.id, table.c.region)
+        with ShouldRaise(ValueError(
+            "Partition column 'at' must be part of the unique constraint "
+            "on (id, region) of 'event'"
+        )):
+            Source(table, partitioning=dict(event=RangePartitioning('at')))
+
+    def test_column_not_in_unique_index(self):
+        table = event_table()
+        Index('ix_region', table.c.region, unique=True)
+        with ShouldRaise(ValueError(
+            "Partition column 'at' must be part of the unique index "
+            "on (region) of 'event'"
+        )):
+            Source(table, partitioning=dict(event=RangePartitioning('at')))
+
+    def test_column_in_unique_constraint_and_index(self):
+        table = event_table()
+        UniqueConstraint(table.c.region, table.c.at)
+        Index('ix_at', table.c.at, unique=True)
+        Index('ix_region', table.c.region)
+        Source(table, partitioning=dict(event=RangePartitioning('at')))
+
+
+class TestPartitioning(TestCase):
+
+    def test_subclass(self):
+        class Custom(Partitioning):
+            method = 'LIST'
+        config = Config(Source(event_table(), partitioning=dict(
+            event=Custom('at')
+        )))
+        statement, = config.create_ddl(postgresql.dialect())
+        self.assertTrue(statement.endswith('PARTITION BY LIST (at)'),
+                        statement)
+        compare([], plan_partitions(postgresql.dialect(), 'event',
+                                    Custom('at'), set(), date.today()))
+
+    def test_no_method(self):
+        with ShouldRaise(TypeError(
+            'Partitioning does not set a partitioning method'
+        )):
+            Partitioning('at')
+
+
+class TestPlan(TestCase):
+
+    dialect = postgresql.dialect()
+
+    def _plan(self, partitioning, existing=(), today=date(2026, 10, 19),
+              name='event', expire=True):
+        return [step[-1] for step in plan_partitions(
+            self.dialect, name, partitioning, set(existing), today, expire
+        )]
+
+    def test_range_months(self):
+        compare([
+            'CREATE TABLE event_p2026_10 PARTITION OF event '
+            "FOR VALUES FROM ('2026-10-01') TO ('2026-11-01')",
+            'CREATE TABLE event_p2026_11 PARTITION OF event '
+            "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')",
+            'CREATE TABLE event_p2026_12 PARTITION OF event '
+            "FOR VALUES FROM ('2026-12-01') TO ('2027-01-01')",
+        ], self._plan(RangePartitioning('at', premake=2)))
+
+    def test_range_days_and_default(self):
+        compare([
+            'CREATE TABLE event_p2026_10_19 PARTITION OF event '
+            "FOR VALUES FROM ('2026-10-19') TO ('2026-10-20')",
+            'CREATE TABLE event_default PARTITION OF event DEFAULT',
+        ], self._plan(RangePartitioning('at', 'day', premake=0,
+                                        default=True)))
+
+    def test_range_years(self):
+        compare([
+            'CREATE TABLE event_p2026 PARTITION OF event '
+            "FOR VALUES FROM ('2026-01-01') TO ('2027-01-01')",
+        ], self._plan(RangePartitioning('at', 'year', premake=0)))
+
+    def test_range_existing(self):
+        compare([
+            'CREATE TABLE event_p2026_11 PARTITION OF event '
+            "FOR VALUES FROM ('2026-11-01') TO ('2026-12-01')",
+        ], self._plan(RangePartitioning('at', premake=1),
+                      existing=['event_p2026_10']))
+
+    def test_range_retention(self):
+        existing = ['event_p2026_06', 'event_p2026_07', 'event_p2026_08',
+                    'event_p2026_09', 'event_p2026_10', 'event_default',
+                    'event_p2026_13', 'other_p2020_01']
+        compare([
+            'DROP TABLE event_p2026_06',
+            'DROP TABLE event_p2026_07',
+        ], self._plan(RangePartitioning('at', premake=0, retain=2),
+                      existing))
+
+    def test_range_detach(self):
+        compare([
+            'ALTER TABLE event DETACH PARTITION event_p2026_08',
+        ], self._plan(RangePartitioning('at', premake=0, retain=1,
+                                        detach=True),
+                      ['event_p2026_08', 'event_p2026_10']))
+
+    def test_range_no_expire(self):
+        compare([], self._plan(RangePartitioning('at', premake=0, retain=0),
+                               ['event_p2026_08', 'event_p2026_10'],
+                               expire=False))
+
+    def test_range_schema(self):
+        compare([
+            'CREATE TABLE audit.event_p2026_10 PARTITION OF audit.event '
+            "FOR VALUES FROM ('2026-10-01') TO ('2026-11-01')",
+            'DROP TABLE audit.event_p2026_01',
+        ], self._plan(RangePartitioning('at', premake=0, retain=1),
+                      ['event_p2026_01'], name='audit.event'))
+
+    def test_bad_interval(self):
+        with ShouldRaise(ValueError(
+            'interval must be one of: day, month, year'
+        )):
+            RangePartitioning('at', 'week')
+
+    def test_list(self):
+        compare([
+            'CREATE TABLE event_eu PARTITION OF event '
+            "FOR VALUES IN ('de', 'fr')",
+            'CREATE TABLE event_us PARTITION OF event '
+            "FOR VALUES IN ('us')",
+            'CREATE TABLE event_default PARTITION OF event DEFAULT',
+        ], self._plan(ListPartitioning('region', dict(
+            us=['us'], eu=['de', 'fr']
+        ), default=True), existing=['event_p2020_01']))
+
+    def test_hash(self):
+        compare([
+            'CREATE TABLE event_p0 PARTITION OF event '
+            'FOR VALUES WITH (MODULUS 2, REMAINDER 0)',
+        ], self._plan(HashPartitioning('id', 2), existing=['event_p1']))
+
+    def test_repr(self):
+        compare('<HashPartitioning on id>', repr(HashPartitioning('id', 2)))
+
+
+class TestMaintainPartitions(TestCase):
+
+    def setUp(self):
+        metadata = MetaData()
+        self.config = Config(Source(
+            event_table(metadata), event_table(metadata, 'audit'),
+            partitioning=dict(
+                event=RangePartitioning('at', premake=0, retain=0),
+                audit=HashPartitioning('id', 1),
+            )
+        ))
+        self.connection = Mock()
+        self.connection.dialect = postgresql.dialect()
+
+    def test_maintain(self):
+        existing = dict(event={'event_p2026_09'}, audit=set())
+        with Replacer() as r:
+            r.replace('mortar_rdb.partitions.existing_partitions',
+                      lambda connection, name: existing[name])
+            executed = maintain_partitions(self.connection, self.config,
+                                           date(2026, 10, 19))
+        compare([
+            ('create', 'audit', 'audit_p0',
+             'CREATE TABLE audit_p0 PARTITION OF audit '
+             'FOR VALUES WITH (MODULUS 1, REMAINDER 0)'),
+            ('create', 'event', 'event_p2026_10',
+             'CREATE TABLE event_p2026_10 PARTITION OF event '
+             "FOR VALUES FROM ('2026-10-01') TO ('2026-11-01')"),
+            ('drop', 'event', 'event_p2026_09',
+             'DROP TABLE event_p2026_09'),
+        ], executed)
+        compare([step[-1] for step in executed], [
+            call.args[0]
+            for call in self.connection.exec_driver_sql.call_args_list
+        ])
+
+    def test_not_postgresql(self):
+        from sqlalchemy.dialects import sqlite
+        self.connection.dialect = sqlite.dialect()
+        with ShouldRaise(ValueError(
+            'Partitioning is not supported for sqlite databases'
+        )):
+            maintain_partitions(self.connection, self.config)
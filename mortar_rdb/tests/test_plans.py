@@ -0,0 +1,182 @@
+import json
+from unittest import TestCase
+
+from sqlalchemy import Column, Index, Integer, MetaData, String, Table, text
+from testfixtures import (
+    Replacer, ShouldRaise, TempDirectory, compare
+)
+from testfixtures.components import TestComponents
+
+from mortar_rdb.controlled import Config, Source
+from mortar_rdb.plans import PlanRecorder, indexes, scans
+from mortar_rdb.testing import assert_max_queries, register_session
+
+
+class TestPlanRecorder(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.dir = TempDirectory()
+        self.r = Replacer()
+        self.r.replace('os.environ', dict())
+        self.r.replace('mortar_rdb.testing._snapshots', {})
+        self.path = self.dir.getpath('plans.json')
+
+    def tearDown(self):
+        self.r.restore()
+        self.dir.cleanup()
+        self.components.uninstall()
+
+    def _session(self, index=True):
+        metadata = MetaData()
+        table = Table('model', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('name', String(50)))
+        if index:
+            Index('ix_name', table.c.name)
+        self.config = Config(Source(table))
+        return register_session(metadata=metadata, transactional=False)
+
+    def _run(self, session):
+        session.execute(text('select * from model where name = :name'),
+                        dict(name='foo'))
+        session.execute(text('select * from model where name = :name'),
+                        dict(name='bar'))
+        session.execute(text('select * from model where id = 1'))
+        session.execute(text("insert into model (name) values ('x')"))
+
+    def _recorder(self, session, config=None):
+        recorder = PlanRecorder(self.path, config)
+        recorder.watch()
+        self._run(session)
+        return recorder
+
+    def test_record(self):
+        recorder = self._recorder(self._session())
+        compare({
+            'select * from model where name = ?': dict(
+                dialect='sqlite',
+                plan=['SEARCH model USING COVERING INDEX ix_name (name=?)']
+            ),
+            'select * from model where id = 1': dict(
+                dialect='sqlite',
+                plan=['SEARCH model USING INTEGER PRIMARY KEY (rowid=?)']
+            ),
+        }, recorder.plans)
+        compare([], recorder.problems())
+
+    def test_save_and_check(self):
+        self._recorder(self._session()).save()
+        with open(self.path) as source:
+            compare(2, len(json.load(source)))
+
+        recorder = self._recorder(self._session())
+        recorder.check()
+
+    def test_index_removed(self):
+        self._recorder(self._session()).save()
+        recorder = self._recorder(self._session(index=False))
+        with ShouldRaise(AssertionError(
+            'New sequential scan of model:\n'
+            'select * from model where name = ?\n'
+            '\n'
+            'INDEX ix_name on model no longer used:\n'
+            'select * from model where name = ?'
+        )):
+            recorder.check()
+
+    def test_new_statement_not_checked(self):
+        recorder = self._recorder(self._session(index=False))
+        compare([], recorder.problems())
+        compare(['SCAN model'],
+                recorder.plans['select * from model where name = ?']['plan'])
+
+    def test_save_merges(self):
+        session = self._session()
+        PlanRecorder(self.path).save()
+        recorder = PlanRecorder(self.path)
+        recorder.baseline['other'] = dict(dialect='sqlite', plan=['SCAN x'])
+        recorder.watch()
+        session.execute(text('select * from model where id = 1'))
+        recorder.save()
+        with open(self.path) as source:
+            compare(['other', 'select * from model where id = 1'],
+                    sorted(json.load(source)))
+
+    def test_config_filters(self):
+        session = self._session()
+        other = Config(Source(Table('other', MetaData(),
+                                    Column('id', Integer))))
+        recorder = self._recorder(session, other)
+        compare({}, recorder.plans)
+        recorder = self._recorder(session, self.config)
+        compare(2, len(recorder.plans))
+
+    def test_config_without_tables(self):
+        session = self._session()
+        recorder = self._recorder(session, Config())
+        compare({}, recorder.plans)
+
+    def test_explain_not_counted(self):
+        session = self._session()
+        recorder = PlanRecorder(self.path)
+        recorder.watch()
+        with assert_max_queries(4) as statements:
+            self._run(session)
+        compare([
+            'select * from model where name = ?',
+            'select * from model where name = ?',
+            'select * from model where id = 1',
+            "insert into model (name) values ('x')",
+        ], [sql for sql, seconds in statements])
+        compare(2, len(recorder.plans))
+
+    def test_explain_not_recorded(self):
+        session = self._session()
+        recorder = PlanRecorder(self.path)
+        recorder.watch()
+        PlanRecorder(self.dir.getpath('other.json')).watch()
+        self._run(session)
+        compare(['select * from model where id = 1',
+                 'select * from model where name = ?'],
+                sorted(recorder.plans))
+
+    def test_watch_twice(self):
+        session = self._session()
+        recorder = PlanRecorder(self.path)
+        recorder.watch()
+        recorder.watch()
+        self._run(session)
+        compare(2, len(recorder.plans))
+
+    def test_save_creates_directory(self):
+        recorder = PlanRecorder(self.dir.getpath('plans/run.json'))
+        recorder.save()
+        self.dir.compare(['plans/', 'plans/run.json'])
+
+
+class TestScansAndIndexes(TestCase):
+
+    def test_sqlite(self):
+        plan = ['SCAN a',
+                'SEARCH b USING AUTOMATIC COVERING INDEX (x=?)',
+                'SCAN TABLE c',
+                'SCAN d USING COVERING INDEX ix_d',
+                'SEARCH e USING INTEGER PRIMARY KEY (rowid=?)']
+        compare({'a', 'c'}, scans('sqlite', plan))
+        compare({('d', 'INDEX ix_d'), ('e', 'INTEGER PRIMARY KEY')},
+                indexes('sqlite', plan))
+
+    def test_postgresql(self):
+        plan = ['Nested Loop',
+                'Seq Scan on a',
+                'Index Scan using a_pkey on b',
+                'Index Only Scan using ix_c on c',
+                'Bitmap Index Scan on ix_d']
+        compare({'a'}, scans('postgresql', plan))
+        compare({('b', 'a_pkey'), ('c', 'ix_c'), (None, 'ix_d')},
+                indexes('postgresql', plan))
+
+    def test_other(self):
+        compare(set(), scans('mysql', ['ALL model']))
+        compare(set(), indexes('mysql', ['ref model ix']))
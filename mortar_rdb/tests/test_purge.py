@@ -0,0 +1,150 @@
+import json
+from datetime import date, datetime, time
+from decimal import Decimal
+from unittest import TestCase
+from uuid import UUID
+
+from mock import Mock, call
+from sqlalchemy import (
+    Column, Integer, MetaData, String, Table, create_engine, event, select
+)
+from sqlalchemy.dialects import postgresql
+from testfixtures import Replacer, ShouldRaise, TempDirectory, compare
+
+from mortar_rdb.purge import dump_key, load_key, purge, replica_lag
+
+
+class TestPurge(TestCase):
+
+    def setUp(self):
+        self.dir = TempDirectory()
+        self.engine = create_engine(
+            'sqlite:///'+self.dir.getpath('test.db')
+        )
+        self.metadata = MetaData()
+        self.table = Table('event', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('kind', String(10)))
+        self.archive = Table('event_archive', self.metadata,
+                             Column('id', Integer, primary_key=True),
+                             Column('kind', String(10)))
+        self.metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), [
+                dict(id=i, kind='old' if i % 2 else 'new')
+                for i in range(1, 11)
+            ])
+        self.r = Replacer()
+        self.sleep = Mock()
+        self.r.replace('mortar_rdb.purge.sleep', self.sleep)
+        self.deletes = []
+
+        @event.listens_for(self.engine, 'before_cursor_execute')
+        def record(conn, cursor, statement, *args):
+            if statement.startswith('DELETE'):
+                self.deletes.append(statement)
+
+    def tearDown(self):
+        self.r.restore()
+        self.engine.dispose()
+        self.dir.cleanup()
+
+    def _ids(self, table=None):
+        table = self.table if table is None else table
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(table.c.id).order_by(table.c.id)
+            ).scalars().all()
+
+    def test_batches(self):
+        batch = Mock()
+        compare(5, purge(self.engine, self.table, "kind = 'old'",
+                         batch_size=2, pause=0.5, batch=batch))
+        compare([2, 4, 6, 8, 10], self._ids())
+        compare([call(2, (3,)), call(2, (7,)), call(1, (9,))],
+                [call(*c.args[:2]) for c in batch.call_args_list])
+        compare(3, len(self.deletes))
+        compare([call(0.5), call(0.5)], self.sleep.call_args_list)
+
+    def test_exact_batches(self):
+        compare(5, purge(self.engine, self.table, "kind = 'old'",
+                         batch_size=5))
+        compare(1, len(self.deletes))
+
+    def test_expression_and_archive(self):
+        compare(3, purge(self.engine, self.table, self.table.c.id > 7,
+                         archive=self.archive))
+        compare([1, 2, 3, 4, 5, 6, 7], self._ids())
+        compare([8, 9, 10], self._ids(self.archive))
+
+    def test_resume(self):
+        compare(2, purge(self.engine, self.table, "kind = 'old'",
+                         after=(5,)))
+        compare([1, 2, 3, 4, 5, 6, 8, 10], self._ids())
+
+    def test_nothing_to_purge(self):
+        batch = Mock()
+        compare(0, purge(self.engine, self.table, "kind = 'none'",
+                         batch=batch))
+        compare([], batch.call_args_list)
+
+    def test_composite_key(self):
+        table = Table('pair', self.metadata,
+                      Column('a', Integer, primary_key=True),
+                      Column('b', Integer, primary_key=True))
+        table.create(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(table.insert(), [
+                dict(a=a, b=b) for a in range(3) for b in range(3)
+            ])
+        batch = Mock()
+        compare(6, purge(self.engine, table, table.c.b > 0, batch_size=4,
+                         batch=batch))
+        compare([call(4, (1, 2)), call(2, (2, 2))],
+                [call(*c.args[:2]) for c in batch.call_args_list])
+        with self.engine.connect() as connection:
+            compare([(0, 0), (1, 0), (2, 0)],
+                    [tuple(row) for row in connection.execute(
+                        select(table).order_by(table.c.a)
+                    )])
+
+    def test_no_primary_key(self):
+        table = Table('heap', MetaData(), Column('x', Integer))
+        with ShouldRaise(ValueError('heap has no primary key')):
+            purge(self.engine, table, 'x = 1')
+
+    def test_max_lag(self):
+        lag = Mock(side_effect=[10, 3, 0, 0])
+        compare(5, purge(self.engine, self.table, "kind = 'old'",
+                         batch_size=3, max_lag=5, lag=lag))
+        compare(3, lag.call_count)
+        compare([call(1)], self.sleep.call_args_list)
+
+
+class TestKeys(TestCase):
+
+    def test_round_trip(self):
+        key = (1, 'x', 1.5, None, datetime(2026, 10, 19, 12, 30),
+               date(2026, 10, 19), time(12, 30), UUID(int=1),
+               Decimal('1.10'), b'\x00\xff')
+        compare(key, load_key(json.loads(json.dumps(dump_key(key)))))
+
+    def test_unsupported(self):
+        with ShouldRaise(TypeError('Cannot store key value [1]')):
+            dump_key(([1],))
+
+
+class TestReplicaLag(TestCase):
+
+    def test_postgresql(self):
+        connection = Mock(dialect=postgresql.dialect())
+        connection.execute.return_value.scalar.return_value = 2
+        compare(2.0, replica_lag(connection))
+
+    def test_not_supported(self):
+        engine = create_engine('sqlite://')
+        with engine.connect() as connection:
+            with ShouldRaise(ValueError(
+                'Replica lag is not supported for sqlite databases'
+            )):
+                replica_lag(connection)
@@ -0,0 +1,138 @@
+import os
+from unittest import TestCase
+
+from sqlalchemy import bindparam, create_engine, event, select
+from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.schema import Column
+from sqlalchemy.types import Integer, String
+from testfixtures import (
+    Replace, TempDirectory, compare, StringComparison as S
+)
+from testfixtures.components import TestComponents
+
+from mortar_rdb import register_session, get_session
+from mortar_rdb.queries import hot_query, warm
+
+
+class TestHotQueries(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.r = Replace('mortar_rdb.queries._queries', [])
+        self.r.__enter__()
+        self.dir = TempDirectory()
+
+        Base = declarative_base()
+
+        class Model(Base):
+            __tablename__ = 'model'
+            id = Column(Integer, primary_key=True)
+            name = Column(String(50))
+
+        self.Base = Base
+        self.Model = Model
+        self.by_name = hot_query(
+            select(Model).where(Model.name == bindparam('name'))
+        )
+        self.all = hot_query(select(Model).order_by(Model.id))
+        self.executed = []
+
+    def tearDown(self):
+        self.r.__exit__(None, None, None)
+        self.dir.cleanup()
+        self.components.uninstall()
+
+    def _engine(self, name='test', **kw):
+        url = 'sqlite:///' + os.path.join(self.dir.path, name + '.db')
+        engine = create_engine(url, **kw)
+        self.Base.metadata.create_all(engine)
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT'):
+                self.executed.append(context._get_cache_stats())
+
+        return engine
+
+    def _check_cached(self, count):
+        compare(len(self.executed), expected=count)
+        for stats in self.executed:
+            self.assertTrue(stats.startswith('cached since'), stats)
+
+    def test_compiled_on_register(self):
+        engine = self._engine()
+        register_session(engine=engine, transactional=False)
+        compare(len(engine._compiled_cache), expected=2)
+
+        session = get_session()
+        session.add(self.Model(name='foo'))
+        session.add(self.Model(name='bar'))
+        session.flush()
+
+        obj = session.execute(self.by_name, dict(name='foo')).scalar_one()
+        compare(obj.name, expected='foo')
+        compare([o.name for o in session.scalars(self.all)],
+                expected=['foo', 'bar'])
+        self._check_cached(2)
+
+    def test_each_engine(self):
+        one, two = self._engine('one'), self._engine('two')
+        register_session(engine=one, name='one', transactional=False)
+        register_session(engine=two, name='two', transactional=False)
+        for name in 'one', 'two':
+            compare(get_session(name).scalars(self.all).all(), expected=[])
+        self._check_cached(2)
+
+    def test_registered_twice(self):
+        engine = self._engine()
+        register_session(engine=engine, transactional=False)
+        register_session(engine=engine, name='other', transactional=False)
+        compare(len(engine._compiled_cache), expected=2)
+
+    def test_sharded(self):
+        shards = dict(a=self._engine('a', connect_args=dict(
+                          check_same_thread=False
+                      )),
+                      b=self._engine('b', connect_args=dict(
+                          check_same_thread=False
+                      )))
+        register_session(shards=shards, transactional=False,
+                         shard_chooser=lambda *args, **kw: 'a')
+        session = get_session()
+        session.add(self.Model(name='foo'))
+        session.flush()
+        compare([o.name for o in session.scalars(self.by_name,
+                                                 dict(name='foo'))],
+                expected=['foo'])
+        self._check_cached(2)
+
+    def test_literal_values(self):
+        statement = hot_query(select(self.Model).where(self.Model.id == 1))
+        engine = self._engine()
+        register_session(engine=engine, transactional=False)
+        session = get_session()
+        compare(session.scalars(statement).all(), expected=[])
+        compare(session.scalars(
+            select(self.Model).where(self.Model.id == 2)
+        ).all(), expected=[])
+        self._check_cached(2)
+
+    def test_caching_disabled(self):
+        engine = self._engine(query_cache_size=0)
+        register_session(engine=engine, transactional=False)
+        compare(get_session().scalars(self.all).all(), expected=[])
+        compare(self.executed, expected=[S('caching disabled .+')])
+
+    def test_warm_directly(self):
+        engine = self._engine()
+        warm([engine])
+        compare(len(engine._compiled_cache), expected=2)
+        session = sessionmaker(bind=engine)()
+        compare(session.scalars(self.all).all(), expected=[])
+        self._check_cached(1)
+
+    def test_no_queries(self):
+        engine = self._engine()
+        with Replace('mortar_rdb.queries._queries', []):
+            register_session(engine=engine, transactional=False)
+        compare(len(engine._compiled_cache), expected=0)
@@ -38,8 +38,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('mysql://foo',), {'echo':None}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine,
                   'twophase': True,
                   },),
@@ -59,8 +58,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('postgres://foo',), {'echo':None}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine,
                   'twophase': True,
                   },),
@@ -80,8 +78,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('postgres://foo',), {'echo':None}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine,
                   },),
                 ('scoped_session', (self.Session,), {}),
@@ -99,8 +96,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('sqlite://foo',), {'echo':None}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine,
                   },),
                 ('scoped_session', (self.Session,), {}),
@@ -119,8 +115,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('mysql://foo',), {'echo':None}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine}),
                 ('getSiteManager', (), {}),
                 ('registry.registerUtility',
@@ -136,8 +131,7 @@ class TestUtility(TestCase):
         compare([
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.m.engine2}),
                 ('scoped_session', (self.Session,), {}),
                 ('getSiteManager', (), {}),
@@ -153,8 +147,7 @@ class TestUtility(TestCase):
         compare([
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.m.engine2}),
                 ('scoped_session', (self.Session,), {}),
                 ('register', (self.ScopedSession,), {'initial_state': STATUS_CHANGED}),
@@ -171,8 +164,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('mysql://foo',), {'echo':None}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine}),
                 ('scoped_session', (self.Session,), {}),
                 ('register', (self.ScopedSession,), {'initial_state': STATUS_CHANGED}),
@@ -189,8 +181,7 @@ class TestUtility(TestCase):
                 ('create_engine', ('mysql://foo',), {'echo':True}),
                 ('sessionmaker',
                  (),
-                 {'autocommit': False,
-                  'autoflush': True,
+                 {'autoflush': True,
                   'bind': self.engine}),
                 ('scoped_session', (self.Session,), {}),
                 ('register', (self.ScopedSession,), {'initial_state': STATUS_CHANGED}),
@@ -201,6 +192,82 @@ class TestUtility(TestCase):
                   'provided': ISession})
                 ],self.m.method_calls)
 
+    def test_scopefunc(self):
+        register_session(url='sqlite://foo', scopefunc=self.m.scopefunc)
+        compare([
+                ('create_engine', ('sqlite://foo',), {'echo':None}),
+                ('sessionmaker',
+                 (),
+                 {'autoflush': True,
+                  'bind': self.engine}),
+                ('scoped_session', (self.Session,),
+                 {'scopefunc': self.m.scopefunc}),
+                ('register', (self.ScopedSession,), {'initial_state': STATUS_CHANGED}),
+                ('getSiteManager', (), {}),
+                ('registry.registerUtility',
+                 (self.ScopedSession,),
+                 {'name': u'',
+                  'provided': ISession})
+                ],self.m.method_calls)
+
+    def test_scopefunc_but_not_scoped(self):
+        with ShouldRaise(
+            TypeError('A scopefunc can only be specified when using scoped sessions')
+            ):
+            register_session(url='mysql://', scoped=False,
+                             transactional=False, scopefunc=self.m.scopefunc)
+
+        compare([],self.m.method_calls)
+
+    def test_engine_options(self):
+        register_session(url='sqlite://foo', engine_options=dict(pool_size=5))
+        compare([
+                ('create_engine', ('sqlite://foo',),
+                 {'echo': None, 'pool_size': 5}),
+                ('sessionmaker',
+                 (),
+                 {'autoflush': True,
+                  'bind': self.engine}),
+                ('scoped_session', (self.Session,), {}),
+                ('register', (self.ScopedSession,), {'initial_state': STATUS_CHANGED}),
+                ('getSiteManager', (), {}),
+                ('registry.registerUtility',
+                 (self.ScopedSession,),
+                 {'name': u'',
+                  'provided': ISession})
+                ],self.m.method_calls)
+
+    def test_share_engine(self):
+        self.r.replace('mortar_rdb.shared_engine', self.m.shared_engine)
+        engine = self.m.shared_engine.return_value
+        register_session(url='sqlite://foo', share_engine=True,
+                         engine_options=dict(pool_size=5))
+        compare([
+                ('shared_engine', ('sqlite://foo',),
+                 {'echo': None, 'pool_size': 5}),
+                ('sessionmaker',
+                 (),
+                 {'autoflush': True,
+                  'bind': engine}),
+                ('scoped_session', (self.Session,), {}),
+                ('register', (self.ScopedSession,), {'initial_state': STATUS_CHANGED}),
+                ('getSiteManager', (), {}),
+                ('registry.registerUtility',
+                 (self.ScopedSession,),
+                 {'name': u'',
+                  'provided': ISession})
+                ],self.m.method_calls)
+
+    def test_engine_options_and_engine(self):
+        with ShouldRaise(TypeError(
+            'Cannot specify engine_options or share_engine '
+            'if an engine is passed'
+            )):
+            register_session(engine=self.m.engine2,
+                             engine_options=dict(pool_size=5))
+
+        compare([],self.m.method_calls)
+
     def test_echo_and_engine(self):
         with ShouldRaise(
             TypeError('Cannot specify echo if an engine is passed')
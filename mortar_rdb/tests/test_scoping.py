@@ -0,0 +1,316 @@
+import asyncio
+import logging
+from unittest import TestCase
+
+from mock import Mock
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import Column
+from sqlalchemy.types import Integer, String
+from testfixtures import (
+    ShouldRaise, compare, LogCapture, TempDirectory, StringComparison as S
+)
+from testfixtures.components import TestComponents
+
+from zope.component import getSiteManager
+
+from mortar_rdb import register_session, get_session
+from mortar_rdb.interfaces import ISession
+from mortar_rdb.scoping import (
+    ContextScope, RequestSessions, SessionMiddleware, request_scope
+)
+
+import transaction
+
+
+class TestContextScope(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.scope = ContextScope()
+        Base = declarative_base()
+        class Model(Base):
+            __tablename__ = 'model'
+            id = Column('id', Integer, primary_key=True)
+            name = Column('name', String(50))
+        self.Base = Base
+        self.Model = Model
+
+    def tearDown(self):
+        self.components.uninstall()
+
+    def test_no_scope(self):
+        register_session('sqlite://', scopefunc=self.scope)
+        with ShouldRaise(RuntimeError('No session scope is active')):
+            get_session()
+
+    def test_same_session_within_scope(self):
+        register_session('sqlite://', scopefunc=self.scope)
+        with self.scope.scope():
+            s1 = get_session()
+            s2 = get_session()
+        self.assertTrue(s1 is s2)
+
+    def test_different_sessions_for_different_scopes(self):
+        register_session('sqlite://', scopefunc=self.scope)
+        with self.scope.scope():
+            s1 = get_session()
+        with self.scope.scope():
+            s2 = get_session()
+        self.assertFalse(s1 is s2)
+
+    def test_nested_scope(self):
+        register_session('sqlite://', scopefunc=self.scope)
+        with self.scope.scope():
+            s1 = get_session()
+            with self.scope.scope():
+                s2 = get_session()
+            s3 = get_session()
+        self.assertFalse(s1 is s2)
+        self.assertTrue(s1 is s3)
+
+    def test_end_removes_session(self):
+        register_session('sqlite://', scopefunc=self.scope,
+                         transactional=False)
+        Session = getSiteManager().getUtility(ISession)
+        token = self.scope.begin()
+        session = get_session()
+        self.Base.metadata.create_all(session.bind)
+        session.add(self.Model(name='foo'))
+        session.flush()
+        self.assertTrue(Session.registry.has())
+        self.scope.end(token)
+        # the session has been closed and is no longer in the registry:
+        compare(session.new, expected=set())
+        compare(dict(Session.registry.registry), expected={})
+
+    def test_end_hooks(self):
+        register_session('sqlite://', scopefunc=self.scope)
+        called = []
+        self.scope.on_end.append(lambda: called.append(self.scope()))
+        with self.scope.scope():
+            key = self.scope()
+        # hooks are called while the scope is still active:
+        compare(called, expected=[key])
+
+    def test_end_leaves_other_registrations_alone(self):
+        register_session('sqlite://', scopefunc=self.scope)
+        register_session('sqlite://', name='thread')
+        thread_session = get_session('thread')
+        with self.scope.scope():
+            get_session()
+        self.assertTrue(get_session('thread') is thread_session)
+
+    def test_asyncio_tasks_in_one_thread(self):
+        register_session('sqlite://', scopefunc=self.scope)
+
+        async def request():
+            with self.scope.scope():
+                session = get_session()
+                await asyncio.sleep(0)
+                self.assertTrue(get_session() is session)
+                return session
+
+        async def main():
+            return await asyncio.gather(request(), request())
+
+        s1, s2 = asyncio.run(main())
+        self.assertFalse(s1 is s2)
+
+
+class TestRequestScope(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.dir = TempDirectory()
+        self.url = 'sqlite:///' + self.dir.getpath('test.db')
+        Base = declarative_base()
+        class Model(Base):
+            __tablename__ = 'model'
+            id = Column('id', Integer, primary_key=True)
+            name = Column('name', String(50))
+        Base.metadata.create_all(create_engine(self.url))
+        self.Model = Model
+
+    def tearDown(self):
+        self.components.uninstall()
+        self.dir.cleanup()
+
+    def _pool(self, name=''):
+        return getSiteManager().getUtility(ISession, name)().bind.pool
+
+    def test_scoped_session_removed(self):
+        register_session(self.url, transactional=False,
+                         engine_options=dict(poolclass=QueuePool))
+        Session = getSiteManager().getUtility(ISession)
+        with request_scope() as request:
+            session = get_session()
+            session.add(self.Model(name='foo'))
+            session.flush()
+            pool = session.bind.pool
+            compare(pool.checkedout(), expected=1)
+        compare(pool.checkedout(), expected=0)
+        compare(session.new, expected=set())
+        self.assertFalse(Session.registry.has())
+        compare(request.sessions, expected=[])
+        compare(request.connections, expected=1)
+        self.assertTrue(request.connection_time > 0)
+
+    def test_transactional_without_transaction(self):
+        register_session(self.url, engine_options=dict(poolclass=QueuePool))
+        with request_scope():
+            get_session().query(self.Model).count()
+            compare(self._pool().checkedout(), expected=1)
+        compare(self._pool().checkedout(), expected=0)
+
+    def test_transaction_aborted(self):
+        register_session(self.url, engine_options=dict(poolclass=QueuePool))
+        with ShouldRaise(ZeroDivisionError):
+            with request_scope():
+                with transaction.manager:
+                    get_session().add(self.Model(name='foo'))
+                    get_session().flush()
+                    1/0
+        compare(self._pool().checkedout(), expected=0)
+
+    def test_not_scoped(self):
+        register_session(self.url, transactional=False, scoped=False,
+                         engine_options=dict(poolclass=QueuePool))
+        with request_scope() as request:
+            s1 = get_session()
+            s2 = get_session()
+            s1.query(self.Model).count()
+            s2.query(self.Model).count()
+            compare(len(request.sessions), expected=2)
+            compare(self._pool().checkedout(), expected=2)
+        compare(self._pool().checkedout(), expected=0)
+        compare(request.connections, expected=2)
+
+    def test_same_session_added_once(self):
+        register_session(self.url)
+        with request_scope() as request:
+            get_session()
+            get_session()
+            compare(len(request.sessions), expected=1)
+
+    def test_decorator(self):
+        register_session(self.url, transactional=False,
+                         engine_options=dict(poolclass=QueuePool))
+
+        @request_scope()
+        def view():
+            get_session().query(self.Model).count()
+            return self._pool().checkedout()
+
+        compare(view(), expected=1)
+        compare(view(), expected=1)
+        compare(self._pool().checkedout(), expected=0)
+
+    def test_context_scope(self):
+        scope = ContextScope()
+        register_session(self.url, scopefunc=scope)
+        with request_scope(scope):
+            s1 = get_session()
+        with request_scope(scope):
+            s2 = get_session()
+        self.assertFalse(s1 is s2)
+        with ShouldRaise(RuntimeError):
+            get_session()
+
+    def test_connection_still_checked_out(self):
+        register_session(self.url, engine_options=dict(poolclass=QueuePool))
+        engine = get_session().bind
+        with LogCapture(level=logging.WARNING) as log:
+            with request_scope():
+                connection = engine.connect()
+        log.check(('mortar_rdb', 'WARNING',
+                   '1 connections still checked out at the end of the request'))
+        connection.close()
+
+    def test_not_in_request(self):
+        register_session(self.url, transactional=False,
+                         engine_options=dict(poolclass=QueuePool))
+        session = get_session()
+        session.query(self.Model).count()
+        self.assertTrue(session.bind.pool.checkedout())
+        session.close()
+
+
+class TestSessionMiddleware(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.dir = TempDirectory()
+        self.url = 'sqlite:///' + self.dir.getpath('test.db')
+        register_session(self.url, transactional=False,
+                         engine_options=dict(poolclass=QueuePool))
+        self.pool = get_session().bind.pool
+        self.start_response = Mock()
+
+    def tearDown(self):
+        self.components.uninstall()
+        self.dir.cleanup()
+
+    def test_normal(self):
+        def app(environ, start_response):
+            self.assertTrue(
+                isinstance(environ['mortar_rdb.request'], RequestSessions)
+            )
+            get_session().execute(text('select 1'))
+            start_response('200 OK', [])
+            return [b'body']
+
+        response = SessionMiddleware(app)({}, self.start_response)
+        compare(list(response), expected=[b'body'])
+        compare(self.pool.checkedout(), expected=1)
+        response.close()
+        compare(self.pool.checkedout(), expected=0)
+
+    def test_streaming(self):
+        def app(environ, start_response):
+            start_response('200 OK', [])
+            for i in range(2):
+                yield str(get_session().execute(text('select 1')).scalar()).encode()
+
+        response = SessionMiddleware(app)({}, self.start_response)
+        compare(list(response), expected=[b'1', b'1'])
+        response.close()
+        compare(self.pool.checkedout(), expected=0)
+
+    def test_app_closes_response(self):
+        closed = []
+        class Response(list):
+            def close(self):
+                closed.append(True)
+
+        def app(environ, start_response):
+            get_session().execute(text('select 1'))
+            return Response([b'x'])
+
+        SessionMiddleware(app)({}, self.start_response).close()
+        compare(closed, expected=[True])
+        compare(self.pool.checkedout(), expected=0)
+
+    def test_exception(self):
+        def app(environ, start_response):
+            get_session().execute(text('select 1'))
+            raise ZeroDivisionError()
+
+        with ShouldRaise(ZeroDivisionError):
+            SessionMiddleware(app)({}, self.start_response)
+        compare(self.pool.checkedout(), expected=0)
+
+    def test_warn_after(self):
+        def app(environ, start_response):
+            get_session().execute(text('select 1'))
+            return []
+
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/slow'}
+        with LogCapture(level=logging.WARNING) as log:
+            SessionMiddleware(app, warn_after=0)(environ,
+                                                 self.start_response).close()
+            SessionMiddleware(app, warn_after=60)(environ,
+                                                  self.start_response).close()
+        log.check(('mortar_rdb', 'WARNING',
+                   S(r'GET /slow held 1 connections for [\d.]+s')))
@@ -1,14 +1,26 @@
+import json
+import re
 from argparse import ArgumentParser
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
 
+from mock import Mock
 from sqlalchemy import (
-    Table, Column, Integer, MetaData, create_engine
+    Table, Column, Index, Integer, MetaData, ForeignKey, String,
+    create_engine, inspect, text
 )
-from sqlalchemy.engine.reflection import Inspector
 from testfixtures import (
-    OutputCapture, compare, LogCapture)
+    OutputCapture, compare, LogCapture, ShouldRaise, StringComparison as S)
 
 from mortar_rdb.controlled import Scripts, Config, Source
-from .base import ControlledTest, PackageTest
+from mortar_rdb.stats import human_size
+# tests replace parts of these, so they must be imported before
+# PackageTest snapshots sys.modules:
+import mortar_rdb.maintenance
+import mortar_rdb.partitions
+import mortar_rdb.purge
+from .base import ControlledTest, PackageTest, sqlite_page_size
 
 logger_name = 'mortar_rdb.controlled'
 
@@ -54,8 +66,8 @@ class TestCreate(ScriptsMixin, PackageTest):
         self.config = Config(Source(self.mytable))
         
     def _check_db(self, expected_metadata):
-        actual_metadata = MetaData(bind=create_engine(self.db_url))
-        actual_metadata.reflect()
+        actual_metadata = MetaData()
+        actual_metadata.reflect(create_engine(self.db_url))
         # hmm, not much of a test right now, could do with more depth
         compare(expected_metadata.tables.keys(),
                 actual_metadata.tables.keys())
@@ -81,7 +93,7 @@ user
 ''' % (self.db_url, ),
                     kw=dict(argv=['create']))
         expected_metadata = MetaData()
-        self.mytable.tometadata(expected_metadata)
+        self.mytable.to_metadata(expected_metadata)
         self._check_db(expected_metadata)
 
     def test_help(self):
@@ -136,7 +148,7 @@ user
         )
 
         expected_metadata = MetaData()
-        self.mytable.tometadata(expected_metadata)
+        self.mytable.to_metadata(expected_metadata)
         self.db_url = db_url
         self._check_db(expected_metadata)
 
@@ -159,7 +171,7 @@ user
         )
 
         expected_metadata = MetaData()
-        self.mytable.tometadata(expected_metadata)
+        self.mytable.to_metadata(expected_metadata)
         self.db_url = db_url
         self._check_db(expected_metadata)
 
@@ -190,7 +202,7 @@ Creating the following tables:
 user
 ''' % (self.db_url, ))
         expected_metadata = MetaData()
-        self.mytable.tometadata(expected_metadata)
+        self.mytable.to_metadata(expected_metadata)
         self._check_db(expected_metadata)
 
     def test_multi_source(self):
@@ -218,10 +230,28 @@ t2
 ''' % (self.db_url, ))
 
         expected_metadata = MetaData()
-        t1.tometadata(expected_metadata)
-        t2.tometadata(expected_metadata)
+        t1.to_metadata(expected_metadata)
+        t2.to_metadata(expected_metadata)
         self._check_db(expected_metadata)
     
+    def test_foreign_key_between_sources(self):
+        child = Table('child', MetaData(),
+                      Column('id', Integer, primary_key=True),
+                      Column('parent_id', ForeignKey('parent.id')))
+        parent = Table('parent', MetaData(),
+                       Column('id', Integer, primary_key=True))
+        self.config = Config(Source(child), Source(parent))
+
+        self._check('create','''
+For database at %s:
+Creating the following tables:
+parent
+child
+''' % (self.db_url, ))
+
+        fk, = inspect(create_engine(self.db_url)).get_foreign_keys('child')
+        compare('parent', fk['referred_table'])
+
     def test_table_present(self):
         self._setup_config()
         self.mytable.create(create_engine(self.db_url))
@@ -232,7 +262,7 @@ Refusing to create as the following tables exist:
 user
 ''' % self.db_url)
         expected_metadata = MetaData()
-        self.mytable.tometadata(expected_metadata)
+        self.mytable.to_metadata(expected_metadata)
 
 
 class TestDrop(ScriptsMixin, ControlledTest):
@@ -240,7 +270,7 @@ class TestDrop(ScriptsMixin, ControlledTest):
     def _check_tables(self,*expected):
         compare(
             list(expected),
-            Inspector.from_engine(self.engine).get_table_names()
+            inspect(self.engine).get_table_names()
             )
         
     def test_normal(self):
@@ -259,3 +289,424 @@ Refusing to drop all tables due to failsafe.
 ''' % self.db_url)
 
         self._check_tables('user')
+
+
+class TestAdviseIndexes(ScriptsMixin, ControlledTest):
+
+    def setUp(self):
+        super(TestAdviseIndexes, self).setUp()
+        metadata = MetaData()
+        self.table = Table('user', metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(50)),
+                           Column('team', Integer))
+        Index('ix_user_name', self.table.c.name)
+        self.config = Config(Source(self.table))
+        with self.engine.begin() as connection:
+            connection.execute(text('drop table user'))
+        metadata.create_all(self.engine)
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(), [
+                dict(name=str(i), team=i % 3) for i in range(5)
+            ])
+
+    def test_advice(self):
+        self.dir.write('workload.sql', '\n'.join([
+            'SELECT * FROM user WHERE team = ?',
+            'SELECT * FROM user WHERE team = ? AND id > ?',
+            'SELECT * FROM user WHERE name = ?',
+        ]), encoding='ascii')
+        self._check('advise-indexes %s' % self.dir.getpath('workload.sql'),
+                    '''
+For database at %s:
+Columns used in predicates without an index:
+user.team: used 2 times, score 10
+''' % self.db_url)
+
+    def test_all_indexed(self):
+        self.dir.write('workload.sql', 'SELECT * FROM user WHERE id = 1\n',
+                       encoding='ascii')
+        self._check('advise-indexes %s' % self.dir.getpath('workload.sql'),
+                    '''
+For database at %s:
+All columns used in predicates are indexed.
+''' % self.db_url)
+
+    def test_limit(self):
+        self.dir.write('workload.sql', '\n'.join([
+            'SELECT * FROM user WHERE team = ?',
+            'SELECT * FROM user WHERE team = ?',
+            'SELECT * FROM user WHERE name LIKE ? OR team > 2',
+            'SELECT * FROM user u1 JOIN user u2 ON u1.team = u2.id',
+        ]), encoding='ascii')
+        self._check('advise-indexes --limit 1 %s' % self.dir.getpath(
+            'workload.sql'
+        ), '''
+For database at %s:
+Columns used in predicates without an index:
+user.team: used 4 times, score 20
+''' % self.db_url)
+
+    def test_help(self):
+        output = self._check('advise-indexes --help', expected=SystemExit)
+        self.assertTrue('usage: X advise-indexes [-h] [--limit LIMIT] '
+                        'workload' in output, output)
+        self.assertTrue('leading column' in output, output)
+
+
+
+class TestMaintenance(ScriptsMixin, ControlledTest):
+
+    def setUp(self):
+        super(TestMaintenance, self).setUp()
+        self.log = LogCapture()
+        self.addCleanup(self.log.uninstall)
+
+    def _run(self, *argv):
+        self._callable()(list(argv))
+
+    def test_analyze(self):
+        self._run('analyze', '--jobs', '2')
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Running analyze on 1 tables using 2 jobs.'),
+            (logger_name, 'INFO', S(r'user: \d+\.\d{3}s')),
+            (logger_name, 'INFO', S(r'Total: \d+\.\d{3}s')),
+        )
+
+    def test_reindex(self):
+        self._run('reindex', '--timeout', '60')
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Running reindex on 1 tables using 1 jobs.'),
+            (logger_name, 'INFO', S(r'user: \d+\.\d{3}s')),
+            (logger_name, 'INFO', S(r'Total: \d+\.\d{3}s')),
+        )
+
+    def test_not_supported(self):
+        self._run('vacuum')
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Running vacuum on 1 tables using 1 jobs.'),
+            (logger_name, 'ERROR',
+             'vacuum is not supported for sqlite databases'),
+        )
+
+    def test_failure(self):
+        with self.engine.begin() as connection:
+            connection.execute(text('drop table user'))
+        self._run('analyze')
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Running analyze on 1 tables using 1 jobs.'),
+            (logger_name, 'ERROR', S(r'user: failed after \d+\.\d{3}s: '
+                                     r'.+no such table: user.*',
+                                     flags=re.DOTALL)),
+            (logger_name, 'INFO', S(r'Total: \d+\.\d{3}s')),
+        )
+
+
+class TestStats(ScriptsMixin, ControlledTest):
+
+    def setUp(self):
+        super(TestStats, self).setUp()
+        self.log = LogCapture()
+        self.addCleanup(self.log.uninstall)
+        with self.engine.begin() as connection:
+            self.page = sqlite_page_size(connection)
+            connection.execute(self.table.insert(),
+                               [dict(id=1), dict(id=2)])
+
+    def test_stats(self):
+        self._callable()(['stats'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO',
+             'Table  Rows  Table size  Index size  Dead rows  Free'),
+            (logger_name, 'INFO', 'user      2  %10s         0 B          -'
+                                  '     -' % human_size(self.page)),
+        )
+
+    def test_json(self):
+        path = self.dir.getpath('stats.json')
+        self._callable()(['stats', '--json', path])
+        with open(path) as source:
+            compare(dict(user=dict(rows=2, table_bytes=self.page,
+                                   index_bytes=0, dead_rows=None,
+                                   free_bytes=None)),
+                    json.load(source))
+
+
+class TestMaintainPartitions(ScriptsMixin, ControlledTest):
+
+    def setUp(self):
+        super(TestMaintainPartitions, self).setUp()
+        self.log = LogCapture()
+        self.addCleanup(self.log.uninstall)
+
+    def test_not_supported(self):
+        self._callable()(['maintain-partitions', '--date', '2026-10-19'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'ERROR',
+             'Partitioning is not supported for sqlite databases'),
+        )
+
+    def test_maintain(self):
+        executed = [
+            ('create', 'user', 'user_p2026_10', 'CREATE ...'),
+            ('detach', 'user', 'user_p2026_01', 'ALTER ...'),
+            ('drop', 'user', 'user_p2025_12', 'DROP ...'),
+        ]
+        maintain = Mock(return_value=executed)
+        self.r.replace('mortar_rdb.partitions.maintain_partitions', maintain)
+        self._callable()(['maintain-partitions', '--date', '2026-10-19'])
+        compare(date(2026, 10, 19), maintain.call_args.args[2])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Created partition user_p2026_10 of user'),
+            (logger_name, 'INFO', 'Detached partition user_p2026_01 of user'),
+            (logger_name, 'INFO', 'Dropped partition user_p2025_12 of user'),
+        )
+
+    def test_up_to_date(self):
+        self.r.replace('mortar_rdb.partitions.maintain_partitions',
+                       Mock(return_value=[]))
+        self._callable()(['maintain-partitions'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'All partitions are up to date.'),
+        )
+
+
+class TestSyncIndexes(ScriptsMixin, ControlledTest):
+
+    def setUp(self):
+        super(TestSyncIndexes, self).setUp()
+        self.log = LogCapture()
+        self.addCleanup(self.log.uninstall)
+        metadata = MetaData()
+        table = Table('user', metadata,
+                      Column('id', Integer, primary_key=True),
+                      Index('ix_user_id', 'id'))
+        self.config = Config(Source(table))
+
+    def _indexes(self):
+        return [index['name'] for index in inspect(self.engine).get_indexes(
+            'user'
+        )]
+
+    def test_sync(self):
+        self._callable()(['sync-indexes'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Creating 1 indexes.'),
+            (logger_name, 'INFO', 'Creating index ix_user_id on user'),
+            (logger_name, 'INFO', S(r'ix_user_id: \d+\.\d{3}s')),
+        )
+        compare(['ix_user_id'], self._indexes())
+
+    def test_up_to_date(self):
+        self._callable()(['sync-indexes'])
+        self.log.clear()
+        self._callable()(['sync-indexes'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'All indexes exist.'),
+        )
+
+    def test_dry_run(self):
+        self._callable()(['sync-indexes', '--dry-run'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Creating 1 indexes.'),
+            (logger_name, 'INFO', 'CREATE INDEX ix_user_id ON user (id)'),
+        )
+        compare([], self._indexes())
+
+    def test_failure(self):
+        self.r.replace('mortar_rdb.maintenance.build_index',
+                       Mock(side_effect=Exception('boom')))
+        self._callable()(['sync-indexes'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Creating 1 indexes.'),
+            (logger_name, 'INFO', 'Creating index ix_user_id on user'),
+            (logger_name, 'ERROR', 'ix_user_id: failed: boom'),
+        )
+
+    def test_progress(self):
+        def build_index(engine, index, invalid, progress, interval):
+            compare((False, 10), (invalid, interval))
+            progress(index, ('building index', 5, 10, 0, 0))
+            progress(index, ('loading tuples in tree', 0, 0, 3, 4))
+            progress(index, ('waiting for old snapshots', 0, 0, 0, 0))
+            return 1.5
+        self.r.replace('mortar_rdb.maintenance.build_index', build_index)
+        self._callable()(['sync-indexes'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Creating 1 indexes.'),
+            (logger_name, 'INFO', 'Creating index ix_user_id on user'),
+            (logger_name, 'INFO',
+             'ix_user_id: building index, 5 of 10 blocks'),
+            (logger_name, 'INFO',
+             'ix_user_id: loading tuples in tree, 3 of 4 tuples'),
+            (logger_name, 'INFO', 'ix_user_id: waiting for old snapshots'),
+            (logger_name, 'INFO', 'ix_user_id: 1.500s'),
+        )
+
+
+class TestPurge(ScriptsMixin, ControlledTest):
+
+    def setUp(self):
+        super(TestPurge, self).setUp()
+        self.log = LogCapture()
+        self.addCleanup(self.log.uninstall)
+        with self.engine.begin() as connection:
+            connection.execute(self.table.insert(),
+                               [dict(id=i) for i in range(1, 6)])
+        self.state = self.dir.getpath('purge.json')
+
+    def _ids(self, table='user'):
+        with self.engine.connect() as connection:
+            return connection.exec_driver_sql(
+                'select id from %s order by id' % table
+            ).scalars().all()
+
+    def test_purge(self):
+        self._callable()(['purge', 'user', 'id > 1', '--batch-size', '3',
+                          '--state', self.state])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Purging rows from user where id > 1.'),
+            (logger_name, 'INFO',
+             S(r'Purged 3 rows in \d+\.\d{3}s, 3 in total\.')),
+            (logger_name, 'INFO',
+             S(r'Purged 1 rows in \d+\.\d{3}s, 4 in total\.')),
+            (logger_name, 'INFO',
+             S(r'Purged 4 rows in total in \d+\.\d{3}s\.')),
+        )
+        compare([1], self._ids())
+        self.dir.compare(['sqlite.db', 'x/', 'x/__init__.py', 'x/y/',
+                          'x/y/__init__.py', 'x/y/z/', 'x/y/z/__init__.py'])
+
+    def test_resume(self):
+        with open(self.state, 'w') as target:
+            json.dump(dict(table='user', where='id > 1', after=[3]), target)
+        self._callable()(['purge', 'user', 'id > 1', '--state', self.state])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Resuming after (3,).'),
+            (logger_name, 'INFO', 'Purging rows from user where id > 1.'),
+            (logger_name, 'INFO',
+             S(r'Purged 2 rows in \d+\.\d{3}s, 2 in total\.')),
+            (logger_name, 'INFO',
+             S(r'Purged 2 rows in total in \d+\.\d{3}s\.')),
+        )
+        compare([1, 2, 3], self._ids())
+
+    def test_state_saved_on_failure(self):
+        def batch_then_fail(engine, table, where, batch_size, pause,
+                            archive, max_lag, lag, after, batch):
+            batch(2, (2,), 0.1)
+            raise RuntimeError('interrupted')
+        self.r.replace('mortar_rdb.purge.purge', batch_then_fail)
+        with ShouldRaise(RuntimeError('interrupted')):
+            self._callable()(['purge', 'user', 'id > 0',
+                              '--state', self.state])
+        with open(self.state) as source:
+            compare(dict(table='user', where='id > 0', after=[2]),
+                    json.load(source))
+
+    def test_state_key_types(self):
+        key = (datetime(2026, 10, 19, 12, 30), UUID(int=1), Decimal('1.5'))
+
+        def batch_then_fail(engine, table, where, batch_size, pause,
+                            archive, max_lag, lag, after, batch):
+            batch(2, key, 0.1)
+            raise RuntimeError('interrupted')
+        self.r.replace('mortar_rdb.purge.purge', batch_then_fail)
+        with ShouldRaise(RuntimeError('interrupted')):
+            self._callable()(['purge', 'user', 'id > 0',
+                              '--state', self.state])
+        with open(self.state) as source:
+            compare(dict(table='user', where='id > 0', after=[
+                dict(datetime='2026-10-19T12:30:00'),
+                dict(uuid='00000000-0000-0000-0000-000000000001'),
+                dict(decimal='1.5'),
+            ]), json.load(source))
+
+        resumed = Mock(return_value=0)
+        self.r.replace('mortar_rdb.purge.purge', resumed)
+        self._callable()(['purge', 'user', 'id > 0', '--state', self.state])
+        compare(key, resumed.call_args.args[8])
+
+    def test_state_kept_if_key_cannot_be_stored(self):
+        with open(self.state, 'w') as target:
+            json.dump(dict(table='user', where='id > 0', after=[1]), target)
+
+        def batch(engine, table, where, batch_size, pause, archive,
+                  max_lag, lag, after, batch):
+            batch(2, (object(),), 0.1)
+        self.r.replace('mortar_rdb.purge.purge', batch)
+        with ShouldRaise(TypeError):
+            self._callable()(['purge', 'user', 'id > 0',
+                              '--state', self.state])
+        with open(self.state) as source:
+            compare(dict(table='user', where='id > 0', after=[1]),
+                    json.load(source))
+        self.dir.compare(['purge.json', 'sqlite.db', 'x'], recursive=False)
+
+    def test_different_state(self):
+        with open(self.state, 'w') as target:
+            json.dump(dict(table='user', where='id > 2', after=[3]), target)
+        self._callable()(['purge', 'user', 'id > 1', '--state', self.state])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'ERROR',
+             self.state+' is the state of a different purge.'),
+        )
+        compare([1, 2, 3, 4, 5], self._ids())
+
+    def test_archive(self):
+        with self.engine.begin() as connection:
+            connection.exec_driver_sql(
+                'create table user_archive (id integer primary key)'
+            )
+        self._callable()(['purge', 'user', 'id < 3',
+                          '--archive', 'user_archive'])
+        compare([3, 4, 5], self._ids())
+        compare([1, 2], self._ids('user_archive'))
+
+    def test_not_in_config(self):
+        self._callable()(['purge', 'other', 'id > 1'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'ERROR', 'other is not in the configuration.'),
+        )
+
+    def test_max_lag_not_supported(self):
+        self._callable()(['purge', 'user', 'id > 1', '--max-lag', '5'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Purging rows from user where id > 1.'),
+            (logger_name, 'ERROR',
+             'Replica lag is not supported for sqlite databases'),
+        )
+        compare([1, 2, 3, 4, 5], self._ids())
+
+    def test_waits_for_lag(self):
+        self.r.replace('mortar_rdb.purge.replica_lag',
+                       Mock(side_effect=[9.0, 1.0]))
+        self.r.replace('mortar_rdb.purge.sleep', Mock())
+        self._callable()(['purge', 'user', 'id > 1', '--max-lag', '5'])
+        self.log.check(
+            (logger_name, 'INFO', 'For database at '+self.db_url+':'),
+            (logger_name, 'INFO', 'Purging rows from user where id > 1.'),
+            (logger_name, 'INFO', 'Replica lag is 9.0s, waiting.'),
+            (logger_name, 'INFO',
+             S(r'Purged 4 rows in \d+\.\d{3}s, 4 in total\.')),
+            (logger_name, 'INFO',
+             S(r'Purged 4 rows in total in \d+\.\d{3}s\.')),
+        )
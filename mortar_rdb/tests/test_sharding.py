@@ -0,0 +1,277 @@
+import os
+import threading
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import declarative_base
+from sqlalchemy.schema import Column
+from sqlalchemy.types import Integer, String
+from testfixtures import (
+    Replacer, ShouldRaise, compare, LogCapture, TempDirectory,
+    StringComparison as S
+)
+from testfixtures.components import TestComponents
+
+from mortar_rdb import register_session, get_session
+from mortar_rdb.sharding import (
+    ShardedSession, _execute_concurrently, _internals, _plan, _shard_id,
+    shard_executor
+)
+
+import transaction
+
+
+class TestSharding(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.dir = TempDirectory()
+        Base = declarative_base()
+        class Model(Base):
+            __tablename__ = 'model'
+            id = Column('id', Integer, primary_key=True)
+            region = Column('region', String(10))
+        self.Base = Base
+        self.Model = Model
+        self.shards = {
+            region: 'sqlite:///' + os.path.join(self.dir.path, region+'.db')
+            for region in ('eu', 'us')
+        }
+
+    def tearDown(self):
+        self.components.uninstall()
+        self.dir.cleanup()
+
+    @staticmethod
+    def shard_chooser(mapper, instance, clause=None):
+        return instance.region
+
+    def _populate(self):
+        session = get_session()
+        for shard_id in self.shards:
+            self.Base.metadata.create_all(
+                session.get_bind(None, shard_id=shard_id)
+            )
+        with transaction.manager:
+            session.add(self.Model(id=1, region='eu'))
+            session.add(self.Model(id=2, region='us'))
+            session.add(self.Model(id=3, region='eu'))
+
+    def _rows(self, shard_id):
+        engine = create_engine(self.shards[shard_id])
+        with engine.connect() as conn:
+            return [tuple(row) for row in conn.execute(
+                text('select id, region from model order by id')
+            )]
+
+    def test_flush_routed_by_shard(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self.assertTrue(isinstance(get_session(), ShardedSession))
+        self._populate()
+        compare(self._rows('eu'), expected=[(1, 'eu'), (3, 'eu')])
+        compare(self._rows('us'), expected=[(2, 'us')])
+
+    def test_query_all_shards_concurrently(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+
+        # both shards must be queried at the same time for this to pass:
+        barrier = threading.Barrier(2, timeout=5)
+        threads = set()
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('SELECT'):
+                threads.add(threading.current_thread().name)
+                barrier.wait()
+        for shard_id in self.shards:
+            event.listen(session.get_bind(None, shard_id=shard_id),
+                         'before_cursor_execute', record)
+
+        compare(sorted((m.id, m.region) for m in session.query(self.Model)),
+                expected=[(1, 'eu'), (2, 'us'), (3, 'eu')])
+        compare(len(threads), expected=2)
+        for name in threads:
+            self.assertTrue(name.startswith('mortar_rdb_shards'), name)
+        session.rollback()
+
+    def test_query_single_shard(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+        compare([m.id for m in session.query(self.Model).set_shard('us')],
+                expected=[2])
+        session.rollback()
+
+    def test_execute_chooser(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser,
+                         execute_chooser=lambda orm_context: ['eu'])
+        self._populate()
+        session = get_session()
+        compare(sorted(m.id for m in session.query(self.Model)),
+                expected=[1, 3])
+        session.rollback()
+
+    def test_get(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+        compare(session.get(self.Model, 2).region, expected='us')
+        session.rollback()
+
+    def test_bulk_update_all_shards(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser,
+                         transactional=False)
+        self._populate()
+        session = get_session()
+        result = session.query(self.Model).filter(self.Model.id > 1).update(
+            {'region': 'xx'}, synchronize_session=False
+        )
+        compare(result, expected=2)
+        session.commit()
+        compare(self._rows('eu'), expected=[(1, 'eu'), (3, 'xx')])
+        compare(self._rows('us'), expected=[(2, 'xx')])
+
+    def test_engines_passed(self):
+        engines = {
+            shard_id: create_engine(
+                url, connect_args={'check_same_thread': False}
+            )
+            for shard_id, url in self.shards.items()
+        }
+        register_session(shards=engines, shard_chooser=self.shard_chooser)
+        session = get_session()
+        self.assertTrue(session.get_bind(None, shard_id='eu') is engines['eu'])
+
+    def test_logging(self):
+        with LogCapture() as log:
+            register_session(shards=self.shards,
+                             shard_chooser=self.shard_chooser)
+        log.check(*(
+            ('mortar_rdb', 'INFO',
+             'Registering session for %s with name %r and shard %r' % (
+                 url, '', shard_id
+             ))
+            for shard_id, url in self.shards.items()
+        ))
+
+    def test_url_and_shards(self):
+        with ShouldRaise(
+            TypeError('Cannot specify engine or url when using shards')
+        ):
+            register_session('sqlite://', shards=self.shards,
+                             shard_chooser=self.shard_chooser)
+
+    def test_no_shard_chooser(self):
+        with ShouldRaise(
+            TypeError('Must specify shard_chooser when using shards')
+        ):
+            register_session(shards=self.shards)
+
+    def test_echo_and_engine(self):
+        with ShouldRaise(
+            TypeError('Cannot specify echo if an engine is passed')
+        ):
+            register_session(shards={'a': create_engine('sqlite://')},
+                             shard_chooser=self.shard_chooser,
+                             echo=True)
+
+    def test_private_orm_api(self):
+        # concurrent execution relies on private parts of the ORM, so
+        # check they are still there and behave as expected:
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+        planned = []
+
+        def plan(orm_context, compile_state_cls, shard_ids):
+            compare(_shard_id(orm_context, *_internals(orm_context)[1:]),
+                    expected=None)
+            result = _plan(orm_context, compile_state_cls, shard_ids)
+            planned.extend(bind_arguments['shard_id']
+                           for c, s, o, bind_arguments in result[1])
+            return result
+
+        r = Replacer()
+        self.addCleanup(r.restore)
+        r.replace('mortar_rdb.sharding._plan', plan)
+        with LogCapture('mortar_rdb') as log:
+            compare(len(session.query(self.Model).all()), expected=3)
+        log.check()
+        compare(planned, expected=['eu', 'us'])
+        compare(session.query(self.Model).set_shard('us').count(), expected=1)
+        session.rollback()
+
+    def test_private_orm_api_changed(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+        with Replacer() as r:
+            r.replace('mortar_rdb.sharding._warned', [])
+            def changed(orm_context):
+                return orm_context._compile_state_cls.missing
+            r.replace('mortar_rdb.sharding._internals', changed)
+            with LogCapture('mortar_rdb') as log:
+                compare(sorted(m.id for m in session.query(self.Model)),
+                        expected=[1, 2, 3])
+                session.query(self.Model).all()
+        log.check(
+            ('mortar_rdb', 'WARNING', S(
+                'Executing statements on shards in turn as concurrent '
+                'execution is not supported by this version of SQLAlchemy: '
+                '.+missing'
+            )),
+        )
+        session.rollback()
+
+    def test_execution_errors_not_hidden(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+        def bad(orm_context, compile_state_cls, shard_ids):
+            raise TypeError('bad parameters')
+        with Replacer() as r:
+            r.replace('mortar_rdb.sharding._warned', [])
+            r.replace('mortar_rdb.sharding._plan', bad)
+            with LogCapture('mortar_rdb') as log:
+                with ShouldRaise(TypeError('bad parameters')):
+                    session.query(self.Model).all()
+        log.check()
+        session.rollback()
+
+    def test_text_not_concurrent(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self._populate()
+        session = get_session()
+        with Replacer() as r:
+            r.replace('mortar_rdb.sharding._warned', [])
+            with LogCapture('mortar_rdb') as log:
+                compare(sorted(session.execute(
+                    text('select id from model')
+                ).scalars()), expected=[1, 2, 3])
+        log.check()
+        session.rollback()
+
+    def test_listener_registered_once(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        session = get_session()
+        compare(list(session.dispatch.do_orm_execute).count(
+            _execute_concurrently
+        ), expected=1)
+
+    def test_executor_shared(self):
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        first = get_session().executor(2)
+        register_session(shards=self.shards, shard_chooser=self.shard_chooser)
+        self.assertTrue(get_session().executor(2) is first)
+        self.assertTrue(get_session().executor(1) is first)
+        self.assertTrue(shard_executor(2) is first)
+
+    def test_executor_grows(self):
+        with Replacer() as r:
+            r.replace('mortar_rdb.sharding._executor', None)
+            r.replace('mortar_rdb.sharding._executor_workers', 0)
+            small = shard_executor(2)
+            self.assertTrue(shard_executor(1) is small)
+            large = shard_executor(3)
+            self.assertFalse(large is small)
+            self.assertTrue(shard_executor(2) is large)
@@ -0,0 +1,58 @@
+from unittest import TestCase
+
+from sqlalchemy import Column, Index, Integer, MetaData, Table, create_engine
+from testfixtures import Replacer, compare
+
+from mortar_rdb.stats import human_size, table_stats
+from .base import sqlite_page_size
+
+
+class TestTableStats(TestCase):
+
+    def setUp(self):
+        self.metadata = MetaData()
+        self.table = Table('order', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('value', Integer))
+        Index('ix_value', self.table.c.value)
+        Table('empty', self.metadata, Column('id', Integer))
+        self.engine = create_engine('sqlite://')
+        self.metadata.create_all(self.engine)
+
+    def test_sqlite(self):
+        with self.engine.begin() as connection:
+            page = sqlite_page_size(connection)
+            connection.execute(self.table.insert(),
+                               [dict(id=1, value=1), dict(id=2, value=2)])
+            # each table and index fits in one page:
+            compare({
+                'order': dict(rows=2, table_bytes=page, index_bytes=page,
+                              dead_rows=None, free_bytes=None),
+                'empty': dict(rows=0, table_bytes=page, index_bytes=0,
+                              dead_rows=None, free_bytes=None),
+            }, table_stats(connection, ['order', 'empty']))
+
+    def test_sqlite_without_dbstat(self):
+        with self.engine.connect() as connection:
+            with Replacer() as r:
+                r.replace('mortar_rdb.stats._sqlite_sizes',
+                          lambda connection, stats: None)
+                compare(dict(empty=dict(rows=0, table_bytes=None,
+                                        index_bytes=None, dead_rows=None,
+                                        free_bytes=None)),
+                        table_stats(connection, ['empty']))
+
+    def test_no_tables(self):
+        with self.engine.connect() as connection:
+            compare({}, table_stats(connection, []))
+
+
+class TestHumanSize(TestCase):
+
+    def test_sizes(self):
+        compare('-', human_size(None))
+        compare('0 B', human_size(0))
+        compare('1023 B', human_size(1023))
+        compare('1.5 kB', human_size(1536))
+        compare('2.0 MB', human_size(2*1024**2))
+        compare('3.0 TB', human_size(3*1024**4))
@@ -0,0 +1,266 @@
+import os
+from logging import WARNING
+import sqlite3
+from unittest import TestCase
+
+from mock import Mock
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.schema import Column
+from sqlalchemy.types import Integer, String
+from testfixtures import (
+    ShouldRaise, compare, LogCapture, TempDirectory, Comparison as C
+)
+from testfixtures.components import TestComponents
+from zope.component import getSiteManager
+
+from mortar_rdb import register_session, get_session
+from mortar_rdb.interfaces import ISession
+from mortar_rdb.scoping import ContextScope
+from mortar_rdb.tenants import (
+    register_tenant_session, TenantSessions, _schema_per_transaction
+)
+
+import transaction
+
+
+class TestTenants(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.dir = TempDirectory()
+        self.url = 'sqlite:///' + os.path.join(self.dir.path, '{tenant}.db')
+        Base = declarative_base()
+        class Model(Base):
+            __tablename__ = 'model'
+            id = Column('id', Integer, primary_key=True)
+            name = Column('name', String(50))
+        self.Base = Base
+        self.Model = Model
+
+    def tearDown(self):
+        getSiteManager().getUtility(ISession).dispose()
+        self.components.uninstall()
+        self.dir.cleanup()
+
+    def _sessions(self):
+        return getSiteManager().getUtility(ISession)
+
+    def test_register(self):
+        with LogCapture() as log:
+            register_tenant_session(self.url)
+        log.check((
+            'mortar_rdb',
+            'INFO',
+            "Registering tenant session for sqlite:///%s with name ''" % (
+                os.path.join(self.dir.path, '{tenant}.db')
+            )))
+        compare(self._sessions(), expected=C(TenantSessions, partial=True))
+
+    def test_database_per_tenant(self):
+        register_tenant_session(self.url)
+        for tenant in 'a', 'b':
+            with transaction.manager:
+                session = get_session(tenant=tenant)
+                self.Base.metadata.create_all(session.bind)
+                session.add(self.Model(name=tenant))
+
+        for tenant in 'a', 'b':
+            session = get_session(tenant=tenant)
+            compare([m.name for m in session.query(self.Model)],
+                    expected=[tenant])
+            session.rollback()
+
+        compare(sorted(os.listdir(self.dir.path)),
+                expected=['a.db', 'b.db'])
+
+    def test_same_session_for_tenant(self):
+        register_tenant_session(self.url)
+        self.assertTrue(get_session(tenant='a') is get_session(tenant='a'))
+        self.assertFalse(get_session(tenant='a') is get_session(tenant='b'))
+
+    def test_no_tenant(self):
+        register_tenant_session(self.url)
+        with ShouldRaise(
+            TypeError('A tenant must be specified for this session')
+        ):
+            get_session()
+
+    def test_tenant_for_normal_session(self):
+        register_session('sqlite://', name='normal')
+        register_tenant_session(self.url)
+        with ShouldRaise(TypeError(
+            "Session registered with name 'normal' does not support tenants"
+        )):
+            get_session('normal', tenant='a')
+
+    def test_no_placeholder(self):
+        with ShouldRaise(ValueError(
+            'Either url or schema must contain a {tenant} placeholder'
+        )):
+            register_tenant_session('sqlite://')
+        # so we have something to dispose of in tearDown
+        register_tenant_session(self.url)
+
+    def test_transactional_but_not_scoped(self):
+        with ShouldRaise(TypeError(
+            'Transactions can only be managed when using scoped sessions'
+        )):
+            register_tenant_session(self.url, scoped=False)
+        register_tenant_session(self.url)
+
+    def test_not_scoped(self):
+        register_tenant_session(self.url, scoped=False, transactional=False)
+        self.assertFalse(get_session(tenant='a') is get_session(tenant='a'))
+
+    def test_engine_options(self):
+        register_tenant_session(self.url,
+                                engine_options=dict(poolclass=QueuePool,
+                                                    pool_size=2))
+        engine = get_session(tenant='a').bind
+        self.assertTrue(isinstance(engine.pool, QueuePool))
+        compare(engine.pool.size(), expected=2)
+
+    def test_lru_eviction(self):
+        register_tenant_session(self.url, max_engines=2)
+        sessions = self._sessions()
+        a = get_session(tenant='a').bind
+        get_session(tenant='b')
+        # use a again so b is least recently used:
+        get_session(tenant='a')
+        get_session(tenant='c')
+        compare(list(sessions.engines()), expected=['a', 'c'])
+        self.assertTrue(sessions.engines()['a'] is a)
+
+    def test_nothing_logged_normally(self):
+        register_tenant_session(self.url, max_engines=1)
+        with LogCapture(level=WARNING) as log:
+            get_session(tenant='a')
+            # evicts a:
+            get_session(tenant='b')
+        log.check()
+        compare(list(self._sessions().engines()), expected=['b'])
+
+    def test_busy_engines_not_evicted(self):
+        register_tenant_session(
+            self.url, max_engines=1, transactional=False,
+            engine_options=dict(poolclass=QueuePool)
+        )
+        sessions = self._sessions()
+        session = get_session(tenant='a')
+        session.execute(text('select 1'))
+        with LogCapture() as log:
+            get_session(tenant='b')
+        log.check(
+            ('mortar_rdb', 'WARNING',
+             '2 tenant engines are in use, more than the maximum of 1'),
+        )
+        compare(list(sessions.engines()), expected=['a', 'b'])
+        session.rollback()
+        get_session(tenant='c')
+        compare(list(sessions.engines()), expected=['c'])
+
+    def test_live_session_not_evicted(self):
+        register_tenant_session(self.url, max_engines=1)
+        sessions = self._sessions()
+        Session = sessions.factory('a')
+        session = get_session(tenant='a')
+        self.Base.metadata.create_all(session.bind)
+        session.add(self.Model(name='a'))
+        session.flush()
+        with LogCapture() as log:
+            get_session(tenant='b')
+        log.check(
+            ('mortar_rdb', 'WARNING',
+             '2 tenant engines are in use, more than the maximum of 1'),
+        )
+        compare(list(sessions.engines()), expected=['a', 'b'])
+        self.assertTrue(Session() is session)
+        transaction.abort()
+        get_session(tenant='c')
+        compare(list(sessions.engines()), expected=['c'])
+
+    def test_schema_per_tenant_shares_engine(self):
+        register_tenant_session('sqlite://', schema='tenant_{tenant}',
+                                max_engines=1)
+        sessions = self._sessions()
+        a = get_session(tenant='a').bind
+        b = get_session(tenant='b').bind
+        compare(a.get_execution_options()['mortar_rdb_schema'],
+                expected='tenant_a')
+        compare(b.get_execution_options()['mortar_rdb_schema'],
+                expected='tenant_b')
+        self.assertTrue(a.engine.pool is b.engine.pool)
+        compare(list(sessions.engines()), expected=['b'])
+        compare(len(sessions._engines), expected=1)
+
+    def test_context_scope(self):
+        scope = ContextScope()
+        register_tenant_session(self.url, scopefunc=scope)
+        Session = self._sessions().factory('a')
+        with scope.scope():
+            session = get_session(tenant='a')
+            self.assertTrue(Session.registry.has())
+            self.assertTrue(get_session(tenant='a') is session)
+        compare(dict(Session.registry.registry), expected={})
+
+
+class TestSchemaPerTransaction(TestCase):
+
+    def _begin(self, **options):
+        engine = create_engine('sqlite://')
+        _schema_per_transaction(engine)
+        connection = Mock()
+        connection.get_execution_options.return_value = options
+        engine.dispatch.begin(connection)
+        return connection.connection.mock_calls
+
+    def test_begin(self):
+        compare(self._begin(mortar_rdb_schema='Tenant A'), expected=[
+            ('cursor', (), {}),
+            ('cursor().execute', ('SET LOCAL search_path TO "Tenant A"',), {}),
+            ('cursor().close', (), {}),
+        ])
+
+    def test_no_schema(self):
+        compare(self._begin(), expected=[])
+
+    def test_twophase_session(self):
+        # SQLite has no two-phase transactions or search_path, so record
+        # the statements that would set it and fake the two-phase parts:
+        executed = []
+
+        class Cursor:
+            def __init__(self, cursor):
+                self.cursor = cursor
+            def execute(self, statement, *args):
+                if statement.startswith('SET LOCAL'):
+                    executed.append(statement)
+                    return
+                return self.cursor.execute(statement, *args)
+            def __getattr__(self, name):
+                return getattr(self.cursor, name)
+
+        class Connection:
+            def __init__(self, connection):
+                self.connection = connection
+            def cursor(self):
+                return Cursor(self.connection.cursor())
+            def __getattr__(self, name):
+                return getattr(self.connection, name)
+
+        engine = create_engine('sqlite://', creator=lambda: Connection(
+            sqlite3.connect(':memory:', check_same_thread=False)
+        ))
+        _schema_per_transaction(engine)
+        dialect = engine.dialect
+        for name in ('begin', 'prepare', 'commit', 'rollback'):
+            setattr(dialect, 'do_%s_twophase' % name, Mock())
+        session = Session(bind=engine.execution_options(
+            mortar_rdb_schema='tenant_a'
+        ), twophase=True)
+        session.execute(text('select 1'))
+        session.commit()
+        dialect.do_begin_twophase.assert_called_once()
+        compare(executed, expected=['SET LOCAL search_path TO tenant_a'])
@@ -1,17 +1,32 @@
 import os
+import re
+import sqlite3
 
-from mortar_rdb.testing import register_session, TestingBase
+import mortar_rdb.testing
+from mortar_rdb.testing import (
+    register_session, TestingBase, Fixtures, LeakCheck, assert_max_queries,
+    record_workload,
+    assert_max_time, _fingerprint, _execute_script
+)
 from mortar_rdb import get_session, declarative_base
-from mortar_rdb.controlled import Config, Source
+from mortar_rdb.interfaces import ISession
+from mortar_rdb.controlled import Config, Source, _ddl
 from testfixtures.components import TestComponents
+from zope.component import getSiteManager
 from mock import Mock
 from sqlalchemy.pool import StaticPool
-from sqlalchemy.engine.reflection import Inspector
-from sqlalchemy.ext.declarative import declarative_base as sa_declarative_base
+from sqlalchemy import (
+    Index, MetaData, Table, create_engine, event, inspect, text
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import declarative_base as sa_declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Column, ForeignKey
 from sqlalchemy.types import Integer, String
-from testfixtures import Replacer, compare, TempDirectory, OutputCapture
+from testfixtures import (
+    Replacer, compare, TempDirectory, OutputCapture, ShouldRaise,
+    StringComparison as S
+)
 from unittest import TestCase
 
 class TestRegisterSessionFunctional(TestCase):
@@ -92,7 +107,7 @@ class TestRegisterSessionFunctional(TestCase):
         m1.model2 = m2
         session = get_session('create')
         if db_path.startswith('sqlite:'):
-            session.execute('PRAGMA foreign_keys = ON')
+            session.execute(text('PRAGMA foreign_keys = ON'))
         session.add(m1)
         session.add(m2)
         session.commit()
@@ -130,7 +145,7 @@ class TestRegisterSessionFunctional(TestCase):
         # only table1 should have been created!
         compare(
             [u'model1'],
-            Inspector.from_engine(get_session().bind).get_table_names()
+            inspect(get_session().bind).get_table_names()
             )
             
 class TestRegisterSessionCalls(TestCase):
@@ -146,11 +161,8 @@ class TestRegisterSessionCalls(TestCase):
         # mock out for certainty
         # self.r.replace('mortar_rdb.testing.???',Mock())
         # mock out for table destruction
-        get_session = Mock()
-        bind = get_session.return_value.bind
-        bind.dialect.inspector.return_value = inspector = Mock()
-        inspector.get_table_names.return_value = ()
-        self.r.replace('mortar_rdb.testing.get_session', get_session)
+        self.r.replace('mortar_rdb.testing.get_session', Mock())
+        self.r.replace('mortar_rdb.testing.drop_tables', Mock())
 
     def tearDown(self):
         self.r.restore()
@@ -264,3 +276,623 @@ class TestTestingBase(TestCase):
         self.assertFalse(b1 is b2)
         self.assertFalse(b3 is b2)
         self.assertTrue(b1 is b3)
+
+
+class TestCreateStatements(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.dir = TempDirectory()
+        self.r = Replacer()
+        self.r.replace('mortar_rdb.testing._ddl_cache', {})
+        self.r.replace('mortar_rdb.testing._snapshots', {})
+        self.r.replace('os.environ', dict())
+        self.compiled = []
+        self.r.replace('mortar_rdb.controlled._ddl', self._ddl)
+
+    def tearDown(self):
+        self.r.restore()
+        self.dir.cleanup()
+        self.components.uninstall()
+
+    def _ddl(self, metadata, dialect, drop=False, schema_translate_map=None,
+             tables=None):
+        if tables is None:
+            tables = metadata.tables.values()
+        self.compiled.append(sorted(table.name for table in tables))
+        return _ddl(metadata, dialect, drop, schema_translate_map, tables)
+
+    def _metadata(self, unique=False):
+        metadata = MetaData()
+        Table('parent', metadata,
+              Column('id', Integer, primary_key=True))
+        Table('child', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('name', String(50), unique=unique),
+              Column('parent_id', ForeignKey('parent.id'), index=True))
+        return metadata
+
+    def _check_tables(self, session, *expected):
+        compare(sorted(expected),
+                sorted(inspect(session.bind).get_table_names()))
+
+    def test_compiled_once(self):
+        session = register_session(metadata=self._metadata())
+        self._check_tables(session, 'parent', 'child')
+        session = register_session(metadata=self._metadata())
+        self._check_tables(session, 'parent', 'child')
+        compare([['child', 'parent']], self.compiled)
+
+    def test_config(self):
+        metadata = self._metadata()
+        config = Config(Source(metadata.tables['parent']),
+                        Source(metadata.tables['child']))
+        session = register_session(config=config)
+        self._check_tables(session, 'parent', 'child')
+        session = register_session(config=config)
+        self._check_tables(session, 'parent', 'child')
+        compare([['child', 'parent']], self.compiled)
+
+    def test_schema_changed(self):
+        register_session(metadata=self._metadata())
+        session = register_session(metadata=self._metadata(unique=True))
+        compare([['child', 'parent']]*2, self.compiled)
+        unique, = inspect(session.bind).get_unique_constraints('child')
+        compare(['name'], unique['column_names'])
+
+    def test_fingerprint(self):
+        dialect = create_engine('sqlite://').dialect
+        fingerprints = {
+            _fingerprint(self._metadata(), dialect),
+            _fingerprint(self._metadata(), dialect),
+        }
+        compare(1, len(fingerprints))
+        metadata = self._metadata()
+        Index('ix_name', metadata.tables['child'].c.name)
+        fingerprints.add(_fingerprint(metadata, dialect))
+        fingerprints.add(_fingerprint(self._metadata(unique=True), dialect))
+        compare(3, len(fingerprints))
+
+    def test_fingerprint_dialect_options(self):
+        dialect = create_engine('sqlite://').dialect
+        plain = self._metadata()
+        partial = self._metadata()
+        table = partial.tables['child']
+        Index('ix_name', table.c.name, sqlite_where=table.c.id > 1)
+        other = self._metadata()
+        table = other.tables['child']
+        Index('ix_name', table.c.name, sqlite_where=table.c.id > 2)
+        compare(3, len({_fingerprint(plain, dialect),
+                        _fingerprint(partial, dialect),
+                        _fingerprint(other, dialect)}))
+
+    def test_fingerprint_text_default(self):
+        def metadata(default):
+            metadata = MetaData()
+            Table('model', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', String(50),
+                         server_default=text(default)))
+            return metadata
+        dialect = create_engine('sqlite://').dialect
+        compare(_fingerprint(metadata("'x'"), dialect),
+                _fingerprint(metadata("'x'"), dialect))
+        self.assertNotEqual(_fingerprint(metadata("'x'"), dialect),
+                            _fingerprint(metadata("'y'"), dialect))
+
+    def test_config_and_metadata(self):
+        metadata = self._metadata()
+        Table('other', metadata, Column('id', Integer, primary_key=True))
+        config = Config(Source(metadata.tables['parent']))
+        session = register_session(config=config, metadata=metadata)
+        self._check_tables(session, 'parent', 'child', 'other')
+        compare([['parent'], ['child', 'other']], self.compiled)
+
+    def test_disk_cache(self):
+        os.environ['DDL_CACHE'] = self.dir.getpath('cache')
+        register_session(metadata=self._metadata())
+        compare(1, len(self.compiled))
+        filename, = os.listdir(self.dir.getpath('cache'))
+        compare(S('[0-9a-f]{40}.json'), filename)
+
+        # as if in a new process:
+        mortar_rdb.testing._ddl_cache.clear()
+        session = register_session(metadata=self._metadata())
+        self._check_tables(session, 'parent', 'child')
+        compare(1, len(self.compiled))
+
+    def test_no_tables(self):
+        session = register_session(metadata=MetaData())
+        self._check_tables(session)
+
+
+class TestSnapshots(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.r = Replacer()
+        self.r.replace('mortar_rdb.testing._snapshots', {})
+        self.r.replace('os.environ', dict())
+        self.metadata = MetaData()
+        self.table = Table('model', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('name', String(50)))
+        self.loaded = []
+
+    def tearDown(self):
+        self.r.restore()
+        self.components.uninstall()
+
+    def _fixtures(self, connection):
+        self.loaded.append(connection)
+        connection.execute(self.table.insert(), [dict(name='foo'),
+                                                 dict(name='bar')])
+
+    def _names(self, session):
+        return [name for name, in session.execute(
+            text('select name from model order by id')
+        )]
+
+    def test_restored(self):
+        execute = Mock(wraps=_execute_script)
+        self.r.replace('mortar_rdb.testing._execute_script', execute)
+
+        session = register_session(metadata=self.metadata,
+                                   fixtures=self._fixtures)
+        compare(['foo', 'bar'], self._names(session))
+        session.execute(text("insert into model (name) values ('baz')"))
+
+        session = register_session(metadata=self.metadata,
+                                   fixtures=self._fixtures)
+        compare(['foo', 'bar'], self._names(session))
+
+        compare(1, len(self.loaded))
+        compare(1, execute.call_count)
+
+    def test_separate_databases(self):
+        session1 = register_session(name='one', metadata=self.metadata,
+                                    transactional=False)
+        session2 = register_session(name='two', metadata=self.metadata,
+                                    transactional=False)
+        session1.execute(text("insert into model (name) values ('foo')"))
+        session1.commit()
+        compare(['foo'], self._names(session1))
+        compare([], self._names(session2))
+
+    def test_different_fixtures(self):
+        register_session(metadata=self.metadata, fixtures=self._fixtures)
+        session = register_session(metadata=self.metadata)
+        compare([], self._names(session))
+        compare(2, len(mortar_rdb.testing._snapshots))
+
+    def test_config(self):
+        config = Config(Source(self.table))
+        register_session(config=config)
+        session = register_session(config=config)
+        compare(['model'], inspect(session.bind).get_table_names())
+        compare(1, len(mortar_rdb.testing._snapshots))
+
+    def test_fixtures_matched_by_rows(self):
+        register_session(metadata=self.metadata, fixtures=Fixtures(
+            {self.table: [dict(name='foo')]}
+        ))
+        session = register_session(metadata=self.metadata, fixtures=Fixtures(
+            {self.table: [dict(name='foo')]}
+        ))
+        compare(['foo'], self._names(session))
+        compare(1, len(mortar_rdb.testing._snapshots))
+        session = register_session(metadata=self.metadata, fixtures=Fixtures(
+            {self.table: [dict(name='bar')]}
+        ))
+        compare(['bar'], self._names(session))
+        compare(2, len(mortar_rdb.testing._snapshots))
+
+    def test_fixtures_key(self):
+        for i in range(2):
+            fixtures = lambda connection: self._fixtures(connection)
+            fixtures.key = 'foo and bar'
+            session = register_session(metadata=self.metadata,
+                                       fixtures=fixtures)
+            compare(['foo', 'bar'], self._names(session))
+        compare(1, len(self.loaded))
+
+    def test_schema_changed(self):
+        register_session(metadata=self.metadata, fixtures=self._fixtures)
+        metadata = MetaData()
+        Table('model', metadata,
+              Column('id', Integer, primary_key=True),
+              Column('name', String(50), unique=True))
+        register_session(metadata=metadata, fixtures=self._fixtures)
+        compare(2, len(self.loaded))
+
+    def test_limit(self):
+        self.r.replace('mortar_rdb.testing._snapshot_limit', 2)
+        names = 'foo', 'bar', 'baz'
+        snapshots = mortar_rdb.testing._snapshots
+        for name in names:
+            register_session(metadata=self.metadata, fixtures=Fixtures(
+                {self.table: [dict(name=name)]}
+            ))
+            if name == 'foo':
+                oldest, = snapshots.values()
+        compare(2, len(snapshots))
+        # the oldest has been evicted and closed, the others are kept:
+        with ShouldRaise(sqlite3.ProgrammingError):
+            oldest.execute('select 1')
+        for name in names[1:]:
+            key = Fixtures({self.table: [dict(name=name)]}).key
+            snapshot, = [snapshot for (config, metadata, fixtures), snapshot
+                         in snapshots.items() if fixtures == key]
+            compare([(name,)], snapshot.execute(
+                'select name from model'
+            ).fetchall())
+
+    def test_limit_least_recently_used(self):
+        self.r.replace('mortar_rdb.testing._snapshot_limit', 2)
+        foo = Fixtures({self.table: [dict(name='foo')]})
+        bar = Fixtures({self.table: [dict(name='bar')]})
+        baz = Fixtures({self.table: [dict(name='baz')]})
+        for fixtures in foo, bar, foo, baz:
+            register_session(metadata=self.metadata, fixtures=fixtures)
+        compare({foo.key, baz.key},
+                {key[-1] for key in mortar_rdb.testing._snapshots})
+
+    def test_nothing_to_snapshot(self):
+        register_session()
+        compare({}, mortar_rdb.testing._snapshots)
+
+    def test_url_not_snapshotted(self):
+        with TempDirectory() as dir:
+            url = 'sqlite:///'+dir.getpath('test.db')
+            register_session(url, metadata=self.metadata,
+                             fixtures=self._fixtures)
+            session = register_session(url, metadata=self.metadata,
+                                       fixtures=self._fixtures)
+            compare(['foo', 'bar'], self._names(session))
+            session.rollback()
+            session.bind.dispose()
+        compare(2, len(self.loaded))
+        compare({}, mortar_rdb.testing._snapshots)
+
+
+class TestFixtures(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.r = Replacer()
+        self.r.replace('mortar_rdb.testing._snapshots', {})
+        self.r.replace('os.environ', dict())
+
+        Base = sa_declarative_base()
+
+        class Parent(Base):
+            __tablename__ = 'parent'
+            id = Column(Integer, primary_key=True)
+            name = Column('parent_name', String(50))
+
+        class Child(Base):
+            __tablename__ = 'child'
+            id = Column(Integer, primary_key=True)
+            parent_id = Column(ForeignKey('parent.id'), nullable=False)
+            value = Column(Integer)
+
+        self.Base = Base
+        self.Parent = Parent
+        self.Child = Child
+
+    def tearDown(self):
+        self.r.restore()
+        self.components.uninstall()
+
+    def _session(self, fixtures=None):
+        session = register_session(metadata=self.Base.metadata,
+                                   transactional=False,
+                                   fixtures=fixtures)
+        session.execute(text('PRAGMA foreign_keys = ON'))
+        return session
+
+    def _executes(self):
+        executes = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            executes.append((statement, executemany))
+
+        event.listen(Engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, Engine, 'before_cursor_execute', record)
+        return executes
+
+    def test_dependency_order(self):
+        fixtures = Fixtures({
+            self.Child: [dict(id=1, parent_id=1, value=10),
+                         dict(id=2, parent_id=2, value=20)],
+            self.Parent: [dict(id=1, name='one'), dict(id=2, name='two')],
+        })
+        session = self._session()
+        executes = self._executes()
+        fixtures.load(session)
+        session.commit()
+        compare([
+            (S('INSERT INTO parent .+'), True),
+            (S('INSERT INTO child .+'), True),
+        ], executes)
+        compare([(1, 'one'), (2, 'two')],
+                [(p.id, p.name) for p in session.query(self.Parent)])
+        compare([(1, 1, 10), (2, 2, 20)],
+                [(c.id, c.parent_id, c.value)
+                 for c in session.query(self.Child)])
+
+    def test_config_order(self):
+        config = Config(Source(self.Child.__table__),
+                        Source(self.Parent.__table__))
+        fixtures = Fixtures({
+            self.Child.__table__: [dict(id=1, parent_id=1)],
+            self.Parent.__table__: [dict(id=1, parent_name='one')],
+        }, config=config)
+        session = register_session(config=config, transactional=False,
+                                   fixtures=fixtures)
+        compare([(1, 1)], [(c.id, c.parent_id)
+                           for c in session.query(self.Child)])
+
+    def test_not_in_config(self):
+        other = Table('other', MetaData(), Column('id', Integer))
+        fixtures = Fixtures({self.Parent: [dict(id=1)]},
+                            config=Config(Source(other)))
+        with ShouldRaise(ValueError('Tables not in configuration: parent')):
+            fixtures(None)
+
+    def test_compiled_once(self):
+        fixtures = Fixtures({self.Parent: [dict(id=1, name='one')]})
+        compile = Mock(wraps=fixtures._compile)
+        fixtures._compile = compile
+        for i in range(2):
+            session = register_session(metadata=self.Base.metadata,
+                                       name=str(i), transactional=False)
+            fixtures.load(session)
+            compare(['one'], [p.name for p in session.query(self.Parent)])
+        compare(1, compile.call_count)
+
+    def test_different_keys(self):
+        fixtures = Fixtures({self.Parent: [
+            dict(id=1, name='one'),
+            dict(id=2),
+            dict(id=3),
+            dict(id=4, name='four'),
+        ]})
+        session = self._session()
+        executes = self._executes()
+        fixtures.load(session)
+        compare([False, True, False], [many for _, many in executes])
+        compare([(1, 'one'), (2, None), (3, None), (4, 'four')],
+                [(p.id, p.name) for p in session.query(self.Parent)])
+
+    def test_inheritance(self):
+        Base = sa_declarative_base()
+
+        class Thing(Base):
+            __tablename__ = 'thing'
+            id = Column(Integer, primary_key=True)
+            type = Column(String(10))
+            __mapper_args__ = dict(polymorphic_on=type,
+                                   polymorphic_identity='thing')
+
+        class Widget(Thing):
+            __tablename__ = 'widget'
+            id = Column(ForeignKey('thing.id'), primary_key=True)
+            size = Column(Integer)
+            __mapper_args__ = dict(polymorphic_identity='widget')
+
+        class Gadget(Thing):
+            __mapper_args__ = dict(polymorphic_identity='gadget')
+
+        session = register_session(
+            metadata=Base.metadata, transactional=False,
+            fixtures=Fixtures({
+                Widget: [dict(id=1, size=5)],
+                Gadget: [dict(id=2)],
+                Thing: [dict(id=3, type='other')],
+            }))
+        compare([(1, 'widget'), (2, 'gadget'), (3, 'other')],
+                [tuple(row) for row in session.execute(
+                    text('select id, type from thing order by id')
+                )])
+        compare([(1, 5)], [tuple(row) for row in session.execute(
+            text('select id, size from widget')
+        )])
+
+
+class TestLeakCheck(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.r = Replacer()
+        self.r.replace('os.environ', dict())
+        self.r.replace('mortar_rdb.testing._checkouts', {})
+        self.r.replace('mortar_rdb.testing._leak_checks', [])
+
+    def tearDown(self):
+        self.r.restore()
+        self.components.uninstall()
+
+    def _remove(self, name=''):
+        getSiteManager().getUtility(ISession, name).remove()
+
+    def test_clean(self):
+        with LeakCheck():
+            session = register_session(transactional=False)
+            session.execute(text('select 1'))
+            self._remove()
+
+    def test_never_removed(self):
+        check = LeakCheck()
+        register_session(name='foo', transactional=False)
+        with ShouldRaise(AssertionError("Session 'foo' was never removed")):
+            check.check()
+
+    def test_open_transaction(self):
+        check = LeakCheck()
+        session = register_session(transactional=False)
+        session.execute(text('select 1'))
+        compare([
+            "Session '' has an open transaction and was never removed",
+            S("Connection to sqlite:// checked out at:\n"
+              ".+in test_open_transaction\n"
+              ".+session.execute\\(text\\('select 1'\\)\\)",
+              flags=re.DOTALL),
+        ], check.leaks())
+        check.restore()
+
+    def test_connection_leaked(self):
+        check = LeakCheck()
+        session = register_session(transactional=False)
+        connection = session.bind.connect()
+        self._remove()
+        with ShouldRaise(AssertionError(S(
+                "Connection to sqlite:// checked out at:\n"
+                ".+in test_connection_leaked\n"
+                ".+connection = session.bind.connect\\(\\)",
+                flags=re.DOTALL
+        ))):
+            check.check()
+        connection.close()
+        compare({}, mortar_rdb.testing._checkouts)
+
+    def test_connection_returned(self):
+        check = LeakCheck()
+        session = register_session(transactional=False)
+        connection = session.bind.connect()
+        connection.close()
+        self._remove()
+        check.check()
+        compare({}, mortar_rdb.testing._checkouts)
+
+    def test_other_engines_ignored(self):
+        session = register_session(name='before', transactional=False)
+        with LeakCheck() as check:
+            connection = session.bind.connect()
+            compare([], check.leaks())
+        connection.close()
+
+    def test_not_active(self):
+        check = LeakCheck()
+        check.restore()
+        session = register_session(transactional=False)
+        connection = session.bind.connect()
+        compare([], check.leaks())
+        compare({}, mortar_rdb.testing._checkouts)
+        connection.close()
+
+    def test_exception_in_context_manager(self):
+        with ShouldRaise(ValueError):
+            with LeakCheck():
+                register_session(transactional=False)
+                raise ValueError()
+        compare([], mortar_rdb.testing._leak_checks)
+
+
+class TestQueryBudgets(TestCase):
+
+    def setUp(self):
+        self.components = TestComponents()
+        self.r = Replacer()
+        self.r.replace('os.environ', dict())
+        self.session = register_session(transactional=False)
+
+    def tearDown(self):
+        self.r.restore()
+        self.components.uninstall()
+
+    def _select(self, session, i):
+        session.execute(text('select %i' % i))
+
+    def test_max_queries_okay(self):
+        with assert_max_queries(2) as statements:
+            self._select(self.session, 1)
+            self._select(self.session, 2)
+        compare([('select 1', S('.*')), ('select 2', S('.*'))],
+                [(sql, str(seconds)) for sql, seconds in statements])
+
+    def test_max_queries_exceeded(self):
+        with ShouldRaise(AssertionError(S(
+            '3 statements executed, expected at most 2:\n'
+            '\\d+\\.\\d{6}s: select 1\n'
+            '\\d+\\.\\d{6}s: select 2\n'
+            '\\d+\\.\\d{6}s: select 3'
+        ))):
+            with assert_max_queries(2):
+                for i in range(1, 4):
+                    self._select(self.session, i)
+
+    def test_named_session(self):
+        other = register_session(name='other', transactional=False)
+        with assert_max_queries(0):
+            self._select(other, 1)
+        with ShouldRaise(AssertionError):
+            with assert_max_queries(0, name='other'):
+                self._select(other, 1)
+
+    def test_listeners_removed(self):
+        with assert_max_queries(0):
+            pass
+        self._select(self.session, 1)
+
+    def test_exception_in_block(self):
+        with ShouldRaise(ValueError):
+            with assert_max_queries(0):
+                self._select(self.session, 1)
+                raise ValueError()
+        with assert_max_queries(0):
+            pass
+
+    def test_record_workload(self):
+        with TempDirectory() as dir:
+            path = dir.getpath('workload.sql')
+            with record_workload(path) as statements:
+                self.session.execute(text('select\n  1'))
+                self._select(self.session, 2)
+            compare(2, len(statements))
+            with record_workload(path):
+                self._select(self.session, 2)
+            compare(b'select 1\nselect 2\nselect 2\n',
+                    dir.read('workload.sql'))
+
+    def test_max_time_okay(self):
+        self.r.replace('mortar_rdb.testing.perf_counter',
+                       Mock(side_effect=[0, 0.1, 1, 1.2]))
+        with assert_max_time(0.3) as statements:
+            self._select(self.session, 1)
+            self._select(self.session, 2)
+        compare([('select 1', 0.1), ('select 2', 0.2)],
+                [(sql, round(seconds, 3)) for sql, seconds in statements])
+
+    def test_max_time_exceeded(self):
+        self.r.replace('mortar_rdb.testing.perf_counter',
+                       Mock(side_effect=[0, 0.1, 1, 1.25]))
+        with ShouldRaise(AssertionError(
+            'Statements took 0.350000s, expected at most 0.300000s:\n'
+            '0.100000s: select 1\n'
+            '0.250000s: select 2'
+        )):
+            with assert_max_time(0.3):
+                self._select(self.session, 1)
+                self._select(self.session, 2)
+
+    def test_sharded(self):
+        from mortar_rdb import register_session as real_register_session
+        real_register_session(name='sharded', shards=dict(
+            a=create_engine('sqlite://'), b=create_engine('sqlite://')
+        ), shard_chooser=lambda *args, **kw: 'a', transactional=False)
+        with ShouldRaise(AssertionError(S('2 statements executed.+',
+                                          flags=re.DOTALL))):
+            with assert_max_queries(1, name='sharded'):
+                session = get_session('sharded')
+                for shard_id in 'a', 'b':
+                    session.execute(text('select 1'),
+                                    bind_arguments=dict(shard_id=shard_id))
+
+    def test_not_bound(self):
+        getSiteManager().registerUtility(Mock(spec=[]), ISession, 'odd')
+        with ShouldRaise(TypeError(
+            "Session registered with name 'odd' is not bound to an engine"
+        )):
+            with assert_max_queries(1, name='odd'):
+                pass
@@ -2,7 +2,7 @@ from mortar_rdb import register_session, get_session
 from mortar_rdb.interfaces import ISession
 from testfixtures.components import TestComponents
 from sqlalchemy.exc import OperationalError
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm.session import Session
 from sqlalchemy.schema import Column
 from sqlalchemy.types import Integer, String
@@ -20,19 +20,22 @@ setup(
         'Development Status :: 5 - Production/Stable',
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
-    python_requires='>=3.6',
-    packages=find_packages(),
+    python_requires='>=3.7',
+    packages=find_packages(exclude=['benchmarks']),
     include_package_data=True,
     zip_safe=False,
     install_requires = (
-        'SQLAlchemy<1.4',
+        'SQLAlchemy>=2,<2.1',
         'zope.component<5',
         'zope.dottedname',
         'zope.interface',
-        'zope.sqlalchemy<1.2',
+        'zope.sqlalchemy>=2',
         ),
     extras_require=dict(
         test=[